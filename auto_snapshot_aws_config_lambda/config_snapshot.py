@@ -0,0 +1,241 @@
+# ========================================
+# config_snapshot.py — ĐỌC STREAM SNAPSHOT AWS CONFIG (.json.gz) + TÁCH DELTA THEO RESOURCE
+# ========================================
+import os
+import json
+import zlib
+import heapq
+import hashlib
+import logging
+import tempfile
+from json_stream import iter_array_items
+
+logger = logging.getLogger()
+
+# số (key, hash) giữ trong RAM trước khi ghi 1 run đã sort ra /tmp
+SNAPSHOT_RUN_SIZE = int(os.environ.get("SNAPSHOT_RUN_SIZE", "100000"))
+# index (key, hash) đã sort của snapshot gần nhất + delta, cùng bucket với snapshot
+SNAPSHOT_INDEX_PREFIX = os.environ.get("SNAPSHOT_INDEX_PREFIX", "config-snapshot-index")
+SNAPSHOT_DELTA_PREFIX = os.environ.get("SNAPSHOT_DELTA_PREFIX", "config-snapshot-delta")
+READ_CHUNK_BYTES = 256 * 1024
+
+DELETED_STATUSES = ("ResourceDeleted", "ResourceDeletedNotRecorded")
+# field đổi ở mọi lần capture, không tính vào hash
+VOLATILE_FIELDS = ("configurationItemCaptureTime", "configurationStateId", "configurationItemMD5Hash",
+                   "configurationStateMd5Hash")
+
+
+# === ĐỌC SNAPSHOT ===
+def iter_gzip_chunks(chunks):
+    """bytes gzip → bytes đã giải nén, mỗi chunk ≤ READ_CHUNK_BYTES (không giữ cả file)."""
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = inflater.decompress(chunk, READ_CHUNK_BYTES)
+        while data:
+            yield data
+            tail = inflater.unconsumed_tail
+            data = inflater.decompress(tail, READ_CHUNK_BYTES) if tail else b""
+    tail = inflater.flush()
+    if tail:
+        yield tail
+
+
+def iter_s3_chunks(s3, bucket: str, key: str):
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+    chunks = body.iter_chunks(READ_CHUNK_BYTES)
+    return iter_gzip_chunks(chunks) if key.endswith(".gz") else chunks
+
+
+def iter_configuration_items(chunks):
+    """configurationItems[] của snapshot, từng item một."""
+    for _, item in iter_array_items(chunks, ("configurationItems",)):
+        if isinstance(item, dict):
+            yield item
+
+
+def item_key(item: dict):
+    """Cùng format identifier với document aws_state: AWS__EC2__Instance_i-123"""
+    return f"{item.get('resourceType', '').replace('::', '__')}_{item.get('resourceId') or item.get('resourceName')}"
+
+
+def parse_key(key: str):
+    """AWS__EC2__Instance_i-123 → ("AWS::EC2::Instance", "i-123")"""
+    parts = key.split("__")
+    service_type, _, name = parts[-1].partition("_")
+    return "::".join(parts[:-1] + [service_type]), name
+
+
+def item_hash(item: dict):
+    stable = {k: v for k, v in item.items() if k not in VOLATILE_FIELDS}
+    return hashlib.sha256(json.dumps(stable, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:32]
+
+
+def is_deleted(item: dict):
+    return item.get("configurationItemStatus") in DELETED_STATUSES
+
+
+# === INDEX (key, hash) ĐÃ SORT ===
+def sorted_index(items, run_size: int = None, tmpdir: str = None):
+    """
+    External sort: mỗi run_size cặp (key, hash) sort rồi ghi ra file tạm,
+    heapq.merge các run → iterator (key, hash) tăng dần, bộ nhớ ~ run_size.
+    """
+    run_size = run_size or SNAPSHOT_RUN_SIZE
+    runs, buffer = [], []
+    for item in items:
+        if is_deleted(item):
+            continue
+        buffer.append((item_key(item), item_hash(item)))
+        if len(buffer) >= run_size:
+            runs.append(_spill(buffer, tmpdir))
+            buffer = []
+    buffer.sort()
+    if not runs:
+        yield from _dedupe(iter(buffer))
+        return
+    files = [open(path, "r", encoding="utf-8") for path in runs]
+    try:
+        yield from _dedupe(heapq.merge(iter(buffer), *(read_index_lines(f) for f in files)))
+    finally:
+        for f, path in zip(files, runs):
+            f.close()
+            os.remove(path)
+
+
+def _spill(buffer: list, tmpdir: str = None):
+    buffer.sort()
+    fd, path = tempfile.mkstemp(prefix="snapshot-run-", suffix=".tsv", dir=tmpdir)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.writelines(f"{k}\t{h}\n" for k, h in buffer)
+    return path
+
+
+def _dedupe(pairs):
+    previous = None
+    for key, digest in pairs:
+        if key != previous:
+            yield key, digest
+        previous = key
+
+
+def read_index_lines(lines):
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.rstrip("\n")
+        if line:
+            key, _, digest = line.partition("\t")
+            yield key, digest
+
+
+# === SORTED MERGE ===
+def diff_sorted(previous, current):
+    """Merge 2 iterator (key, hash) đã sort → (status, key) với status added/changed/deleted."""
+    prev, curr = next(previous, None), next(current, None)
+    while prev is not None or curr is not None:
+        if curr is None or (prev is not None and prev[0] < curr[0]):
+            yield "deleted", prev[0]
+            prev = next(previous, None)
+        elif prev is None or curr[0] < prev[0]:
+            yield "added", curr[0]
+            curr = next(current, None)
+        else:
+            if prev[1] != curr[1]:
+                yield "changed", curr[0]
+            prev, curr = next(previous, None), next(current, None)
+
+
+class SnapshotDelta:
+    """
+    Delta giữa snapshot mới và index của snapshot trước:
+    - pass 1: stream snapshot → index sort (ghi ra index_out) + merge với index cũ → status theo key
+    - pass 2: stream lại snapshot, chỉ trả các item added/changed; deleted là stub
+    Bộ nhớ ~ SNAPSHOT_RUN_SIZE + số resource thay đổi.
+    """
+
+    def __init__(self, open_snapshot, previous_index=(), index_out=None, run_size: int = None):
+        self.open_snapshot = open_snapshot      # () -> iterator chunk (gọi 2 lần)
+        self.previous_index = previous_index    # iterator dòng "key\thash"
+        self.index_out = index_out              # file text để ghi index mới (hoặc None)
+        self.run_size = run_size
+        self.changes = {}
+        self.counts = {"added": 0, "changed": 0, "deleted": 0, "unchanged": 0, "total": 0}
+
+    def _current_index(self):
+        for key, digest in sorted_index(iter_configuration_items(self.open_snapshot()), self.run_size):
+            self.counts["total"] += 1
+            if self.index_out is not None:
+                self.index_out.write(f"{key}\t{digest}\n")
+            yield key, digest
+
+    def compute(self):
+        for status, key in diff_sorted(read_index_lines(self.previous_index), self._current_index()):
+            self.changes[key] = status
+            self.counts[status] += 1
+        self.counts["unchanged"] = self.counts["total"] - self.counts["added"] - self.counts["changed"]
+        logger.info(f"Config snapshot delta: {json.dumps(self.counts)}")
+        return self.counts
+
+    def items(self):
+        """(status, item) của resource added/changed, rồi stub {resourceType, resourceId, status} cho deleted."""
+        if not self.changes:
+            return
+        emitted = set()
+        for item in iter_configuration_items(self.open_snapshot()):
+            key = item_key(item)
+            status = self.changes.get(key)
+            if status in ("added", "changed") and key not in emitted and not is_deleted(item):
+                emitted.add(key)
+                yield status, item
+        for key, status in self.changes.items():
+            if status == "deleted":
+                resource_type, resource_id = parse_key(key)
+                yield "deleted", {
+                    "resourceType": resource_type,
+                    "resourceId": resource_id,
+                    "configurationItemStatus": "ResourceDeleted",
+                }
+
+
+# === S3 ===
+def snapshot_scope(key: str):
+    """AWSLogs/{account}/Config/{region}/.../ConfigSnapshot/... → "{account}/{region}" """
+    parts = key.split("/")
+    if "AWSLogs" in parts and "Config" in parts:
+        i = parts.index("AWSLogs")
+        j = parts.index("Config")
+        if j + 1 < len(parts):
+            return f"{parts[i + 1]}/{parts[j + 1]}"
+    return "default"
+
+
+def process_snapshot(s3, bucket: str, key: str, consume=None):
+    """
+    Tính delta của 1 snapshot vừa được deliver, ghi delta (JSON lines) và index mới
+    lên S3; consume(status, item) (nếu có) nhận từng item thay đổi. Trả counts.
+    """
+    scope = snapshot_scope(key)
+    index_key = f"{SNAPSHOT_INDEX_PREFIX}/{scope}/latest.tsv"
+    try:
+        previous = s3.get_object(Bucket=bucket, Key=index_key)["Body"].iter_lines()
+    except s3.exceptions.NoSuchKey:
+        logger.info(f"No previous snapshot index for {scope}, every resource counts as added")
+        previous = iter(())
+
+    with tempfile.NamedTemporaryFile("w+", encoding="utf-8", suffix=".tsv") as index_file, \
+            tempfile.NamedTemporaryFile("w+", encoding="utf-8", suffix=".jsonl") as delta_file:
+        delta = SnapshotDelta(lambda: iter_s3_chunks(s3, bucket, key), previous, index_file)
+        counts = delta.compute()
+        for status, item in delta.items():
+            delta_file.write(json.dumps({"status": status, "item": item}, default=str) + "\n")
+            if consume is not None:
+                consume(status, item)
+        index_file.flush()
+        delta_file.flush()
+        snapshot_name = key.rsplit("/", 1)[-1].split(".")[0]
+        delta_key = f"{SNAPSHOT_DELTA_PREFIX}/{scope}/{snapshot_name}.jsonl"
+        s3.upload_file(delta_file.name, bucket, delta_key)
+        # index mới chỉ thay index cũ sau khi delta đã ghi xong
+        s3.upload_file(index_file.name, bucket, index_key)
+    counts["delta_key"] = delta_key
+    return counts
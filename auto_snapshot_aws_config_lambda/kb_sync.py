@@ -0,0 +1,228 @@
+# ========================================
+# kb_sync.py — ĐỒNG BỘ TĂNG DẦN DOCUMENT KB (aws_state/, iac_config/) LÊN S3 DATA SOURCE
+# ========================================
+import os
+import json
+import hashlib
+import logging
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from config_snapshot import item_key, is_deleted
+
+logger = logging.getLogger()
+
+# rỗng = không đồng bộ KB
+KB_BUCKET = os.environ.get("KB_BUCKET", "")
+KNOWLEDGE_BASE_ID = os.environ.get("KNOWLEDGE_BASE_ID", "")
+KB_DATA_SOURCE_ID = os.environ.get("KB_DATA_SOURCE_ID", "")
+# tối đa 1 ingestion job / cửa sổ; các lần sync trong cửa sổ được gom lại
+KB_INGESTION_WINDOW_SECONDS = int(os.environ.get("KB_INGESTION_WINDOW_SECONDS", "600"))
+KB_SYNC_CONCURRENCY = int(os.environ.get("KB_SYNC_CONCURRENCY", "8"))
+KB_SYNC_BATCH = int(os.environ.get("KB_SYNC_BATCH", "500"))
+REGION = os.environ.get("AWS_REGION", "us-east-1")
+
+HASH_METADATA = "content-sha256"
+UNKNOWN = object()   # chưa biết ETag hiện tại → head_object
+
+
+# === DOCUMENT ===
+def document_key(prefix: str, name: str):
+    """1 document / resource; tên được encode để '/' hay ':' không tạo thư mục con."""
+    return f"{prefix.rstrip('/')}/{quote(name, safe='')}.json"
+
+
+def state_key(region: str, identifier: str):
+    return document_key(f"aws_state/{region}", identifier)
+
+
+def iac_key(repo_prefix: str, resource_address: str):
+    return document_key(f"iac_config/{repo_prefix}", resource_address)
+
+
+def state_document(item: dict):
+    """configurationItem → document aws_state (không giữ capture time để hash ổn định)."""
+    return {
+        "id": item_key(item),
+        "metadata": {
+            "resourceType": item.get("resourceType"),
+            "resourceId": item.get("resourceId"),
+            "resourceName": item.get("resourceName"),
+            "arn": item.get("ARN") or item.get("arn"),
+            "status": item.get("configurationItemStatus"),
+            "awsRegion": item.get("awsRegion"),
+            "accountId": item.get("accountId") or item.get("awsAccountId"),
+        },
+        "configuration": item.get("configuration") or {},
+        "supplementaryConfiguration": item.get("supplementaryConfiguration") or {},
+        "tags": item.get("tags") or {},
+    }
+
+
+def iac_document(doc: dict, repo_url: str):
+    return {
+        "type": "iac_configuration",
+        **doc,
+        "metadata": {**(doc.get("metadata") or {}), "repo": repo_url},
+    }
+
+
+def encode(doc: dict):
+    return json.dumps(doc, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+
+
+# === SYNC ===
+class KnowledgeBaseSync:
+    """
+    Ghi document lên bucket data source của KB:
+    - bỏ qua document không đổi: ETag == MD5 của body (không cần request nào thêm khi đã list),
+      nếu không thì so metadata content-sha256 (bucket SSE-KMS có ETag khác MD5)
+    - xoá document của resource ResourceDeleted / không còn trong repo
+    - các thao tác được gom theo lô KB_SYNC_BATCH, chạy song song KB_SYNC_CONCURRENCY
+    """
+
+    def __init__(self, s3, bucket: str, agent=None, knowledge_base_id: str = "", data_source_id: str = "",
+                 concurrency: int = KB_SYNC_CONCURRENCY, batch_size: int = KB_SYNC_BATCH):
+        self.s3 = s3
+        self.bucket = bucket
+        self.agent = agent
+        self.knowledge_base_id = knowledge_base_id
+        self.data_source_id = data_source_id
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.pending = []
+        self.counts = {"written": 0, "unchanged": 0, "deleted": 0}
+
+    @property
+    def changed(self):
+        return self.counts["written"] + self.counts["deleted"]
+
+    def reset_counts(self):
+        counts, self.counts = self.counts, {"written": 0, "unchanged": 0, "deleted": 0}
+        return counts
+
+    # --- S3 ---
+    def list_etags(self, prefix: str):
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if not obj["Key"].endswith("/"):
+                    yield obj["Key"], obj.get("ETag")
+
+    def _head(self, key: str):
+        from botocore.exceptions import ClientError
+        try:
+            return self.s3.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def put_document(self, key: str, doc: dict, etag=UNKNOWN):
+        """etag: ETag từ list_objects (None = chưa có object, UNKNOWN = phải head)."""
+        body = encode(doc)
+        digest = hashlib.sha256(body).hexdigest()
+        if etag is not None:
+            head = None
+            if etag is UNKNOWN:
+                head = self._head(key)
+                etag = head and head.get("ETag")
+            if etag and etag.strip('"') == hashlib.md5(body).hexdigest():
+                return "unchanged"
+            if etag:
+                head = head or self._head(key)
+                if head and (head.get("Metadata") or {}).get(HASH_METADATA) == digest:
+                    return "unchanged"
+        self.s3.put_object(
+            Bucket=self.bucket, Key=key, Body=body,
+            ContentType="application/json", Metadata={HASH_METADATA: digest},
+        )
+        return "written"
+
+    def delete_document(self, key: str):
+        self.s3.delete_object(Bucket=self.bucket, Key=key)
+        return "deleted"
+
+    # --- LÔ THAO TÁC ---
+    def queue(self, op: str, key: str, doc: dict = None, etag=UNKNOWN):
+        self.pending.append((op, key, doc, etag))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def _run(self, entry):
+        op, key, doc, etag = entry
+        return self.delete_document(key) if op == "delete" else self.put_document(key, doc, etag)
+
+    def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return self.counts
+        if self.concurrency > 1 and len(batch) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batch))) as pool:
+                results = list(pool.map(self._run, batch))
+        else:
+            results = [self._run(entry) for entry in batch]
+        for result in results:
+            self.counts[result] += 1
+        return self.counts
+
+    # --- aws_state/ ---
+    def state_change(self, status: str, item: dict, region: str = None):
+        """Callback consume của process_snapshot: (status, configurationItem)."""
+        key = state_key(item.get("awsRegion") or region or REGION, item_key(item))
+        if status == "deleted" or is_deleted(item):
+            self.queue("delete", key)
+        else:
+            self.queue("put", key, state_document(item))
+
+    # --- iac_config/ ---
+    def sync_iac_documents(self, repo_url: str, documents: list):
+        """
+        Inventory IaC hiện tại của repo (document có resource_address) → iac_config/{repo_prefix}/:
+        ghi document mới/đổi, xoá document của resource không còn trong repo.
+        """
+        repo_prefix = repo_url.rstrip("/").split("/")[-1]
+        self.reset_counts()
+        existing = dict(self.list_etags(f"iac_config/{repo_prefix}/"))
+        keep = set()
+        for doc in documents:
+            if not doc.get("resource_address"):
+                continue
+            key = iac_key(repo_prefix, doc["resource_address"])
+            keep.add(key)
+            self.queue("put", key, iac_document(doc, repo_url), existing.get(key))
+        for key in existing:
+            if key not in keep:
+                self.queue("delete", key)
+        counts = self.flush()
+        logger.info(f"KB iac_config/{repo_prefix}: {len(keep)} documents, {json.dumps(counts)}")
+        return counts
+
+    # --- INGESTION ---
+    @property
+    def can_ingest(self):
+        return bool(self.agent and self.knowledge_base_id and self.data_source_id)
+
+    def start_ingestion(self, description: str = ""):
+        """Trả ingestionJobId; None nếu data source đang có job chạy (ConflictException)."""
+        from botocore.exceptions import ClientError
+        try:
+            job = self.agent.start_ingestion_job(
+                knowledgeBaseId=self.knowledge_base_id,
+                dataSourceId=self.data_source_id,
+                description=description[:200],
+            )["ingestionJob"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConflictException":
+                logger.info(f"Ingestion job already running for data source {self.data_source_id}")
+                return None
+            raise
+        logger.info(f"Started KB ingestion job {job['ingestionJobId']} ({description})")
+        return job["ingestionJobId"]
+
+
+def build_kb_sync():
+    if not KB_BUCKET:
+        return None
+    import boto3
+    agent = boto3.client("bedrock-agent") if KNOWLEDGE_BASE_ID and KB_DATA_SOURCE_ID else None
+    return KnowledgeBaseSync(boto3.client("s3"), KB_BUCKET, agent, KNOWLEDGE_BASE_ID, KB_DATA_SOURCE_ID)
@@ -1,43 +1,383 @@
+import os
 import json
 import boto3
 import logging
+import time
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from ownership_index import ownership_index, resource_identifier
+from snapshot_gate import snapshot_gate, build_gate, SNAPSHOT_WINDOW_SECONDS
+from config_snapshot import process_snapshot, snapshot_scope
+from kb_sync import build_kb_sync, KB_INGESTION_WINDOW_SECONDS
+from urllib.parse import unquote_plus
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+dynamodb = boto3.resource("dynamodb")
+table = dynamodb.Table("repoSubscriptions")
+tagging = boto3.client("resourcegroupstaggingapi")
+# tag trên resource chỉ ra repo IaC quản lý nó (giá trị: URL github hoặc "org/repo")
+OWNER_TAG_KEYS = [k.strip() for k in os.environ.get("OWNER_TAG_KEYS", "Repository,repo,iac_repo,git_repo").split(",") if k.strip()]
+
+# scan có mục tiêu: tối đa 1 execution / repo / cửa sổ, các change trong cửa sổ được gom lại
+sf = boto3.client("stepfunctions")
+STEP_FUNCTION_ARN = os.environ.get("STEP_FUNCTION_ARN", "arn:aws:states:us-east-1:933000400558:stateMachine:DriftReportAgentASL")
+DETECTION_MODE = os.environ.get("DETECTION_MODE", "fan_out")
+TARGETED_SCAN_WINDOW = int(os.environ.get("TARGETED_SCAN_WINDOW", "300"))
+# delta lớn hơn (vd snapshot đầu tiên) → để scan định kỳ / ưu tiên lo, không tra ownership từng resource
+TARGETED_SCAN_MAX_RESOURCES = int(os.environ.get("TARGETED_SCAN_MAX_RESOURCES", "500"))
+
+# snapshot: 1 lần / SNAPSHOT_WINDOW_SECONDS / channel; event trong cửa sổ được gom lại
+DELIVERY_CHANNEL = os.environ.get("DELIVERY_CHANNEL", "default")
+# SQS (DelaySeconds) gọi lại lambda này cuối cửa sổ để snapshot phần event đã gom; rỗng = đợi event kế tiếp
+SNAPSHOT_FLUSH_QUEUE_URL = os.environ.get("SNAPSHOT_FLUSH_QUEUE_URL", "")
+sqs = boto3.client("sqs")
+# S3 ObjectCreated của snapshot đã deliver → tính delta theo resource
+s3 = boto3.client("s3")
+
+# delta snapshot → document aws_state/ của KB; ingestion job gom theo cửa sổ
+kb_sync = build_kb_sync()
+ingestion_gate = build_gate(KB_INGESTION_WINDOW_SECONDS)
+INGESTION_CHANNEL = f"kb-ingestion:{kb_sync.data_source_id}" if kb_sync else "kb-ingestion"
+
+
+def now_utc():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+def normalize_repo_url(value: str):
+    value = value.strip().rstrip("/")
+    if value.endswith(".git"):
+        value = value[:-4]
+    if not value.startswith("http"):
+        value = "https://github.com/" + value.split("github.com/")[-1].lstrip("/")
+    return value
+
+def resource_tags(detail: dict):
+    """Tag của resource: lấy trong configurationItem, không có thì hỏi Tagging API theo ARN."""
+    item = detail.get("configurationItem") or {}
+    tags = item.get("tags") or detail.get("tags")
+    if tags:
+        return tags
+    arn = item.get("ARN") or detail.get("resourceARN")
+    if not arn:
+        return {}
+    try:
+        mappings = tagging.get_resources(ResourceARNList=[arn]).get("ResourceTagMappingList", [])
+    except ClientError as e:
+        logger.warning(f"Tag lookup failed for {arn}: {e}")
+        return {}
+    return {t["Key"]: t["Value"] for m in mappings for t in m.get("Tags", [])}
+
+def owning_repos(tags: dict):
+    lowered = {k.lower(): v for k, v in (tags or {}).items()}
+    return sorted({normalize_repo_url(lowered[k.lower()]) for k in OWNER_TAG_KEYS if lowered.get(k.lower())})
+
+def changed_identifiers(detail: dict, resource_type: str, resource_id: str):
+    """Identifier theo resourceId và resourceName (index lưu cả hai dạng)."""
+    item = detail.get("configurationItem") or {}
+    names = [resource_id, item.get("resourceName") or detail.get("resourceName")]
+    return [resource_identifier(resource_type, n) for n in dict.fromkeys(names) if n and n != "Unknown"]
+
+def delta_identifiers(item: dict):
+    """Identifier (theo resourceId và resourceName) của 1 item trong delta snapshot."""
+    names = [item.get("resourceId"), item.get("resourceName")]
+    return [resource_identifier(item.get("resourceType", ""), n) for n in dict.fromkeys(names) if n]
+
+def request_targeted_scan(repo_url: str, addresses: list, flush: bool = False):
+    """
+    Lần đầu trong cửa sổ start execution với mọi target đang chờ; các lần sau
+    trong cửa sổ cộng dồn vào pendingTargets và hẹn 1 message flush cuối cửa sổ
+    (flush=True: chỉ start nếu còn target đang chờ).
+    """
+    now = int(time.time())
+    condition = "attribute_exists(repoUrl) AND (attribute_not_exists(targetedScanAt) OR targetedScanAt < :cutoff)"
+    if flush:
+        condition += " AND attribute_exists(pendingTargets)"
+    try:
+        previous = table.update_item(
+            Key={"repoUrl": repo_url},
+            UpdateExpression="SET targetedScanAt = :now REMOVE pendingTargets",
+            ConditionExpression=condition,
+            ExpressionAttributeValues={":now": now, ":cutoff": now - TARGETED_SCAN_WINDOW},
+            ReturnValues="UPDATED_OLD",
+        ).get("Attributes", {})
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        if flush:
+            # flush đến sớm (delay SQS tối đa 15 phút) → hẹn lại nếu vẫn còn target chờ
+            item = table.get_item(Key={"repoUrl": repo_url}).get("Item") or {}
+            if item.get("pendingTargets") and item.get("targetedScanAt"):
+                schedule_flush(repo_url, int(item["targetedScanAt"]), TARGETED_SCAN_WINDOW, "flushTargets")
+            return []
+        try:
+            old = table.update_item(
+                Key={"repoUrl": repo_url},
+                UpdateExpression="ADD pendingTargets :a",
+                ConditionExpression="attribute_exists(repoUrl)",
+                ExpressionAttributeValues={":a": set(addresses)},
+                ReturnValues="ALL_OLD",
+            ).get("Attributes", {})
+            if not old.get("pendingTargets"):
+                # target đầu tiên chờ trong cửa sổ → flush cuối cửa sổ, không đợi change kế tiếp
+                schedule_flush(repo_url, int(old.get("targetedScanAt") or now), TARGETED_SCAN_WINDOW, "flushTargets")
+            logger.info(f"Targeted scan for {repo_url} already started in this window, {len(addresses)} targets queued")
+        except ClientError as e2:
+            if e2.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+        return []
+    targets = sorted(set(addresses) | set(previous.get("pendingTargets") or ()))
+    if not targets:
+        return []
+    payload = {
+        "query": f"Hãy so sánh drift toàn bộ resource trong repo {repo_url}",
+        "type": "full_scan",
+        "detection_mode": DETECTION_MODE,
+        "target_resources": targets,
+    }
+    sf.start_execution(stateMachineArn=STEP_FUNCTION_ARN, input=json.dumps(payload))
+    logger.info(f"🎯 Targeted scan started for {repo_url}: {targets}")
+    return targets
+
+def targeted_scans_for_delta(identifiers: list, counts: dict):
+    """Repo sở hữu resource trong delta (ownership index) → scan riêng các resource_address đó."""
+    if ownership_index is None or not identifiers:
+        return {}
+    if counts.get("added") == counts.get("total") and not counts.get("changed") and not counts.get("deleted"):
+        logger.info("First snapshot for this scope, no targeted scans")
+        return {}
+    if len(identifiers) > TARGETED_SCAN_MAX_RESOURCES:
+        logger.info(f"Delta of {len(identifiers)} identifiers exceeds TARGETED_SCAN_MAX_RESOURCES, no targeted scans")
+        return {}
+    owners = ownership_index.owners(identifiers)
+    targeted = {repo: request_targeted_scan(repo, addresses) for repo, addresses in owners.items() if addresses}
+    return {repo: targets for repo, targets in targeted.items() if targets}
+
+def bump_scan_priority(repo_url: str, resource_key: str):
+    """
+    +1 pendingChanges cho repo đã subscribe; orchestrator ưu tiên repo có nhiều thay đổi chưa quét.
+    changedScan đưa repo vào GSI thưa của orchestrator (claim repo thì xoá).
+    """
+    try:
+        table.update_item(
+            Key={"repoUrl": repo_url},
+            UpdateExpression="ADD pendingChanges :one "
+                             "SET lastChangeAt = :t, lastChangedResource = :r, changedScan = :c",
+            ConditionExpression="attribute_exists(repoUrl)",
+            ExpressionAttributeValues={":one": 1, ":t": now_utc(), ":r": resource_key, ":c": "CHANGED"},
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            logger.info(f"{repo_url} is not a subscribed repo, priority unchanged")
+            return False
+        raise
+
+def deliver_snapshot(config_client, channel: str):
+    """Snapshot nếu cửa sổ của channel đã hết, không thì gom event vào cửa sổ hiện tại."""
+    if snapshot_gate is None:
+        return deliver_window(config_client, channel, 1, gated=False)
+    try:
+        pending = snapshot_gate.open_window(channel)
+        if pending is None:
+            absorbed, window_start = snapshot_gate.absorb(channel)
+    except Exception as e:
+        # gate lỗi (bảng thiếu, throttle...) không được làm mất snapshot
+        logger.warning(f"Snapshot gate unavailable, delivering {channel} ungated: {str(e)}")
+        return deliver_window(config_client, channel, 1, gated=False)
+    if pending is None:
+        if absorbed == 1:
+            schedule_flush(channel, window_start)
+        logger.info(f"Snapshot for {channel} debounced: {absorbed} events waiting for the next window")
+        return {"status": "absorbed", "snapshotId": None, "events": absorbed}
+    # snapshot này phủ cả event vừa đến lẫn các event đã gom của cửa sổ trước
+    return deliver_window(config_client, channel, pending + 1)
+
+def deliver_window(config_client, channel: str, events: int, gated: bool = True):
+    try:
+        response = config_client.deliver_config_snapshot(deliveryChannelName=channel)
+    except Exception:
+        if gated:
+            try:
+                snapshot_gate.release(channel, events)
+            except Exception as e:
+                logger.warning(f"Could not release snapshot window of {channel}: {str(e)}")
+        raise
+    snapshot_id = response['configSnapshotId']
+    if gated:
+        try:
+            snapshot_gate.record(channel, snapshot_id, events)
+        except Exception as e:
+            logger.warning(f"Could not record snapshot {snapshot_id} in the gate: {str(e)}")
+    logger.info(f"Successfully triggered snapshot: {snapshot_id} ({channel}, {events} change events)")
+    return {"status": "delivered", "snapshotId": snapshot_id, "events": events}
+
+def schedule_flush(channel: str, window_start: int, window: int = SNAPSHOT_WINDOW_SECONDS,
+                   message_key: str = "flushChannel"):
+    if not SNAPSHOT_FLUSH_QUEUE_URL:
+        return
+    delay = window_start + window - int(time.time()) + 1
+    sqs.send_message(
+        QueueUrl=SNAPSHOT_FLUSH_QUEUE_URL,
+        MessageBody=json.dumps({message_key: channel}),
+        DelaySeconds=max(0, min(900, delay)),   # SQS cho tối đa 15 phút
+    )
+
+def flush_snapshots(config_client, records: list):
+    """Message flush cuối cửa sổ: snapshot nếu cửa sổ đã hết mà vẫn còn event chưa được phủ."""
+    delivered, ingestions, targeted = [], [], {}
+    for record in records:
+        body = json.loads(record.get("body") or "{}")
+        if body.get("flushTargets"):
+            targets = request_targeted_scan(body["flushTargets"], [], flush=True)
+            if targets:
+                targeted[body["flushTargets"]] = targets
+            continue
+        if body.get("flushIngestion") and ingestion_gate is not None:
+            pending = ingestion_gate.open_window(body["flushIngestion"], require_pending=True)
+            if pending:
+                ingestions.append(ingest_window(pending))
+            continue
+        channel = body.get("flushChannel")
+        if not channel or snapshot_gate is None:
+            continue
+        pending = snapshot_gate.open_window(channel, require_pending=True)
+        if pending:
+            delivered.append(deliver_window(config_client, channel, pending))
+    return {'statusCode': 200, 'body': json.dumps({'flushed': delivered, 'ingestions': ingestions,
+                                                   'targetedScans': targeted})}
+
+def request_ingestion(reason: str):
+    """Document KB vừa đổi → ingestion job, tối đa 1 / KB_INGESTION_WINDOW_SECONDS; sync trong cửa sổ được gom lại."""
+    if kb_sync is None or not kb_sync.can_ingest:
+        return None
+    if ingestion_gate is None:
+        return ingest_window(1, reason)
+    try:
+        pending = ingestion_gate.open_window(INGESTION_CHANNEL)
+        if pending is None:
+            absorbed, window_start = ingestion_gate.absorb(INGESTION_CHANNEL)
+    except Exception as e:
+        logger.warning(f"Ingestion gate unavailable, starting ingestion ungated: {str(e)}")
+        return ingest_window(1, reason, gated=False)
+    if pending is None:
+        if absorbed == 1:
+            schedule_flush(INGESTION_CHANNEL, window_start, KB_INGESTION_WINDOW_SECONDS, "flushIngestion")
+        logger.info(f"KB ingestion debounced: {absorbed} syncs waiting for the next window")
+        return {"status": "absorbed", "ingestionJobId": None, "syncs": absorbed}
+    return ingest_window(pending + 1, reason)
+
+def ingest_window(syncs: int, reason: str = "batched KB document sync", gated: bool = True):
+    job_id = kb_sync.start_ingestion(f"{reason} ({syncs} syncs)")
+    if job_id is None and gated and ingestion_gate is not None:
+        # job trước chưa xong → giữ lại các sync, thử lại cuối cửa sổ sau
+        ingestion_gate.release(INGESTION_CHANNEL, syncs)
+        schedule_flush(INGESTION_CHANNEL, int(time.time()), KB_INGESTION_WINDOW_SECONDS, "flushIngestion")
+        return {"status": "deferred", "ingestionJobId": None, "syncs": syncs}
+    return {"status": "started", "ingestionJobId": job_id, "syncs": syncs}
+
+def process_snapshot_records(records: list):
+    """
+    S3 ObjectCreated của file ConfigSnapshot → delta so với snapshot trước →
+    document aws_state/ của KB → scan có mục tiêu cho repo sở hữu resource đổi
+    (sau khi document đã ghi, detector đọc được state mới).
+    """
+    results = []
+    for record in records:
+        bucket = record["s3"]["bucket"]["name"]
+        key = unquote_plus(record["s3"]["object"]["key"])
+        if "ConfigSnapshot" not in key:
+            continue
+        logger.info(f"Processing Config snapshot s3://{bucket}/{key}")
+        region = snapshot_scope(key).split("/")[-1]
+        identifiers = []
+
+        def consume(status, item):
+            identifiers.extend(delta_identifiers(item))
+            if kb_sync is not None:
+                # chỉ resource thay đổi được ghi lại thành document aws_state/{region}/
+                kb_sync.state_change(status, item, region)
+
+        if kb_sync is not None:
+            kb_sync.reset_counts()
+        counts = process_snapshot(s3, bucket, key, consume)
+        result = {"key": key, **counts}
+        if kb_sync is not None:
+            kb_sync.flush()
+            documents = kb_sync.reset_counts()
+            logger.info(f"KB aws_state/{region}: {json.dumps(documents)}")
+            result["documents"] = documents
+            if documents["written"] or documents["deleted"]:
+                result["ingestion"] = request_ingestion(f"aws_state/{region} delta")
+        result["targetedScans"] = targeted_scans_for_delta(list(dict.fromkeys(identifiers)), counts)
+        results.append(result)
+    return {'statusCode': 200, 'body': json.dumps({'snapshots': results})}
+
+def sync_iac_documents(repo_url: str, documents: list):
+    """Inventory IaC của repo (event iacDocuments) → iac_config/{repo_prefix}/."""
+    if kb_sync is None:
+        return {'statusCode': 400, 'body': json.dumps({'error': 'KB_BUCKET is not configured'})}
+    counts = kb_sync.sync_iac_documents(repo_url, documents)
+    ingestion = None
+    if counts["written"] or counts["deleted"]:
+        ingestion = request_ingestion(f"iac_config {repo_url}")
+    return {'statusCode': 200, 'body': json.dumps({'repoUrl': repo_url, 'documents': counts, 'ingestion': ingestion})}
+
 def lambda_handler(event, context):
     """
     Tự động trigger Config snapshot khi có configuration changes
     """
     config_client = boto3.client('config')
+    if event.get("Records"):
+        s3_records = [r for r in event["Records"] if r.get("eventSource") == "aws:s3"]
+        if s3_records:
+            return process_snapshot_records(s3_records)
+        return flush_snapshots(config_client, event["Records"])
+    if event.get("iacDocuments") is not None:
+        return sync_iac_documents(normalize_repo_url(event.get("repoUrl") or ""), event["iacDocuments"])
     
     try:
         # Parse EventBridge event
         detail = event.get('detail', {})
-        resource_type = detail.get('resourceType', 'Unknown')
-        resource_id = detail.get('resourceId', 'Unknown')
-        config_item_status = detail.get('configurationItemStatus', 'Unknown')
+        item = detail.get('configurationItem') or {}
+        resource_type = detail.get('resourceType') or item.get('resourceType', 'Unknown')
+        resource_id = detail.get('resourceId') or item.get('resourceId', 'Unknown')
+        config_item_status = detail.get('configurationItemStatus') or item.get('configurationItemStatus', 'Unknown')
         
         logger.info(f"Configuration change detected:")
         logger.info(f"Resource Type: {resource_type}")
         logger.info(f"Resource ID: {resource_id}")
         logger.info(f"Status: {config_item_status}")
+
+        # Repo sở hữu resource: tra ownership index (có cả resource_address), thêm repo theo tag
+        owners = {}
+        if ownership_index is not None:
+            try:
+                owners = ownership_index.owners(changed_identifiers(detail, resource_type, resource_id))
+            except Exception as e:
+                logger.warning(f"Ownership index lookup failed: {str(e)}")
+        for repo in owning_repos(resource_tags(detail)):
+            owners.setdefault(repo, [])
+
+        # Đẩy ưu tiên quét của repo sở hữu resource vừa đổi; scan có mục tiêu chạy
+        # khi snapshot đã deliver và document aws_state đã cập nhật (process_snapshot_records)
+        prioritized = [repo for repo in owners if bump_scan_priority(repo, f"{resource_type}/{resource_id}")]
+        logger.info(f"Scan priority raised for: {prioritized or 'no owning repo'}")
         
-        # Trigger configuration snapshot
-        response = config_client.deliver_config_snapshot(
-            deliveryChannelName='default'
-        )
-        
-        snapshot_id = response['configSnapshotId']
-        logger.info(f"Successfully triggered snapshot: {snapshot_id}")
+        # Trigger configuration snapshot (gom theo cửa sổ)
+        snapshot = deliver_snapshot(config_client, DELIVERY_CHANNEL)
         
         return {
             'statusCode': 200,
             'body': json.dumps({
-                'message': 'Snapshot triggered successfully',
-                'snapshotId': snapshot_id,
+                'message': 'Snapshot triggered successfully' if snapshot["status"] == "delivered"
+                           else 'Change absorbed into the current snapshot window',
+                'snapshotId': snapshot["snapshotId"],
+                'absorbedEvents': snapshot["events"],
                 'resourceType': resource_type,
-                'resourceId': resource_id
+                'resourceId': resource_id,
+                'prioritizedRepos': prioritized
             })
         }
         
@@ -0,0 +1,122 @@
+# ========================================
+# ownership_index.py — INDEX AWS IDENTIFIER → REPO + resource_address SỞ HỮU
+# ========================================
+import os
+import logging
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger()
+
+# dynamodb | memory | none
+OWNERSHIP_BACKEND = os.environ.get("OWNERSHIP_BACKEND", "dynamodb")
+OWNERSHIP_TABLE = os.environ.get("OWNERSHIP_TABLE", "resourceOwnership")
+# GSI trên repoUrl để lấy lại toàn bộ entry của 1 repo khi inventory đổi
+OWNERSHIP_REPO_INDEX = os.environ.get("OWNERSHIP_REPO_INDEX", "repoUrl-index")
+
+
+def now_utc():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def resource_identifier(resource_type: str, name: str):
+    """AWS::EC2::SecurityGroup + sg-0abc → AWS__EC2__SecurityGroup_sg-0abc (cùng format resource_resolver)"""
+    return f"{resource_type.replace('::', '__')}_{name}"
+
+
+class DynamoDBOwnershipTable:
+    """pk = awsIdentifier, sk = repoUrl"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def _query(self, **kwargs):
+        while True:
+            response = self.table.query(**kwargs)
+            yield from response.get("Items", [])
+            if "LastEvaluatedKey" not in response:
+                return
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def query(self, identifier: str):
+        from boto3.dynamodb.conditions import Key
+        return list(self._query(KeyConditionExpression=Key("awsIdentifier").eq(identifier)))
+
+    def query_repo(self, repo_url: str):
+        from boto3.dynamodb.conditions import Key
+        return list(self._query(IndexName=OWNERSHIP_REPO_INDEX, KeyConditionExpression=Key("repoUrl").eq(repo_url)))
+
+    def write(self, items: list, deletes: list):
+        with self.table.batch_writer(overwrite_by_pkeys=["awsIdentifier", "repoUrl"]) as batch:
+            for item in items:
+                batch.put_item(Item=item)
+            for key in deletes:
+                batch.delete_item(Key=key)
+
+
+class MemoryOwnershipTable:
+    """Stand-in local/test cho DynamoDB."""
+
+    def __init__(self):
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def query(self, identifier: str):
+        with self._lock:
+            return [dict(item) for (i, _), item in self.items.items() if i == identifier]
+
+    def query_repo(self, repo_url: str):
+        with self._lock:
+            return [dict(item) for (_, r), item in self.items.items() if r == repo_url]
+
+    def write(self, items: list, deletes: list):
+        with self._lock:
+            for item in items:
+                self.items[(item["awsIdentifier"], item["repoUrl"])] = dict(item)
+            for key in deletes:
+                self.items.pop((key["awsIdentifier"], key["repoUrl"]), None)
+
+
+class OwnershipIndex:
+    def __init__(self, table):
+        self.table = table
+
+    def update_repo(self, repo_url: str, owned: dict):
+        """
+        owned: awsIdentifier -> resource_address (inventory hiện tại của repo).
+        Chỉ ghi entry mới/đổi address, xoá entry không còn trong repo.
+        """
+        existing = {item["awsIdentifier"]: item.get("resourceAddress") for item in self.table.query_repo(repo_url)}
+        ts = now_utc()
+        items = [
+            {"awsIdentifier": identifier, "repoUrl": repo_url, "resourceAddress": address, "updatedAt": ts}
+            for identifier, address in owned.items()
+            if existing.get(identifier) != address
+        ]
+        deletes = [{"awsIdentifier": i, "repoUrl": repo_url} for i in existing if i not in owned]
+        if items or deletes:
+            self.table.write(items, deletes)
+        logger.info(f"Ownership index {repo_url}: {len(owned)} owned, {len(items)} written, {len(deletes)} removed")
+        return {"owned": len(owned), "written": len(items), "removed": len(deletes)}
+
+    def owners(self, identifiers):
+        """repoUrl -> [resource_address] của các identifier (bỏ trùng, giữ thứ tự)."""
+        by_repo = {}
+        for identifier in dict.fromkeys(i for i in identifiers if i):
+            for item in self.table.query(identifier):
+                addresses = by_repo.setdefault(item["repoUrl"], [])
+                if item.get("resourceAddress") and item["resourceAddress"] not in addresses:
+                    addresses.append(item["resourceAddress"])
+        return by_repo
+
+
+def build_index():
+    if OWNERSHIP_BACKEND == "none":
+        return None
+    if OWNERSHIP_BACKEND == "memory":
+        return OwnershipIndex(MemoryOwnershipTable())
+    import boto3
+    return OwnershipIndex(DynamoDBOwnershipTable(boto3.resource("dynamodb").Table(OWNERSHIP_TABLE)))
+
+
+ownership_index = build_index()
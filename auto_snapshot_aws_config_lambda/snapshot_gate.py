@@ -0,0 +1,137 @@
+# ========================================
+# snapshot_gate.py — GOM CONFIG CHANGE EVENT: TỐI ĐA 1 SNAPSHOT / CỬA SỔ / DELIVERY CHANNEL
+# ========================================
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger()
+
+SNAPSHOT_GATE_TABLE = os.environ.get("SNAPSHOT_GATE_TABLE", "")
+# dynamodb | memory | none; chưa cấu hình bảng → memory (chỉ gom event trong 1 container,
+# message flush đến container khác vẫn snapshot — xem MemorySnapshotGate.open_window)
+SNAPSHOT_GATE_BACKEND = os.environ.get("SNAPSHOT_GATE_BACKEND", "dynamodb" if SNAPSHOT_GATE_TABLE else "memory")
+SNAPSHOT_WINDOW_SECONDS = int(os.environ.get("SNAPSHOT_WINDOW_SECONDS", "300"))
+
+
+class DynamoDBSnapshotGate:
+    """
+    1 item / channel: windowStart (epoch giây của snapshot gần nhất), absorbed
+    (số event đến sau snapshot đó, chưa được snapshot nào phủ).
+    """
+
+    def __init__(self, table, window: int = SNAPSHOT_WINDOW_SECONDS):
+        self.table = table
+        self.window = window
+
+    def _conditional(self, **kwargs):
+        from botocore.exceptions import ClientError
+        try:
+            return self.table.update_item(**kwargs).get("Attributes") or {}
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return None
+            raise
+
+    def open_window(self, channel: str, now: int = None, require_pending: bool = False):
+        """Cửa sổ đã hết → mở cửa sổ mới, trả số event đang chờ của cửa sổ cũ; chưa hết → None."""
+        now = int(now or time.time())
+        condition = "attribute_not_exists(windowStart) OR windowStart <= :cutoff"
+        if require_pending:
+            condition = "windowStart <= :cutoff AND absorbed > :zero"
+        old = self._conditional(
+            Key={"channel": channel},
+            UpdateExpression="SET windowStart = :now, absorbed = :zero",
+            ConditionExpression=condition,
+            ExpressionAttributeValues={":now": now, ":cutoff": now - self.window, ":zero": 0},
+            ReturnValues="ALL_OLD",
+        )
+        return None if old is None else int(old.get("absorbed", 0))
+
+    def absorb(self, channel: str):
+        """+1 event vào cửa sổ hiện tại; trả (absorbed, windowStart)."""
+        item = self.table.update_item(
+            Key={"channel": channel},
+            UpdateExpression="ADD absorbed :one",
+            ExpressionAttributeValues={":one": 1},
+            ReturnValues="ALL_NEW",
+        )["Attributes"]
+        return int(item["absorbed"]), int(item.get("windowStart", 0))
+
+    def release(self, channel: str, pending: int):
+        """Snapshot lỗi → đóng cửa sổ, trả lại event cho lần sau."""
+        self.table.update_item(
+            Key={"channel": channel},
+            UpdateExpression="SET windowStart = :zero ADD absorbed :n",
+            ExpressionAttributeValues={":zero": 0, ":n": pending},
+        )
+
+    def record(self, channel: str, snapshot_id: str, events: int):
+        self.table.update_item(
+            Key={"channel": channel},
+            UpdateExpression="SET lastSnapshotId = :s, lastSnapshotEvents = :e ADD snapshots :one, events :e",
+            ExpressionAttributeValues={":s": snapshot_id, ":e": events, ":one": 1},
+        )
+
+
+class MemorySnapshotGate:
+    """
+    Stand-in local/test cho DynamoDB (cùng ngữ nghĩa trong 1 container).
+    State không chia sẻ giữa các container: flush đến container chưa thấy
+    channel thì event chờ nằm ở container khác → coi như còn 1 event chờ.
+    """
+
+    def __init__(self, window: int = SNAPSHOT_WINDOW_SECONDS):
+        self.window = window
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def open_window(self, channel: str, now: int = None, require_pending: bool = False):
+        now = int(now or time.time())
+        with self._lock:
+            if require_pending and channel not in self.items:
+                # flush do container khác hẹn (absorb ít nhất 1 event) → không được bỏ qua
+                self.items[channel] = {"windowStart": now, "absorbed": 0}
+                return 1
+            item = self.items.setdefault(channel, {})
+            if "windowStart" in item and item["windowStart"] > now - self.window:
+                return None
+            if require_pending and not item.get("absorbed"):
+                return None
+            pending = item.get("absorbed", 0)
+            item.update(windowStart=now, absorbed=0)
+            return pending
+
+    def absorb(self, channel: str):
+        with self._lock:
+            item = self.items.setdefault(channel, {})
+            item["absorbed"] = item.get("absorbed", 0) + 1
+            return item["absorbed"], item.get("windowStart", 0)
+
+    def release(self, channel: str, pending: int):
+        with self._lock:
+            item = self.items.setdefault(channel, {})
+            item["windowStart"] = 0
+            item["absorbed"] = item.get("absorbed", 0) + pending
+
+    def record(self, channel: str, snapshot_id: str, events: int):
+        with self._lock:
+            item = self.items.setdefault(channel, {})
+            item.update(lastSnapshotId=snapshot_id, lastSnapshotEvents=events)
+            item["snapshots"] = item.get("snapshots", 0) + 1
+            item["events"] = item.get("events", 0) + events
+
+
+def build_gate(window: int = SNAPSHOT_WINDOW_SECONDS):
+    if SNAPSHOT_GATE_BACKEND == "none":
+        return None
+    if SNAPSHOT_GATE_BACKEND == "memory" or not SNAPSHOT_GATE_TABLE:
+        if SNAPSHOT_GATE_BACKEND != "memory":
+            logger.warning("SNAPSHOT_GATE_TABLE is not set, using the in-memory snapshot gate")
+        return MemorySnapshotGate(window)
+    import boto3
+    return DynamoDBSnapshotGate(boto3.resource("dynamodb").Table(SNAPSHOT_GATE_TABLE), window)
+
+
+snapshot_gate = build_gate()
@@ -0,0 +1,50 @@
+# ========================================
+# bench_json_repair.py — BENCHMARK extract_json_from_text TRÊN OUTPUT AGENT 1-20 MB
+# ========================================
+# Chạy từ thư mục gốc repo: python bench/bench_json_repair.py
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "drift_detection_normal_lambda"))
+
+from json_repair import extract_json_from_text  # noqa: E402
+
+
+def agent_output(size_mb: float):
+    record = {
+        "resource_address": "module.security_groups.aws_security_group.app",
+        "issue": "Ingress rule added: SSH from bastion\nport 22 open to 0.0.0.0/0",
+        "risk": "high",
+        "remediation_update_iac": "Update ingress { from_port = 22, cidr_blocks = [\"10.0.0.0/16\"] }",
+        "remediation_remove_source": "N/A",
+    }
+    one = json.dumps(record)
+    count = int(size_mb * 1024 * 1024 / (len(one) + 1))
+    body = ",".join([one] * count)
+    return 'Here is the report:\n{"detection_type": "normal", "drifted_resources": [' + body + '], "summary": "done"}'
+
+
+def main(sizes=(1, 5, 10, 20)):
+    print(f"{'size':>8} {'case':<16} {'seconds':>8} {'MB/s':>8}")
+    for size in sizes:
+        valid = agent_output(size)
+        cases = {
+            "valid": valid,
+            "truncated": valid[: int(len(valid) * 0.7)],
+            "trailing_comma": valid.replace("}, {", "},, {", 1).replace('"N/A"}', '"N/A",}'),
+            "raw_newlines": valid.replace("\\n", "\n"),
+            "raw_quotes": valid.replace("from bastion", 'from "bastion"'),
+        }
+        for name, text in cases.items():
+            t = time.perf_counter()
+            data = extract_json_from_text(text)
+            elapsed = time.perf_counter() - t
+            assert data.get("drifted_resources"), name
+            mb = len(text) / (1024 * 1024)
+            print(f"{mb:>6.1f}MB {name:<16} {elapsed:>8.3f} {mb / elapsed:>8.1f}")
+
+
+if __name__ == "__main__":
+    main([float(s) for s in sys.argv[1:]] or (1, 5, 10, 20))
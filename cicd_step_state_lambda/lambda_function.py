@@ -1,18 +1,41 @@
 import json
 import os
+import uuid
 import boto3
+from json_stream import iter_text_chunks
+from terraform_plan_reader import parse_terraform_plan
+from result_pages import page_result
 
 sf = boto3.client("stepfunctions")
+s3 = boto3.client("s3")
 STEP_FUNCTION_ARN = os.environ.get("STEP_FUNCTION_ARN", "arn:aws:states:us-east-1:933000400558:stateMachine:DriftReportAgentASL")
+# plan lớn: quá số drift này thì page 2.. của cicd_drift["drifted"] lưu ra RESULT_PAGE_BUCKET
+# (input Step Functions ≤ 256KB); detector nạp lại bằng expand_pages
+CICD_DRIFT_PAGE_SIZE = int(os.environ.get("CICD_DRIFT_PAGE_SIZE", "100"))
 
 def lambda_handler(event, context):
     # Parse input body từ API Gateway
     # ✅ Đồng bộ dữ liệu
-    input_data = {
-        "query": f"Phân tích drift từ log CICD: {event['body']}",
-        "type": "cicd_log"
-    }
-    print(input_data)
+    body = event.get("body") or ""
+    if is_plan_json(event, body):
+        # 🟣 Plan JSON (`terraform show -json`) — parse ngay tại đây, không đưa vào prompt
+        cicd_drift = parse_terraform_plan(plan_chunks(body))
+        drifted = len(cicd_drift["drifted"])
+        cicd_drift = page_result(cicd_drift, f"cicd/{uuid.uuid4().hex}", field="drifted",
+                                 page_size=CICD_DRIFT_PAGE_SIZE)
+        input_data = {
+            "query": f"Phân tích drift từ plan JSON: {drifted} drifted / "
+                     f"{cicd_drift['total_refreshed']} managed resources",
+            "type": "cicd_log",
+            "source": "plan_json",
+            "cicd_drift": cicd_drift
+        }
+    else:
+        input_data = {
+            "query": f"Phân tích drift từ log CICD: {body}",
+            "type": "cicd_log"
+        }
+    print(json.dumps(input_data, ensure_ascii=False)[:2000])
 
 
     # Kiểm tra biến môi trường
@@ -37,3 +60,22 @@ def lambda_handler(event, context):
             "execution_arn": execution_arn,
         }, ensure_ascii=False)
     }
+
+
+def is_plan_json(event, body: str):
+    params = event.get("queryStringParameters") or {}
+    if params.get("format") == "plan_json":
+        return True
+    head = body[:2048].lstrip()
+    return head.startswith("{") and ('"format_version"' in head or '"plan_s3_uri"' in head)
+
+
+def plan_chunks(body: str):
+    """Plan lớn được upload lên S3 trước: body = {"plan_s3_uri": "s3://bucket/key"}"""
+    head = body[:2048]
+    if '"plan_s3_uri"' in head and '"format_version"' not in head:
+        uri = json.loads(body)["plan_s3_uri"]
+        bucket, _, key = uri[len("s3://"):].partition("/")
+        obj = s3.get_object(Bucket=bucket, Key=key)
+        return obj["Body"].iter_chunks()
+    return iter_text_chunks(body)
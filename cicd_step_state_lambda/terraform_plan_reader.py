@@ -0,0 +1,97 @@
+# ========================================
+# terraform_plan_reader.py — `terraform show -json` → cicd_drift
+# ========================================
+from json_stream import iter_array_items
+from resource_resolver import to_aws_identifier
+
+ACTIONS = {
+    ("update",): "update_in_place",
+    ("create",): "add",
+    ("delete",): "destroy",
+    ("delete", "create"): "replace",
+    ("create", "delete"): "replace",
+}
+
+MAX_DETAIL_ITEMS = 5
+MAX_VALUE_LENGTH = 80
+
+
+def parse_terraform_plan(chunks):
+    """
+    Đọc plan JSON theo chunk (str/bytes). Chỉ giữ từng resource_change một
+    lúc trong bộ nhớ — plan vài chục MB không bị decode thành một object lớn.
+    """
+    managed = set()
+    drifted = {}
+
+    for (key,), change in iter_array_items(chunks, ("resource_drift",), ("resource_changes",)):
+        if change.get("mode", "managed") != "managed":
+            continue
+        address = change.get("address")
+        if key == "resource_changes":
+            managed.add(address)
+
+        record = to_drift_record(change, outside=key == "resource_drift")
+        if not record:
+            continue
+        existing = drifted.get(address)
+        if existing:
+            existing["drift_details"] = "; ".join(
+                x for x in [existing["drift_details"], record["drift_details"]] if x
+            )
+            if key == "resource_changes":
+                existing["change_type"] = record["change_type"]
+        else:
+            drifted[address] = record
+
+    return {
+        "total_refreshed": len(managed),
+        "managed_count": len(drifted),
+        "drifted": list(drifted.values()),
+        "unmanaged": [],
+    }
+
+
+def to_drift_record(change: dict, outside: bool = False):
+    detail = change.get("change") or {}
+    change_type = ACTIONS.get(tuple(detail.get("actions") or ()))
+    if not change_type:
+        return None  # no-op / read
+
+    before = detail.get("before") or {}
+    after = detail.get("after") or {}
+    unknown = detail.get("after_unknown") or {}
+    resource_id = before.get("id") or after.get("id")
+
+    details = describe_changes(before, after, unknown)
+    if outside:
+        details = f"Changed outside of Terraform: {details}" if details else "Changed outside of Terraform"
+
+    return {
+        "resource_address": change.get("address"),
+        "aws_identifier": to_aws_identifier(change.get("address") or "", resource_id),
+        "change_type": change_type,
+        "drift_details": details,
+    }
+
+
+def describe_changes(before: dict, after: dict, unknown: dict):
+    parts = []
+    for name in sorted(set(before) | set(after)):
+        old, new = before.get(name), after.get(name)
+        if unknown.get(name) is True:
+            new = "(known after apply)"
+        if old == new:
+            continue
+        if isinstance(old, (dict, list)) or isinstance(new, (dict, list)):
+            parts.append(f"{name} changed")
+        else:
+            parts.append(f"{name}: {_short(old)} -> {_short(new)}")
+        if len(parts) >= MAX_DETAIL_ITEMS:
+            break
+    return "; ".join(parts)
+
+
+def _short(value):
+    text = "null" if value is None else str(value)
+    return text if len(text) <= MAX_VALUE_LENGTH else text[:MAX_VALUE_LENGTH] + "..."
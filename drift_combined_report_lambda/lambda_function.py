@@ -9,6 +9,12 @@ import re
 from boto3.dynamodb.conditions import Attr
 from datetime import datetime, timezone
 from botocore.exceptions import ClientError
+from json_repair import extract_json_from_text
+from chunk_assembler import ChunkAssembler
+from request_context import RequestContext
+from event_schema import EventSchema
+from agent_cache import cached_agent_call, template_version
+from work_queue import build_work_queue
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -25,6 +31,11 @@ sf = boto3.client("stepfunctions")
 STEP_FUNCTION_ARN = os.environ.get("STEP_FUNCTION_ARN", "arn:aws:states:us-east-1:933000400558:stateMachine:DriftReportAgentASL")
 lambda_client = boto3.client("lambda")
 LAMBDA_NAME = os.environ.get("LAMBDA_NAME", "iacScanOrchestrator")
+# có SCAN_QUEUE_URL: báo orchestrator qua work queue thay vì invoke trực tiếp
+work_queue = build_work_queue()
+
+# Tăng khi đổi ngữ nghĩa output (cache key còn gồm hash của prompt template)
+PROMPT_VERSION = "1"
 
 bedrock = boto3.client("bedrock-agent-runtime", region_name=REGION)
 
@@ -128,12 +139,24 @@ Data Drift Analysis Report:
 
 """
 
-results = {
+# field lấy từ event → default (mỗi invocation 1 RequestContext riêng)
+REQUEST_FIELDS = {
     "update_remediation": None,
     "remove_remediation": None,
     "query": None,
-    "type": None
+    "type": None,
+    "target_resources": []
 }
+# output của Parallel Remediation: list kết quả từng nhánh (hoặc dưới $.remediations),
+# query/type của input gốc ở top-level hoặc trong nhánh
+REMEDIATION_PATHS = "{0}|remediations.{0}|remediations[].{0}|[].{0}"
+REQUEST_SCHEMA = EventSchema({
+    "update_remediation": (REMEDIATION_PATHS.format("update_remediation"), (dict, list, str)),
+    "remove_remediation": (REMEDIATION_PATHS.format("remove_remediation"), (dict, list, str)),
+    "query": ("query|input.query|[].query", str),
+    "type": ("type|input.type|[].type", str),
+    "target_resources": ("target_resources|input.target_resources|[].target_resources", list),
+}, required=("type",))
 
 def now_utc():
     return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
@@ -142,43 +165,31 @@ def extract_repo_url(text: str):
     m = re.search(r"https?://github\.com/[a-zA-Z0-9_\-]+/[a-zA-Z0-9_\-]+", text)
     return m.group(0) if m else None
 
-def extract_detection(obj):
-    if isinstance(obj, dict):
-        for k, v in obj.items():
-            if k == "update_remediation":
-                results["update_remediation"] = v
-            elif k == "remove_remediation":
-                results["remove_remediation"] = v
-            elif k == "query":
-                results["query"] = v
-            elif k == "type":
-                results["type"] = v
-            else:
-                extract_detection(v)
-    elif isinstance(obj, list):
-        for item in obj:
-            extract_detection(item)
-
 def finish_one_repo(repo_url):
     table.update_item(
         Key={"repoUrl": repo_url},
-        UpdateExpression="SET scanStatus = :done, lastScanAt = :t, updatedAt = :t",
+        UpdateExpression="SET scanStatus = :done, lastScanAt = :t, updatedAt = :t "
+                         "REMOVE leaseOwner, leaseExpiresAt, executionArn",
         ExpressionAttributeValues={":done": "DONE", ":t": now_utc()},
     )
-    lambda_client.invoke(
-        FunctionName=LAMBDA_NAME,
-        InvocationType="Event",
-        Payload=json.dumps({"eventName": "ScanNextRepo"})
-    )
+    if work_queue is not None:
+        work_queue.send_batch([{"kind": "completed", "repoUrl": repo_url}])
+    else:
+        lambda_client.invoke(
+            FunctionName=LAMBDA_NAME,
+            InvocationType="Event",
+            # orchestrator ghi thống kê cho repo này rồi lấp slot vừa trống
+            Payload=json.dumps({"eventName": "ScanNextRepo", "repoUrl": repo_url})
+        )
     return {"status": "completed", "repo": repo_url}
 
 def lambda_handler(event, context):
-    extract_detection(event)
+    ctx = RequestContext.from_event(event, REQUEST_FIELDS, lambda_context=context, schema=REQUEST_SCHEMA)
     print("print event", event)
     
-    update_remediation = results["update_remediation"]
-    remove_remediation = results["remove_remediation"]
-    logger.info(f"results: {results}")
+    update_remediation = ctx["update_remediation"]
+    remove_remediation = ctx["remove_remediation"]
+    logger.info(f"request context: {ctx}")
     logger.info(f"update_remediation: {update_remediation}")
     logger.info(f"remove_remediation: {remove_remediation}")
     # Tạo date
@@ -192,18 +203,24 @@ def lambda_handler(event, context):
     
     logger.info(f"Prompt for combined report: {prompt_formatted}...")
     
+    # prompt bắt agent đọc IaC/AWS state hiện tại trong KB → không cache (giống detector/remediation)
     agent_output = invoke_agent(prompt_formatted)
     logger.info(f"Agent raw output: {agent_output}...")
     
     parsed = extract_json_from_text(agent_output)
+    if isinstance(parsed, dict) and parsed:
+        # report_id luôn theo ngày của lần chạy này, không theo text agent trả
+        parsed["report_id"] = f"drift-{current_date}"
     repo_prefix = "cicd_log"
-    query_type = results["type"]
+    query_type = ctx["type"]
     if query_type == "full_scan":
-        query = results["query"].strip()
+        query = ctx["query"].strip()
         repo_url = extract_repo_url(query)
         repo_prefix = repo_url.split("/")[-1]
         print(f"🔍 Query: {query}, Repo: {repo_url}")
-        finish_one_repo(repo_url)
+        if not ctx["target_resources"]:
+            # scan có mục tiêu chạy ngoài chu kỳ → không đụng scanStatus / slot của orchestrator
+            finish_one_repo(repo_url)
     
     if not parsed:
         parsed = "Agent invoke error: An error occurred (throttlingException) when calling the InvokeAgent operation: Your request rate is too high. Reduce the frequency of requests. Check your Bedrock model invocation quotas to find the acceptable frequency." 
@@ -212,7 +229,13 @@ def lambda_handler(event, context):
     )
     repo_prefix = "cicd_log"
     logger.info(f"Gen HTML File: {prompt_formatted}...")
-    html_content = invoke_agent(prompt_formatted)
+    html_content = cached_agent_call(
+        "html_report",
+        template_version(PROMPT_VERSION, PROMPTT_GENERATE_HTML),
+        # HTML hiển thị report_id (ngày chạy) → key gồm cả report_id
+        {"data": parsed},
+        lambda: invoke_agent(prompt_formatted)
+    )
     logger.info(f"Agent gen html_content raw output: {html_content}...")
     # === Save HTML to S3 ===
     bucket_name = "html-ai-gen"
@@ -231,7 +254,6 @@ def lambda_handler(event, context):
 
 # === INVOKE AGENT ===
 def invoke_agent(question: str, max_retries: int = 5):
-    full_output = ""
     attempt = 0
 
     while attempt < max_retries:
@@ -243,14 +265,13 @@ def invoke_agent(question: str, max_retries: int = 5):
                 inputText=question
             )
 
+            assembler = ChunkAssembler("combined_report")
             for event in response.get("completion", []):
-                chunk = event.get("chunk", {})
-                bytes_data = chunk.get("bytes")
-                if bytes_data:
-                    full_output += bytes_data.decode("utf-8")
+                assembler.add_event(event)
+            assembler.log_stats()
 
             # Nếu thành công, thoát khỏi vòng lặp retry
-            return full_output
+            return assembler.text()
 
         except ClientError as e:
             error_code = e.response["Error"]["Code"]
@@ -274,93 +295,3 @@ def invoke_agent(question: str, max_retries: int = 5):
     # Nếu retry hết số lần mà vẫn lỗi throttling
     logger.error("Max retries reached due to throttling.")
     return "Agent invoke error: Max retries reached due to throttling."
-
-# === EXTRACT JSON ===
-def extract_json_from_text(text: str):
-    try:
-        print("=== [TRACE] START extract_json_from_text ===")
-        full_text = text.strip()
-        logger.info(f"[TRACE] Raw : {full_text}")
-
-        # === B1: ƯU TIÊN TÌM JSON OBJECT { ... } ===
-        start_obj = full_text.find('{')
-        end_obj = full_text.rfind('}') + 1
-
-        if start_obj != -1 and end_obj > start_obj:
-            json_str = full_text[start_obj:end_obj]
-            is_array = False
-            print(f"[TRACE] Found JSON object: {len(json_str)} chars")
-        else:
-            # Nếu không có object, thử array
-            start_arr = full_text.find('[')
-            end_arr = full_text.rfind(']') + 1
-            if start_arr != -1 and end_arr > start_arr:
-                json_str = full_text[start_arr:end_arr]
-                is_array = True
-                print(f"[TRACE] Found JSON array: {len(json_str)} chars")
-            else:
-                print("[TRACE] No JSON found")
-                return {}
-
-        # === B2: Fix content bị cắt ===
-        fixed = ""
-        i = 0
-        in_content = False
-
-        while i < len(json_str):
-            if not in_content and json_str[i:i+10] == '"content":':
-                in_content = True
-                fixed += json_str[i:i+10]
-                i += 10
-                quote = json_str.find('"', i)
-                if quote == -1:
-                    fixed += ' ""'
-                    break
-                fixed += json_str[i:quote+1]
-                i = quote + 1
-                continue
-
-            if in_content and json_str[i] == '"' and json_str[i-1] != '\\':
-                next_part = json_str[i+1:i+5]
-                if any(x in next_part for x in [',', '}', '\n', '\r']):
-                    in_content = False
-            fixed += json_str[i]
-            i += 1
-
-        if in_content:
-            fixed += '"INCOMPLETE"'
-
-        json_str = fixed
-
-        # === B3: Dọn phẩy thừa + đóng ngoặc ===
-        json_str = re.sub(r',\s*([\]}])', r'\1', json_str)
-        json_str = re.sub(r',\s*$', '', json_str)
-
-        open_b = json_str.count('{')
-        close_b = json_str.count('}')
-        open_br = json_str.count('[')
-        close_br = json_str.count(']')
-
-        while open_b > close_b:
-            json_str += '}'
-            close_b += 1
-        while open_br > close_br:
-            json_str += ']'
-            close_br += 1
-
-        print(f"[TRACE] Final JSON: {json_str}")
-
-        # === B4: Parse ===
-        try:
-            data = json.loads(json_str)
-            return data
-        except json.JSONDecodeError as e:
-            print(f"[TRACE] JSON Error: {e}")
-            print(f"[TRACE] JSON string:\n{json_str[:600]}")
-            return {}  # Luôn trả object nếu là object
-
-    except Exception as e:
-        print(f"[TRACE] Exception: {e}")
-        return {}
-    finally:
-        print("=== [TRACE] END extract_json_from_text ===")
\ No newline at end of file
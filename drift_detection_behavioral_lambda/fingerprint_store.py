@@ -0,0 +1,133 @@
+# ========================================
+# fingerprint_store.py — LƯU FINGERPRINT + VERDICT TỪNG RESOURCE ĐỂ SCAN INCREMENTAL
+# ========================================
+import os
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from resource_resolver import normalize_address
+
+logger = logging.getLogger()
+
+# dynamodb | memory | none
+FINGERPRINT_BACKEND = os.environ.get("FINGERPRINT_BACKEND", "dynamodb")
+FINGERPRINT_TABLE = os.environ.get("FINGERPRINT_TABLE", "resourceFingerprints")
+
+
+def now_utc():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class DynamoDBFingerprintTable:
+    """pk = "{repo}#{detector}", sk = resource_address"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def query(self, pk: str):
+        from boto3.dynamodb.conditions import Key
+        kwargs = {"KeyConditionExpression": Key("pk").eq(pk)}
+        while True:
+            response = self.table.query(**kwargs)
+            yield from response.get("Items", [])
+            if "LastEvaluatedKey" not in response:
+                return
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def write(self, items: list, deletes: list):
+        with self.table.batch_writer(overwrite_by_pkeys=["pk", "sk"]) as batch:
+            for item in items:
+                batch.put_item(Item=item)
+            for key in deletes:
+                batch.delete_item(Key=key)
+
+
+class MemoryFingerprintTable:
+    """Stand-in local/test cho DynamoDB."""
+
+    def __init__(self):
+        self.items = {}
+        self._lock = threading.Lock()
+
+    def query(self, pk: str):
+        with self._lock:
+            return [dict(item) for (p, _), item in self.items.items() if p == pk]
+
+    def write(self, items: list, deletes: list):
+        with self._lock:
+            for item in items:
+                self.items[(item["pk"], item["sk"])] = dict(item)
+            for key in deletes:
+                self.items.pop((key["pk"], key["sk"]), None)
+
+
+class FingerprintStore:
+    def __init__(self, table):
+        self.table = table
+
+    def load(self, repo: str, detector: str):
+        """resource_address -> {"fingerprint", "verdicts"}"""
+        stored = {}
+        for item in self.table.query(f"{repo}#{detector}"):
+            stored[item["sk"]] = {
+                "fingerprint": item.get("fingerprint"),
+                "verdicts": json.loads(item.get("verdicts") or "[]"),
+            }
+        return stored
+
+    def save(self, repo: str, detector: str, fingerprints: dict, verdicts: dict, removed=()):
+        """Ghi fingerprint + verdict mới của các resource vừa được phân tích lại."""
+        pk = f"{repo}#{detector}"
+        ts = now_utc()
+        items = [
+            {"pk": pk, "sk": address, "fingerprint": fp,
+             "verdicts": json.dumps(verdicts.get(address, []), ensure_ascii=False), "updatedAt": ts}
+            for address, fp in fingerprints.items()
+        ]
+        self.table.write(items, [{"pk": pk, "sk": address} for address in removed])
+
+
+def split_changed(fingerprints: dict, stored: dict):
+    """
+    Trả về (changed, carried_verdicts, removed):
+    - changed: address mới hoặc fingerprint khác lần scan trước
+    - carried_verdicts: drift record của resource không đổi (dùng lại kết quả cũ)
+    - removed: address không còn trong repo
+    Address của fingerprint được chuẩn hoá (normalize_address), store chỉ lưu key chuẩn hoá.
+    """
+    fingerprints = {normalize_address(a): fp for a, fp in fingerprints.items()}
+    changed, carried = [], []
+    for address, fp in fingerprints.items():
+        previous = stored.get(address)
+        if previous and previous["fingerprint"] == fp:
+            carried.extend(previous["verdicts"])
+        else:
+            changed.append(address)
+    # key lưu kiểu cũ (còn "resource.") bị xoá; resource đó phân tích lại 1 lần và lưu key chuẩn hoá
+    removed = [address for address in stored if address not in fingerprints]
+    return changed, carried, removed
+
+
+def group_by_address(drifted_resources: list, addresses):
+    """Verdict theo resource; resource không có drift vẫn được lưu (list rỗng)."""
+    verdicts = {normalize_address(address): [] for address in addresses}
+    for record in drifted_resources or []:
+        if not isinstance(record, dict):
+            continue
+        address = normalize_address(record.get("resource_address"))
+        if address in verdicts:
+            verdicts[address].append(record)
+    return verdicts
+
+
+def build_store():
+    if FINGERPRINT_BACKEND == "none":
+        return None
+    if FINGERPRINT_BACKEND == "memory":
+        return FingerprintStore(MemoryFingerprintTable())
+    import boto3
+    return FingerprintStore(DynamoDBFingerprintTable(boto3.resource("dynamodb").Table(FINGERPRINT_TABLE)))
+
+
+fingerprint_store = build_store()
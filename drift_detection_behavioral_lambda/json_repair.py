@@ -0,0 +1,193 @@
+# ========================================
+# json_repair.py — TÁCH + SỬA JSON TỪ OUTPUT CỦA AGENT TRONG 1 LẦN DUYỆT (O(n))
+# ========================================
+import json
+import logging
+import re
+
+logger = logging.getLogger()
+
+STRUCT_RE = re.compile(r'[{}\[\]",:]')
+STRING_SPECIAL_RE = re.compile(r'["\\\x00-\x1f]')
+SCALAR_RE = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null")
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+CLOSERS = {"{": "}", "[": "]"}
+# sau dấu " đóng string chỉ có thể là các ký tự này (bỏ qua space/tab); còn lại là " nằm trong nội dung
+STRING_END_CHARS = ",}]:\r\n"
+
+_decoder = json.JSONDecoder()
+
+
+def extract_json_from_text(text: str):
+    """
+    Lấy JSON object (ưu tiên) hoặc array đầu tiên trong text của agent.
+    Hợp lệ → json decode trực tiếp; không thì sửa (string bị cắt, phẩy thừa,
+    thiếu ngoặc đóng, xuống dòng trong string...) rồi decode. Lỗi → {}.
+    """
+    if not text:
+        return {}
+    start = text.find("{")
+    if start == -1:
+        start = text.find("[")
+    if start == -1:
+        logger.info("[extract_json] No JSON found")
+        return {}
+    try:
+        data, _ = _decoder.raw_decode(text, start)
+        return data
+    except ValueError:
+        pass
+    repaired = repair_json(text, start)
+    try:
+        data = json.loads(repaired)
+    except ValueError as e:
+        logger.warning(f"[extract_json] JSON error after repair: {e} (raw {len(text)} chars)")
+        return {}
+    logger.info(f"[extract_json] Repaired JSON: {len(text)} → {len(repaired)} chars")
+    return data
+
+
+class _Repairer:
+    def __init__(self):
+        self.out = []
+        self.stack = []        # '{' | '['
+        self.state = []        # object: key|colon|value|after — array: value|after
+        self.pending_comma = False
+
+    # --- value trong container hiện tại ---
+    def begin_value(self):
+        """Chèn dấu phẩy nếu cần; trả True nếu value này là key của object."""
+        if not self.stack:
+            return False
+        state = self.state[-1]
+        if self.pending_comma or state == "after":
+            self.out.append(",")
+            self.pending_comma = False
+            state = "key" if self.stack[-1] == "{" else "value"
+        if self.stack[-1] == "[":
+            self.state[-1] = "after"
+            return False
+        if state == "key":
+            self.state[-1] = "colon"
+            return True
+        if state == "colon":
+            self.out.append(":")  # thiếu dấu ':' giữa key và value
+        self.state[-1] = "after"
+        return False
+
+    def close_top(self):
+        state = self.state.pop()
+        opener = self.stack.pop()
+        if opener == "{":
+            if state == "colon":
+                self.out.append(":null")
+            elif state == "value":
+                self.out.append("null")
+        self.pending_comma = False
+        self.out.append(CLOSERS[opener])
+
+    def scalar(self, token: str, at_eof: bool):
+        is_key = self.begin_value()
+        if is_key:
+            self.out.append(json.dumps(token))  # key không có quote
+            return
+        if SCALAR_RE.fullmatch(token):
+            self.out.append(token)
+        elif token in PYTHON_LITERALS:
+            self.out.append(PYTHON_LITERALS[token])
+        elif at_eof:
+            self.out.append("null")  # literal/number bị cắt
+        else:
+            self.out.append(json.dumps(token))
+
+    @staticmethod
+    def closes_string(text: str, k: int, n: int):
+        while k < n and text[k] in " \t":
+            k += 1
+        return k >= n or text[k] in STRING_END_CHARS
+
+    def string(self, text: str, i: int, n: int):
+        """i trỏ sau dấu mở ". Trả vị trí sau dấu đóng (hoặc n nếu bị cắt)."""
+        out = self.out
+        out.append('"')
+        while True:
+            m = STRING_SPECIAL_RE.search(text, i)
+            if not m:
+                out.append(text[i:])
+                out.append('"')
+                return n
+            j = m.start()
+            if j > i:
+                out.append(text[i:j])
+            c = m.group()
+            if c == '"':
+                if self.closes_string(text, j + 1, n):
+                    out.append('"')
+                    return j + 1
+                out.append('\\"')  # agent quên escape: "SSH from "bastion" host"
+                i = j + 1
+                continue
+            if c == "\\":
+                if j + 1 >= n:
+                    out.append('"')  # bỏ backslash cuối bị cắt
+                    return n
+                out.append(text[j:j + 2])
+                i = j + 2
+                continue
+            out.append(CONTROL_ESCAPES.get(c, "\\u%04x" % ord(c)))
+            i = j + 1
+
+    def run(self, text: str, start: int):
+        i, n = start, len(text)
+        while i < n:
+            m = STRUCT_RE.search(text, i)
+            end = m.start() if m else n
+            if end > i:
+                token = text[i:end].strip()
+                if token and self.stack:
+                    self.scalar(token, at_eof=m is None)
+            if not m:
+                break
+            c = m.group()
+            i = end + 1
+
+            if c == '"':
+                self.begin_value()
+                i = self.string(text, i, n)
+            elif c in "{[":
+                self.begin_value()
+                self.stack.append(c)
+                self.state.append("key" if c == "{" else "value")
+                self.out.append(c)
+            elif c in "}]":
+                opener = "{" if c == "}" else "["
+                if opener not in self.stack:
+                    continue  # ngoặc đóng thừa
+                while self.stack[-1] != opener:
+                    self.close_top()
+                self.close_top()
+                if not self.stack:
+                    break  # hết value gốc, bỏ phần text phía sau
+            elif c == ":":
+                if self.stack and self.stack[-1] == "{" and self.state[-1] == "colon":
+                    self.out.append(":")
+                    self.state[-1] = "value"
+            elif c == ",":
+                if not self.stack:
+                    continue
+                if self.stack[-1] == "{" and self.state[-1] in ("colon", "value"):
+                    self.out.append(":null" if self.state[-1] == "colon" else "null")
+                    self.state[-1] = "after"
+                if self.state[-1] == "after":
+                    self.pending_comma = True
+                    self.state[-1] = "key" if self.stack[-1] == "{" else "value"
+
+        while self.stack:
+            self.close_top()
+        return "".join(self.out)
+
+
+def repair_json(text: str, start: int = 0):
+    return _Repairer().run(text, start)
+
@@ -5,6 +5,23 @@ import boto3
 import logging
 import time
 import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from attribute_drift import compare_resources
+from kb_documents import KB_BUCKET, load_iac_documents, load_state_documents, s3 as kb_s3
+from resource_resolver import ResourceResolver, normalize_address
+from json_repair import extract_json_from_text
+from json_stream import JsonArrayStream
+from chunk_assembler import ChunkAssembler
+from request_context import RequestContext
+from prompt_builder import Fragment, PromptTemplate
+from prompt_serializer import CompactInputs, EMPTY
+from retrieval_index import build_index
+from result_pages import page_result, expand_pages
+from event_schema import EventSchema
+from agent_cache import agent_failed, cached_agent_call, template_version
+from fingerprint_store import fingerprint_store, group_by_address, split_changed
+from shard_results import detection_result
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -14,19 +31,23 @@ REGION = os.environ.get("AWS_REGION", "us-east-1")
 AGENT_ID = os.environ.get("AGENT_ID", "LBQSCKGFJM")
 AGENT_ALIAS_ID = os.environ.get("AGENT_ALIAS_ID", "NTCPG9HUZF")
 DETECTION_TYPE = os.environ.get("DETECTION_TYPE", "behavioral")
+# Multi-detector mode: chỉ function được chỉ định (DETECTORS="normal,policy,...") chạy nhiều detector;
+# event detection_mode="in_process" đến các lambda fan-out bị bỏ qua (mỗi lambda chỉ chạy DETECTION_TYPE)
+DETECTORS = [d.strip() for d in os.environ.get("DETECTORS", "").split(",") if d.strip()]
+MAX_DETECTOR_WORKERS = int(os.environ.get("MAX_DETECTOR_WORKERS", "4"))
+# số shard input gọi agent song song trong 1 detector
+SHARD_CONCURRENCY = int(os.environ.get("SHARD_CONCURRENCY", "3"))
+# Tăng khi đổi ngữ nghĩa output (cache key còn gồm hash của prompt template)
+PROMPT_VERSION = "1"
 
 bedrock = boto3.client("bedrock-agent-runtime", region_name=REGION)
 
-# === PROMPT DICTIONARY (DÁN PROMPTS BẠN CUNG CẤP) ===
-PROMPTS = {
-"normal": """
-You are an expert in detecting Normal Drift (attribute differences).
-
+# === PROMPT FRAGMENTS (dùng chung cho 7 detector) ===
+KB_RULES = Fragment("kb_rules", "2", """
 KNOWLEDGE BASE RULES:
-All IaC configurations of repo = {repo_url} are stored under the directory `iac_config/{repo_prefix}` in the KB.
 1. IaC Configs (iac_config/{repo_prefix}/)
    Structure: {{"resource_address": "resource.aws_instance.web", "type": "iac_configuration", "content": "...", "metadata": {{"repo": "{repo_url}"}}}}
-   Search: "iac_configuration {repo_url} resource_address"
+   Search: "iac_configuration {repo_prefix} resource_address"
    Extract: resource_address, content (for attributes)
 
 2. AWS State (aws_state/{region}/)
@@ -34,38 +55,47 @@ All IaC configurations of repo = {repo_url} are stored under the directory `iac_
    Search: "metadata.resourceType AWS configuration"
    Extract: metadata (type, id, name, status), configuration (attributes)
    Filter: Exclude status = "ResourceDeleted"
-3. Always prioritize AWS Desired State configurations from the directory `aws_state/` in the Knowledge Base when comparing against IaC configurations.
-4. All IaC configurations are located under `iac_config/{repo_prefix}/`, where `{repo_prefix}` corresponds to the current repo = {repo_url}.
-5. For every IaC resource, find the corresponding AWS resource in the AWS Desired State:
+
+3. For every IaC resource, find the corresponding AWS resource in the AWS Desired State:
    - Match by resource type, name, or ARN.
+   - IaC Data entries that already carry "aws_identifier" are pre-resolved pairs: use that AWS resource directly, no search needed to match them.
    - If no corresponding resource exists in AWS Desired State, skip comparison for that IaC resource.
-6. Do not invent or assume AWS resources that do not exist in the KB.
-7. The Knowledge Base has already been synchronized and contains all available data in both directories: `iac_config/` and `aws_state/`.
-8. Use the Knowledge Base to resolve drift detection as accurately as possible:
-   - Retrieve and correlate related IaC and AWS resource blocks.
-   - If attribute differences exist, log them under `drifted_resources`.
-   - Prefer using data from AWS Desired State when conflict or uncertainty occurs.
-9. Never rely on external assumptions or unstated data — only use content found in the Knowledge Base and provided inputs.
-10. Only include up to 50 high-risk drifts in the output (risk="high").
-
-Step by Step:
-1: forcus on infomation below, base on it and get details from KB
-IaC Data (if any base on it and get details from KB else scan all KB): {iac_data} 
-Desired State Data (if any base on it and get details from KB else scan from KB): {state_data}
-CICD Drift Log (if any base on it and get details from KB else scan from KB): {cicd_drift}
-2. Use the Knowledge Base according to the rules above.
-3. Compare IaC vs AWS attributes (e.g., instance_type, AMI, subnet, etc.).
-4. Document any detected drift.
-5. Suggest remediation actions:
-   - update_iac: Modify IaC files in `iac_config/` to resolve the drift.
-   - remove_source: Rebuild or reset the source if needed.
-6. Review all findings.
-7. Compile a JSON report that includes only the top 50 high-risk drifts.
-
+4. Do not invent or assume AWS resources that do not exist in the KB.
+5. Report every drifted resource found (no limit on the number of results), each with its risk ("high", "medium" or "low").
+""")
+
+# nhắc lại rule ở trên → bỏ đầu tiên khi vượt budget
+KB_GUIDANCE = Fragment("kb_guidance", "1", """
+KNOWLEDGE BASE GUIDANCE:
+- All IaC configurations are located under `iac_config/{repo_prefix}/`, where `{repo_prefix}` corresponds to the current repo = {repo_url}.
+- Always prioritize AWS Desired State configurations from the directory `aws_state/` in the Knowledge Base when comparing against IaC configurations.
+- The Knowledge Base has already been synchronized and contains all available data in both directories: `iac_config/` and `aws_state/`.
+- Retrieve and correlate related IaC and AWS resource blocks; if differences exist, log them under `drifted_resources`.
+- Prefer using data from AWS Desired State when conflict or uncertainty occurs.
+- Never rely on external assumptions or unstated data — only use content found in the Knowledge Base and provided inputs.
+""", drop_priority=1)
+
+INPUTS = Fragment("inputs", "3", """
+INPUTS (compact encoding):
+- Focus on the IaC Data, Desired State Data and CICD Drift Log below and get their details from the KB.
+- If a section is (none), scan the KB for that kind of data instead.
+- A reference "pN/rest" is prefix pN followed by rest: with p1 = aws_instance., "p1/web" means aws_instance.web.
+- Every input resource has a short id (r = IaC, s = AWS, c = CICD drift, u = unmanaged). Use that short id as "resource_address" in the output.
+Prefixes:
+{prefixes}
+IaC Data (id = resource_address [-> pre-resolved aws_identifier] [attributes]):
+{iac_data}
+Desired State Data (id = aws_identifier):
+{state_data}
+CICD Drift Log (id = resource_address -> aws_identifier | change_type | details):
+{cicd_drift}
+""")
+
+OUTPUT_SCHEMA = Fragment("output_schema", "1", """
 IMPORTANT: Start with JSON output only.
 Output JSON:
 {{
-  "detection_type": "normal",
+  "detection_type": "{detection_type}",
   "drifted_resources": [
     {{
       "resource_address": "...",
@@ -77,402 +107,134 @@ Output JSON:
   ],
   "summary": "..."
 }}
+""")
 
+STRICT_INSTRUCTION = Fragment("strict_instruction", "2", """
 STRICT INSTRUCTION:
 - Never ask clarification questions.
 - Always proceed even if some inputs (iac_data, state_data, or cicd_drift) are missing or empty.
-- Only include up to 50 high-risk drifts in the output.
 - Never output explanations, reasoning, or commentary outside the JSON.
 - The output must always be valid JSON following the specified schema.
-""",
-"policy": """
-You are an expert in detecting Policy / Compliance Drift (valid but violating internal or AWS compliance rules).
+""", drop_priority=3)
 
-KNOWLEDGE BASE RULES:
-1. IaC Configs (iac_config/{repo_prefix}/)
-   Structure: {{"resource_address": "resource.aws_instance.web", "type": "iac_configuration", "content": "...", "metadata": {{"repo": "{repo_url}"}}}}
-   Search: "iac_configuration {repo_prefix} resource_address"
-   Extract: resource_address, content (for attributes)
+# document KB chọn sẵn bằng retrieval index local → agent không phải search cho các input này
+RETRIEVED = Fragment("retrieved", "1", """
+RETRIEVED KB DOCUMENTS (pre-selected from iac_config/ and aws_state/ for the inputs above; [id] = input short id, "candidate" = likely AWS match):
+{kb_context}
+- These blocks are the KB content of those inputs: compare them directly and do not search the KB for them again.
+- Search the KB only for inputs that have no block here.
+""", drop_priority=4)
 
-2. AWS State (aws_state/{region}/)
-   Structure: {{"id": "AWS__EC2__Instance_i-123", "metadata": {{"resourceType": "AWS::EC2::Instance", "resourceId": "i-123", "resourceName": "web", "status": "ResourceDiscovered"}}, "configuration": {{"InstanceType": "t3.small", "ImageId": "ami-xyz"}}}}
-   Search: "metadata.resourceType AWS configuration"
-   Extract: metadata (type, id, name, status), configuration (attributes)
-   Filter: Exclude status = "ResourceDeleted"
+OPERATIONAL_RULES = Fragment("operational_rules", "1", """
+OPERATIONAL RULES:
+- Never ask for clarification.
+- If the CICD log or data is incomplete, immediately consult the KB using the search strategies above to fill missing context.
+- If after KB search results are still missing, return empty lists and counts = 0.
+- You are fully autonomous; do not request user input under any condition.
+- Always return a complete JSON response as described below.
+""", drop_priority=2)
+
+
+def detector_prompt(detection_type: str, role: str, steps: str, with_inputs: bool = True, extra=()):
+    fragments = [Fragment("role", "1", role), KB_RULES, KB_GUIDANCE]
+    if with_inputs:
+        fragments += [INPUTS, RETRIEVED]
+    fragments += [Fragment("steps", "2", steps), *extra,
+                  OUTPUT_SCHEMA.with_values(detection_type=detection_type), STRICT_INSTRUCTION]
+    return PromptTemplate(detection_type, fragments)
 
-3. Always prioritize AWS Desired State configurations from the directory `aws_state/` in the Knowledge Base when comparing against IaC configurations.
-4. All IaC configurations are located under `iac_config/{repo_prefix}/`, where `{repo_prefix}` corresponds to the current repo = {repo_url}.
-5. For every IaC resource, find the corresponding AWS resource in the AWS Desired State:
-   - Match by resource type, name, or ARN.
-   - If no corresponding resource exists in AWS Desired State, skip comparison.
-6. Do not invent or assume AWS resources that do not exist in the KB.
-7. The Knowledge Base has already been synchronized and contains all available data in both directories: `iac_config/` and `aws_state/`.
-8. Use the Knowledge Base to resolve drift detection as accurately as possible:
-   - Retrieve and correlate related IaC and AWS resource blocks.
-   - Prefer using data from AWS Desired State when conflict or uncertainty occurs.
-9. Only include up to 50 high-risk drifts in the output (risk="high").
 
+PROMPTS = {
+"normal": detector_prompt("normal", "You are an expert in detecting Normal Drift (attribute differences).", """
+Step by Step:
+1. Focus on the inputs above and use the Knowledge Base according to the rules above.
+2. Compare IaC vs AWS attributes (e.g., instance_type, AMI, subnet, etc.).
+3. Document any detected drift.
+4. Suggest remediation actions:
+   - update_iac: Modify IaC files in `iac_config/` to resolve the drift.
+   - remove_source: Rebuild or reset the source if needed.
+5. Review all findings.
+6. Compile a JSON report that includes every detected drift.
+"""),
+"policy": detector_prompt("policy", "You are an expert in detecting Policy / Compliance Drift (valid but violating internal or AWS compliance rules).", """
 Step by Step:
-1: forcus on infomation below, base on it and get details from KB
-IaC Data (if any base on it and get details from KB else scan all KB): {iac_data} 
-Desired State Data (if any base on it and get details from KB else scan from KB): {state_data}
-CICD Drift Log (if any base on it and get details from KB else scan from KB): {cicd_drift}
-2. Use the Knowledge Base according to the rules above.
-3. Identify any policy or compliance violations (e.g., open security group, missing tags, public access).
-4. Document all drift with compliance context.
-5. Suggest remediation actions:
+1. Focus on the inputs above and use the Knowledge Base according to the rules above.
+2. Identify any policy or compliance violations (e.g., open security group, missing tags, public access).
+3. Document all drift with compliance context.
+4. Suggest remediation actions:
    - update_iac: Fix IaC configurations in `iac_config/` to comply.
    - remove_source: Rebuild to remove non-compliant resources.
-6. Review all findings.
-7. Compile a JSON report that includes only the top 50 high-risk drifts.
-
-
-IMPORTANT: Start with JSON output only.
-Output JSON:
-{{
-  "detection_type": "policy",
-  "drifted_resources": [
-    {{
-      "resource_address": "...",
-      "issue": "...",
-      "risk": "high",
-      "remediation_update_iac": "...",
-      "remediation_remove_source": "..."
-    }}
-  ],
-  "summary": "..."
-}}
-
-STRICT INSTRUCTION:
-- Never ask clarification questions.
-- Always proceed even if some inputs are missing.
-- Only include up to 50 high-risk drifts.
-- Never output explanations or commentary outside JSON.
-- The output must be valid JSON following the schema.
-""",
-"semantic": """
-You are an expert in detecting Semantic Drift (logical difference despite similar structure).
-
-KNOWLEDGE BASE RULES:
-1. IaC Configs (iac_config/{repo_prefix}/)
-   Structure: {{"resource_address": "resource.aws_instance.web", "type": "iac_configuration", "content": "...", "metadata": {{"repo": "{repo_url}"}}}}
-   Search: "iac_configuration {repo_prefix} resource_address"
-   Extract: resource_address, content (for attributes)
-
-2. AWS State (aws_state/{region}/)
-   Structure: {{"id": "AWS__EC2__Instance_i-123", "metadata": {{"resourceType": "AWS::EC2::Instance", "resourceId": "i-123", "resourceName": "web", "status": "ResourceDiscovered"}}, "configuration": {{"InstanceType": "t3.small", "ImageId": "ami-xyz"}}}}
-   Search: "metadata.resourceType AWS configuration"
-   Extract: metadata (type, id, name, status), configuration (attributes)
-   Filter: Exclude status = "ResourceDeleted"
-
-3. Always prioritize AWS Desired State configurations from the directory `aws_state/` in the Knowledge Base when comparing against IaC configurations.
-4. All IaC configurations are located under `iac_config/{repo_prefix}/`, where `{repo_prefix}` corresponds to the current repo = {repo_url}.
-5. For every IaC resource, find the corresponding AWS resource in the AWS Desired State:
-   - Match by resource type, name, or ARN.
-   - If no corresponding resource exists in AWS Desired State, skip comparison.
-6. Do not invent or assume AWS resources that do not exist in the KB.
-7. The Knowledge Base has already been synchronized and contains all available data in both directories: `iac_config/` and `aws_state/`.
-8. Use the Knowledge Base to resolve drift detection as accurately as possible:
-   - Retrieve and correlate related IaC and AWS resource blocks.
-   - Prefer using data from AWS Desired State when conflict or uncertainty occurs.
-9. Only include up to 50 high-risk drifts in the output (risk="high").
-
+5. Review all findings.
+6. Compile a JSON report that includes every detected drift.
+"""),
+"semantic": detector_prompt("semantic", "You are an expert in detecting Semantic Drift (logical difference despite similar structure).", """
 Step by Step:
-0: forcus on infomation below, base on it and get details from KB
-IaC Data (if any base on it and get details from KB else scan all KB): {iac_data} 
-Desired State Data (if any base on it and get details from KB else scan from KB): {state_data}
-CICD Drift Log (if any base on it and get details from KB else scan from KB): {cicd_drift}
-1. Use the Knowledge Base according to the rules.
+1. Focus on the inputs above and use the Knowledge Base according to the rules.
 2. Analyze semantic drift (same logic but different implementation, or vice versa).
 3. Document drifts.
 4. Suggest remediation:
    - update_iac: Modify IaC to match intended logic.
    - remove_source: Rebuild or refactor inconsistent semantics.
 5. Review findings.
-6. Compile a JSON report (top 50 high-risk drifts only).
-
-Output JSON:
-{{
-  "detection_type": "semantic",
-  "drifted_resources": [
-    {{
-      "resource_address": "...",
-      "issue": "...",
-      "risk": "high",
-      "remediation_update_iac": "...",
-      "remediation_remove_source": "..."
-    }}
-  ],
-  "summary": "..."
-}}
-
-STRICT INSTRUCTION:
-- Never ask clarification questions.
-- Always proceed even if some inputs (iac_data, state_data, or cicd_drift) are missing or empty.
-- Only include up to 50 high-risk drifts in the output.
-- Never output explanations, reasoning, or commentary outside the JSON.
-- The output must always be valid JSON following the specified schema.
-""",
-
-    "hidden": """
-You are an expert in detecting Hidden / Implicit Configuration Drift.
-
-KNOWLEDGE BASE RULES:
-1. IaC Configs (iac_config/{repo_prefix}/)
-   Structure: {{"resource_address": "resource.aws_instance.web", "type": "iac_configuration", "content": "...", "metadata": {{"repo": "{repo_url}"}}}}
-   Search: "iac_configuration {repo_prefix} resource_address"
-   Extract: resource_address, content (for attributes)
-
-2. AWS State (aws_state/{region}/)
-   Structure: {{"id": "AWS__EC2__Instance_i-123", "metadata": {{"resourceType": "AWS::EC2::Instance", "resourceId": "i-123", "resourceName": "web", "status": "ResourceDiscovered"}}, "configuration": {{"InstanceType": "t3.small", "ImageId": "ami-xyz"}}}}
-   Search: "metadata.resourceType AWS configuration"
-   Extract: metadata (type, id, name, status), configuration (attributes)
-   Filter: Exclude status = "ResourceDeleted"
-
-3. Always prioritize AWS Desired State configurations from the directory `aws_state/` in the Knowledge Base when comparing against IaC configurations.
-4. All IaC configurations are located under `iac_config/{repo_prefix}/`, where `{repo_prefix}` corresponds to the current repo = {repo_url}.
-5. For every IaC resource, find the corresponding AWS resource in the AWS Desired State:
-   - Match by resource type, name, or ARN.
-   - If no corresponding resource exists in AWS Desired State, skip comparison.
-6. Do not invent or assume AWS resources that do not exist in the KB.
-7. The Knowledge Base has already been synchronized and contains all available data in both directories: `iac_config/` and `aws_state/`.
-8. Use the Knowledge Base to resolve drift detection as accurately as possible:
-   - Retrieve and correlate related IaC and AWS resource blocks.
-   - Prefer using data from AWS Desired State when conflict or uncertainty occurs.
-9. Only include up to 50 high-risk drifts in the output (risk="high").
-
+6. Compile a JSON report (all detected drifts).
+"""),
+"hidden": detector_prompt("hidden", "You are an expert in detecting Hidden / Implicit Configuration Drift.", """
 Step by Step:
 1. Use the Knowledge Base.
 2. Identify hidden configurations (e.g., default SGs, auto-generated tags).
 3. Document them.
 4. Suggest remediation actions.
-5. Compile a JSON report (top 50 high-risk drifts).
-
-Output JSON:
-{{
-  "detection_type": "hidden",
-  "drifted_resources": [
-    {{
-      "resource_address": "...",
-      "issue": "...",
-      "risk": "high",
-      "remediation_update_iac": "...",
-      "remediation_remove_source": "..."
-    }}
-  ],
-  "summary": "..."
-}}
-
-STRICT INSTRUCTION:
-- Never ask clarification questions.
-- Always proceed even if some inputs (iac_data, state_data, or cicd_drift) are missing or empty.
-- Only include up to 50 high-risk drifts in the output.
-- Never output explanations, reasoning, or commentary outside the JSON.
-- The output must always be valid JSON following the specified schema.
-""",
-
-    "cross": """
-You are an expert in detecting Cross-Resource Dependency Drift.
-
-KNOWLEDGE BASE RULES:
-1. IaC Configs (iac_config/{repo_prefix}/)
-   Structure: {{"resource_address": "resource.aws_instance.web", "type": "iac_configuration", "content": "...", "metadata": {{"repo": "{repo_url}"}}}}
-   Search: "iac_configuration {repo_prefix} resource_address"
-   Extract: resource_address, content (for attributes)
-
-2. AWS State (aws_state/{region}/)
-   Structure: {{"id": "AWS__EC2__Instance_i-123", "metadata": {{"resourceType": "AWS::EC2::Instance", "resourceId": "i-123", "resourceName": "web", "status": "ResourceDiscovered"}}, "configuration": {{"InstanceType": "t3.small", "ImageId": "ami-xyz"}}}}
-   Search: "metadata.resourceType AWS configuration"
-   Extract: metadata (type, id, name, status), configuration (attributes)
-   Filter: Exclude status = "ResourceDeleted"
-
-3. Always prioritize AWS Desired State configurations from the directory `aws_state/` in the Knowledge Base when comparing against IaC configurations.
-4. All IaC configurations are located under `iac_config/{repo_prefix}/`, where `{repo_prefix}` corresponds to the current repo = {repo_url}.
-5. For every IaC resource, find the corresponding AWS resource in the AWS Desired State:
-   - Match by resource type, name, or ARN.
-   - If no corresponding resource exists in AWS Desired State, skip comparison.
-6. Do not invent or assume AWS resources that do not exist in the KB.
-7. The Knowledge Base has already been synchronized and contains all available data in both directories: `iac_config/` and `aws_state/`.
-8. Use the Knowledge Base to resolve drift detection as accurately as possible:
-   - Retrieve and correlate related IaC and AWS resource blocks.
-   - Prefer using data from AWS Desired State when conflict or uncertainty occurs.
-9. Only include up to 50 high-risk drifts in the output (risk="high").
-
+5. Compile a JSON report (all detected drifts).
+""", with_inputs=False),
+"cross": detector_prompt("cross", "You are an expert in detecting Cross-Resource Dependency Drift.", """
 Step by Step:
 1. Use the Knowledge Base.
 2. Identify cross-resource impacts.
 3. Document dependencies and affected resources.
 4. Suggest remediation.
-5. Compile JSON report (top 50 high-risk drifts).
-
-Output JSON:
-{{
-  "detection_type": "cross",
-  "drifted_resources": [
-    {{
-      "resource_address": "...",
-      "issue": "...",
-      "risk": "high",
-      "remediation_update_iac": "...",
-      "remediation_remove_source": "..."
-    }}
-  ],
-  "summary": "..."
-}}
-STRICT INSTRUCTION:
-- Never ask clarification questions.
-- Always proceed even if some inputs (iac_data, state_data, or cicd_drift) are missing or empty.
-- Only include up to 50 high-risk drifts in the output.
-- Never output explanations, reasoning, or commentary outside the JSON.
-- The output must always be valid JSON following the specified schema.
-""",
-
-"behavioral": """
-You are an expert in detecting Behavioral Drift.
-
-KNOWLEDGE BASE RULES:
-1. IaC Configs (iac_config/{repo_prefix}/)
-   Structure: {{"resource_address": "resource.aws_instance.web", "type": "iac_configuration", "content": "...", "metadata": {{"repo": "{repo_url}"}}}}
-   Search: "iac_configuration {repo_prefix} resource_address"
-   Extract: resource_address, content (for attributes)
-
-2. AWS State (aws_state/{region}/)
-   Structure: {{"id": "AWS__EC2__Instance_i-123", "metadata": {{"resourceType": "AWS::EC2::Instance", "resourceId": "i-123", "resourceName": "web", "status": "ResourceDiscovered"}}, "configuration": {{"InstanceType": "t3.small", "ImageId": "ami-xyz"}}}}
-   Search: "metadata.resourceType AWS configuration"
-   Extract: metadata (type, id, name, status), configuration (attributes)
-   Filter: Exclude status = "ResourceDeleted"
-
-3. Always prioritize AWS Desired State configurations from the directory `aws_state/` in the Knowledge Base when comparing against IaC configurations.
-4. All IaC configurations are located under `iac_config/{repo_prefix}/`, where `{repo_prefix}` corresponds to the current repo = {repo_url}.
-5. For every IaC resource, find the corresponding AWS resource in the AWS Desired State:
-   - Match by resource type, name, or ARN.
-   - If no corresponding resource exists in AWS Desired State, skip comparison.
-6. Do not invent or assume AWS resources that do not exist in the KB.
-7. The Knowledge Base has already been synchronized and contains all available data in both directories: `iac_config/` and `aws_state/`.
-8. Use the Knowledge Base to resolve drift detection as accurately as possible:
-   - Retrieve and correlate related IaC and AWS resource blocks.
-   - Prefer using data from AWS Desired State when conflict or uncertainty occurs.
-9. Only include up to 50 high-risk drifts in the output (risk="high").
-
+5. Compile JSON report (all detected drifts).
+""", with_inputs=False),
+"behavioral": detector_prompt("behavioral", "You are an expert in detecting Behavioral Drift.", """
 Step by Step:
 1. Use the Knowledge Base.
 2. Detect runtime behavior differences (e.g., performance, downtime, cost).
 3. Document behavioral drift.
 4. Suggest remediation.
-5. Compile JSON report (top 50 high-risk drifts).
-
-OPERATIONAL RULES:
-- Never ask for clarification.
-- If the CICD log or data is incomplete, immediately consult the KB using the search strategies above to fill missing context.
-- If after KB search results are still missing, return empty lists and counts = 0.
-- You are fully autonomous; do not request user input under any condition.
-- Always return a complete JSON response as described below.
-
-Output JSON:
-{{
-  "detection_type": "behavioral",
-  "drifted_resources": [
-    {{
-      "resource_address": "...",
-      "issue": "...",
-      "risk": "high",
-      "remediation_update_iac": "...",
-      "remediation_remove_source": "..."
-    }}
-  ],
-  "summary": "..."
-}}
-
-STRICT INSTRUCTION:
-- Never ask clarification questions.
-- Always proceed even if some inputs (iac_data, state_data, or cicd_drift) are missing or empty.
-- Only include up to 50 high-risk drifts in the output.
-- Never output explanations, reasoning, or commentary outside the JSON.
-- The output must always be valid JSON following the specified schema.
-""",
-"version": """
-You are an expert in detecting Version / API-Level Drift.
-
-KNOWLEDGE BASE RULES:
-1. IaC Configs (iac_config/{repo_prefix}/)
-   Structure: {{"resource_address": "resource.aws_instance.web", "type": "iac_configuration", "content": "...", "metadata": {{"repo": "{repo_url}"}}}}
-   Search: "iac_configuration {repo_prefix} resource_address"
-   Extract: resource_address, content (for attributes)
-
-2. AWS State (aws_state/{region}/)
-   Structure: {{"id": "AWS__EC2__Instance_i-123", "metadata": {{"resourceType": "AWS::EC2::Instance", "resourceId": "i-123", "resourceName": "web", "status": "ResourceDiscovered"}}, "configuration": {{"InstanceType": "t3.small", "ImageId": "ami-xyz"}}}}
-   Search: "metadata.resourceType AWS configuration"
-   Extract: metadata (type, id, name, status), configuration (attributes)
-   Filter: Exclude status = "ResourceDeleted"
-
-3. Always prioritize AWS Desired State configurations from the directory `aws_state/` in the Knowledge Base when comparing against IaC configurations.
-4. All IaC configurations are located under `iac_config/{repo_prefix}/`, where `{repo_prefix}` corresponds to the current repo = {repo_url}.
-5. For every IaC resource, find the corresponding AWS resource in the AWS Desired State:
-   - Match by resource type, name, or ARN.
-   - If no corresponding resource exists in AWS Desired State, skip comparison.
-6. Do not invent or assume AWS resources that do not exist in the KB.
-7. The Knowledge Base has already been synchronized and contains all available data in both directories: `iac_config/` and `aws_state/`.
-8. Use the Knowledge Base to resolve drift detection as accurately as possible:
-   - Retrieve and correlate related IaC and AWS resource blocks.
-   - Prefer using data from AWS Desired State when conflict or uncertainty occurs.
-9. Only include up to 50 high-risk drifts in the output (risk="high").
-
+5. Compile JSON report (all detected drifts).
+""", with_inputs=False, extra=(OPERATIONAL_RULES,)),
+"version": detector_prompt("version", "You are an expert in detecting Version / API-Level Drift.", """
 Step by Step:
 1. Use the Knowledge Base.
 2. Identify version mismatches or deprecated configs.
 3. Document drifts.
 4. Suggest remediation (update_iac / remove_source).
-5. Compile JSON report (top 50 high-risk drifts).
-
-Output JSON:
-{{
-  "detection_type": "version",
-  "drifted_resources": [
-    {{
-      "resource_address": "...",
-      "issue": "...",
-      "risk": "high",
-      "remediation_update_iac": "...",
-      "remediation_remove_source": "..."
-    }}
-  ],
-  "summary": "..."
-}}
-
-STRICT INSTRUCTION:
-- Never ask clarification questions.
-- Always proceed even if some inputs (iac_data, state_data, or cicd_drift) are missing or empty.
-- Only include up to 50 high-risk drifts in the output.
-- Never output explanations, reasoning, or commentary outside the JSON.
-- The output must always be valid JSON following the specified schema.
-"""
+5. Compile JSON report (all detected drifts).
+""", with_inputs=False),
 }
-results = {
+# field lấy từ event → default (mỗi invocation 1 RequestContext riêng)
+REQUEST_FIELDS = {
     "query": None,
     "type": None,
     "iac_resources": [],
     "aws_state_resources": [],
-    "cicd_drift": {}
-    
+    "cicd_drift": {},
+    "resolved_pairs": [],
+    "resource_fingerprints": {},
+    "target_resources": []
 }
-def extract_detection(obj):
-    if isinstance(obj, dict):
-        for k, v in obj.items():
-            if k == "query":
-                results["query"] = v
-            elif k == "type":
-                results["type"] = v
-            elif k == "iac_resources":
-                results["iac_resources"] = v
-            elif k == "aws_state_resources":
-                results["aws_state_resources"] = v
-            elif k == "cicd_drift":
-                results["cicd_drift"] = v
-            else:
-                extract_detection(v)
-    elif isinstance(obj, list):
-        for item in obj:
-            extract_detection(item)
+# path trong event DriftReportAgentASL: input gốc ở top-level, output input parser
+# ở top-level hoặc dưới ResultPath $.parsed / $.input_parser (Payload tự bóc)
+PARSER_PATHS = "{0}|parsed.{0}|input_parser.{0}"
+REQUEST_SCHEMA = EventSchema({
+    "query": ("query|input.query", str),
+    "type": ("type|input.type|" + PARSER_PATHS.format("type"), str),
+    "iac_resources": (PARSER_PATHS.format("iac_resources"), list),
+    "aws_state_resources": (PARSER_PATHS.format("aws_state_resources"), list),
+    "cicd_drift": (PARSER_PATHS.format("cicd_drift"), dict),
+    "resolved_pairs": (PARSER_PATHS.format("resolved_pairs"), list),
+    "resource_fingerprints": (PARSER_PATHS.format("resource_fingerprints"), dict),
+    "target_resources": (PARSER_PATHS.format("target_resources") + "|input.target_resources", list),
+}, required=("query", "type"))
 
 def extract_repo_url(text: str):
     m = re.search(r"https?://github\.com/[a-zA-Z0-9_\-]+/[a-zA-Z0-9_\-]+", text)
@@ -481,173 +243,296 @@ def extract_repo_url(text: str):
 # === MAIN HANDLER ===
 def lambda_handler(event, context):
     logger.info(f"Received event: {json.dumps(event)[:1000]}...")
-    extract_detection(event)
-    print("results: ", results)
+    ctx = RequestContext.from_event(event, REQUEST_FIELDS, lambda_context=context, schema=REQUEST_SCHEMA)
+    print("request context: ", ctx)
+    if DETECTORS:
+        # 🔀 Chạy nhiều detector trong 1 invocation thay vì fan-out Step Functions
+        return run_detectors(ctx, event.get("detectors") or DETECTORS)
+    if event.get("detection_mode") == "in_process":
+        logger.info(f"detection_mode=in_process ignored: DETECTORS is not set, running {DETECTION_TYPE} only")
+    return run_detection(ctx, DETECTION_TYPE)
+
+# === MULTI-DETECTOR MODE ===
+def run_detectors(ctx: RequestContext, detectors: list):
+    start = time.time()
+    output = {d: {"detection_type": d, "error": f"Unknown detector: {d}"} for d in detectors if d not in PROMPTS}
+    valid = [d for d in dict.fromkeys(detectors) if d in PROMPTS]
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_DETECTOR_WORKERS, len(valid) or 1))) as pool:
+        futures = {pool.submit(run_detection, ctx, d): d for d in valid}
+        for future in as_completed(futures):
+            d = futures[future]
+            try:
+                output[d] = future.result()
+            except Exception as e:
+                logger.error(f"Detector {d} failed: {str(e)}")
+                output[d] = {"detection_type": d, "type": ctx["type"], "drifted_resources": [],
+                             "summary": f"Detector failed: {str(e)}"}
+    logger.info(f"Ran {len(valid)} detectors in-process in {time.time() - start:.3f}s")
+    return output
+
+# === SINGLE DETECTOR ===
+def run_detection(ctx: RequestContext, detection_type: str):
+    incremental = plan_incremental_scan(ctx, detection_type)
+    if incremental and not incremental["changed"]:
+        carried = incremental["carried"]
+        result = {
+            "detection_type": detection_type,
+            "type": ctx["type"],
+            "drifted_resources": carried,
+            "summary": f"No resource changed since last scan; {len(carried)} drifts carried forward"
+        }
+    else:
+        result = detect(ctx, detection_type, incremental)
+        if incremental:
+            finish_incremental_scan(detection_type, incremental, result)
+    # đủ mọi drift, page 2.. lưu ra store để payload không vượt giới hạn
+    return page_result(result, f"{ctx.request_id}/{detection_type}")
+
+def detect(ctx: RequestContext, detection_type: str, incremental: dict = None):
     # Xác định loại xử lý
-    type_ = results["type"]
+    type_ = ctx["type"]
     region="us-east-1"
+    local_drifts = []
     if type_ == "cicd_log":
         # 🟣 Trường hợp CICD log
-        log_text = results["query"]
+        log_text = ctx["query"]
         if not log_text:
             logger.warning("Missing log_text for type=cicd_log")
             log_text = "(empty log)"
-        iac_data = results["iac_resources"]
-        state_data = results["aws_state_resources"]
-        cicd_drift = results["cicd_drift"]
-        prompt = PROMPTS[DETECTION_TYPE].format(
+        iac_data = ctx["iac_resources"]
+        state_data = ctx["aws_state_resources"]
+        # plan lớn: các page drifted sau page 1 nằm trên S3 (cicd_step_state_lambda)
+        cicd_drift = expand_pages(ctx["cicd_drift"], field="drifted")
+        prompt_inputs = dict(
             repo_url="(N/A - CICD log)",
             iac_data="[]",
             state_data="[]",
             cicd_drift=cicd_drift,  # tránh log quá dài,
             repo_prefix="",
-            region=region
+            region=region,
+            kb_context=EMPTY
         )
 
     else:
         # 🟢 Trường hợp full_scan (mặc định)
-        repo_url = extract_repo_url(results["query"].strip())
-        iac_data = results["iac_resources"]
-        state_data = results["aws_state_resources"]
-        cicd_drift = results["cicd_drift"]
+        repo_url = extract_repo_url(ctx["query"].strip())
+        iac_data = ctx["iac_resources"]
+        state_data = ctx["aws_state_resources"]
+        cicd_drift = ctx["cicd_drift"]
         repo_prefix = repo_url.split("/")[-1]
-        prompt = PROMPTS[DETECTION_TYPE].format(
+        resolved_pairs = ctx["resolved_pairs"]
+        changed = None
+        if incremental:
+            # ⚡ Chỉ phân tích resource mới / có fingerprint thay đổi
+            changed = set(incremental["changed"])
+            resolved_pairs = [p for p in resolved_pairs if normalize_address(p["resource_address"]) in changed]
+            iac_data = [a for a in iac_data if normalize_address(a) in changed]
+            state_data = [p["aws_identifier"] for p in resolved_pairs]
+        if resolved_pairs:
+            # cặp IaC ↔ AWS đã match sẵn ở input parser, agent không cần tự tìm
+            iac_data, state_data = pre_resolved_inputs(iac_data, state_data, resolved_pairs)
+        if changed is None and ctx["target_resources"]:
+            changed = {normalize_address(a) for a in ctx["target_resources"]}
+        if detection_type == "normal" and KB_BUCKET:
+            # 🔵 So sánh attribute ở local, chỉ gửi cho agent các cặp không map được
+            local_drifts, unmapped = detect_attribute_drift(*kb_docs(ctx, repo_prefix, region), changed)
+            if not unmapped:
+                return detection_result(detection_type, type_, [], local_drifts)
+            iac_data = [{"resource_address": u["resource_address"], "attributes": u["attributes"]} for u in unmapped]
+            state_data = [u["aws_identifier"] for u in unmapped]
+        prompt_inputs = dict(
             repo_url=repo_url,
             iac_data=iac_data,
             state_data=state_data,
             cicd_drift=cicd_drift,
             repo_prefix=repo_prefix,
-            region=region
+            region=region,
+            kb_context=EMPTY
         )
 
-    logger.info(f"Prompt for {DETECTION_TYPE}: {prompt}...")
-
-    agent_output = invoke_agent(prompt)
-    parsed = extract_json_from_text(agent_output)
-
-    if parsed:
-        parsed["detection_type"] = DETECTION_TYPE
-        parsed["type"] = type_
-        return parsed
+    # 🗜️ input mã hoá gọn (prefix + short id), vượt budget token thì chia shard thay vì cắt bớt
+    fingerprints = {normalize_address(a): fp for a, fp in (ctx["resource_fingerprints"] or {}).items()}
+    compact = CompactInputs(prompt_inputs["iac_data"], prompt_inputs["state_data"], prompt_inputs["cicd_drift"])
+    shards = compact.shards() if PROMPTS[detection_type].has_fragment("inputs") else [{}]
+    if prompt_inputs["repo_prefix"] and KB_BUCKET and PROMPTS[detection_type].has_fragment("retrieved"):
+        # 🔎 document liên quan của từng shard lấy từ index local, đưa thẳng vào prompt
+        index = ctx.memo(("retrieval_index", prompt_inputs["repo_prefix"], region),
+                         lambda: build_index(*kb_docs(ctx, prompt_inputs["repo_prefix"], region), kb_s3))
+        for shard in shards:
+            shard["kb_context"] = index.context(compact.shard_resources(shard)) or EMPTY
+    if len(shards) == 1:
+        outputs = [invoke_detector(detection_type, type_, prompt_inputs, shards[0], False, fingerprints)]
     else:
-        return {
-            "detection_type": DETECTION_TYPE,
-            "type": type_,
-            "drifted_resources": [],
-            "summary": "No drift detected or parsing failed"
-        }
+        # ⚡ các shard chạy song song, giới hạn SHARD_CONCURRENCY lần gọi agent cùng lúc
+        with ThreadPoolExecutor(max_workers=max(1, min(SHARD_CONCURRENCY, len(shards)))) as pool:
+            outputs = list(pool.map(
+                lambda shard: invoke_detector(detection_type, type_, prompt_inputs, shard, True, fingerprints),
+                shards
+            ))
+    for output in outputs:
+        compact.decode_records(output.get("drifted_resources"))
+    return detection_result(detection_type, type_, outputs, local_drifts)
+
+def cache_content(type_: str, prompt_inputs: dict, shard: dict, dropped: list, fingerprints: dict):
+    """
+    Nội dung agent thực sự đọc, đưa vào cache key cùng danh sách address/identifier.
+    None = agent phải tự search KB (nội dung không biết trước) → không cache.
+    """
+    content = {}
+    if shard.get("kb_context") and "retrieved" not in dropped:
+        content["kb_context"] = shard["kb_context"]
+    if fingerprints:
+        # hash IaC block + AWS configuration của từng resource (input parser)
+        content["fingerprints"] = fingerprints
+    if type_ == "cicd_log" and prompt_inputs.get("cicd_drift"):
+        content["cicd_drift"] = prompt_inputs["cicd_drift"]
+    return content or None
+
+def invoke_detector(detection_type: str, type_: str, prompt_inputs: dict, shard: dict, sharded: bool = False,
+                    fingerprints: dict = None):
+    """1 lần gọi agent (1 shard input). Trả output đã parse hoặc {}."""
+    prompt, prompt_report = PROMPTS[detection_type].render(**{**prompt_inputs, **shard})
+    logger.info(f"Prompt for {detection_type}: {prompt}...")
+
+    content = None
+    if PROMPTS[detection_type].has_fragment("inputs"):
+        content = cache_content(type_, prompt_inputs, shard, prompt_report["dropped"], fingerprints)
+    cache_inputs = {"type": type_, **prompt_inputs, **(content or {})}
+    if sharded:
+        cache_inputs["shard"] = shard
+    if prompt_report["dropped"]:
+        cache_inputs["dropped_sections"] = prompt_report["dropped"]
+    # ⚡ drifted_resources được parse dần theo chunk trong lúc agent stream
+    stream = JsonArrayStream(("drifted_resources",), keep_rest=True)
+    streamed = []
+    def on_resource(item):
+        streamed.append(item)
+        if isinstance(item, dict):
+            logger.info(f"[{detection_type}] drift #{len(streamed)}: {item.get('resource_address')} ({item.get('risk')})")
+    call = lambda: invoke_agent(prompt, stream, on_resource, label=detection_type)
+    if content is None:
+        logger.info(f"[{detection_type}] agent searches the KB itself, response not cached")
+        agent_output = call()
+    else:
+        agent_output = cached_agent_call(
+            detection_type, template_version(PROMPT_VERSION, PROMPTS[detection_type].text), cache_inputs, call
+        )
+    if agent_failed(agent_output):
+        logger.error(f"[{detection_type}] {agent_output}; partial output discarded")
+        return {}
+    if stream.failed:
+        logger.warning(f"[{detection_type}] streamed JSON invalid ({stream.error}), repairing full output")
+    if stream.done and not stream.failed:
+        # chỉ còn parse phần ngoài drifted_resources (summary...)
+        parsed = extract_json_from_text(stream.rest())
+        if isinstance(parsed, dict):
+            parsed["drifted_resources"] = streamed
+    else:
+        # cache hit, output bị cắt hoặc phần tử lỗi → parse + sửa cả text
+        parsed = extract_json_from_text(agent_output)
+    return parsed if isinstance(parsed, dict) else {}
+
+# === PRE-RESOLVED PAIRS ===
+def pre_resolved_inputs(iac_data, state_data, resolved_pairs):
+    matched = {p["resource_address"] for p in resolved_pairs}
+    matched_ids = {p["aws_identifier"] for p in resolved_pairs}
+    iac_data = list(resolved_pairs) + [a for a in iac_data or [] if a not in matched]
+    state_data = [i for i in state_data or [] if i not in matched_ids]
+    return iac_data, state_data
+
+# === INCREMENTAL SCAN ===
+def plan_incremental_scan(ctx: RequestContext, detection_type: str):
+    fingerprints = ctx["resource_fingerprints"]
+    if ctx["type"] != "full_scan" or not fingerprints or fingerprint_store is None:
+        return None
+    if not PROMPTS[detection_type].has_fragment("inputs"):
+        # agent tự tìm toàn bộ drift trong KB → verdict carry sang sẽ bị trùng
+        return None
+    repo_prefix = extract_repo_url(ctx["query"].strip()).split("/")[-1]
+    try:
+        stored = fingerprint_store.load(repo_prefix, detection_type)
+    except Exception as e:
+        logger.warning(f"Fingerprint store unavailable, full scan: {str(e)}")
+        return None
+    changed, carried, removed = split_changed(fingerprints, stored)
+    if ctx["target_resources"]:
+        # 🎯 scan có mục tiêu: resource vừa đổi luôn phân tích lại (snapshot có thể chưa kịp),
+        # không carry / xoá fingerprint của resource nằm ngoài mục tiêu
+        changed, carried, removed = [normalize_address(a) for a in fingerprints], [], []
+    logger.info(
+        f"Incremental scan {detection_type}: {len(changed)} changed, "
+        f"{len(fingerprints) - len(changed)} unchanged, {len(removed)} removed"
+    )
+    fingerprints = {normalize_address(a): fp for a, fp in fingerprints.items()}
+    return {"repo": repo_prefix, "fingerprints": fingerprints, "changed": changed,
+            "carried": carried, "removed": removed}
+
+def finish_incremental_scan(detection_type: str, incremental: dict, result: dict):
+    new_drifts = result.get("drifted_resources") or []
+    verdicts = group_by_address(new_drifts, incremental["changed"])
+    attributed = sum(len(v) for v in verdicts.values())
+    result["drifted_resources"] = new_drifts + incremental["carried"]
+    result["incremental"] = {"changed": len(incremental["changed"]), "carried_forward": len(incremental["carried"])}
+    if attributed < len(new_drifts) or result.get("failed_shards") or "parsing failed" in str(result.get("summary", "")):
+        # không map được verdict về resource → không ghi, lần sau phân tích lại
+        logger.warning(f"Skip fingerprint update for {detection_type}: unattributed or failed output")
+        return
+    try:
+        fingerprint_store.save(
+            incremental["repo"], detection_type,
+            {a: incremental["fingerprints"][a] for a in incremental["changed"]},
+            verdicts, incremental["removed"]
+        )
+    except Exception as e:
+        logger.warning(f"Fingerprint store update failed: {str(e)}")
+
+# === KB DOCUMENTS (1 lần / invocation, dùng chung cho attribute diff và retrieval index) ===
+def kb_docs(ctx: RequestContext, repo_prefix: str, region: str):
+    return ctx.memo(("kb_docs", repo_prefix, region),
+                    lambda: (load_iac_documents(repo_prefix), load_state_documents(region)))
+
+# === LOCAL ATTRIBUTE DIFF (normal) ===
+def detect_attribute_drift(iac_docs: list, state_docs: list, only_addresses: set = None):
+    start = time.time()
+    if only_addresses is not None:
+        iac_docs = [d for d in iac_docs if normalize_address(d["resource_address"]) in only_addresses]
+    drifted, unmapped = compare_resources(iac_docs, state_docs, ResourceResolver(state_docs=state_docs))
+    logger.info(
+        f"Local attribute diff: {len(iac_docs)} IaC / {len(state_docs)} AWS docs, "
+        f"{len(drifted)} drifts, {len(unmapped)} unmapped in {time.time() - start:.3f}s"
+    )
+    return drifted, unmapped
 
 # === INVOKE AGENT ===
-def invoke_agent(question: str):
+def invoke_agent(question: str, stream: JsonArrayStream = None, on_item=None, label: str = DETECTION_TYPE):
+    """
+    Gọi agent; nếu có `stream` thì feed từng chunk, gọi on_item(item) ngay khi
+    một phần tử của mảng đóng, và ngừng đọc khi object gốc đã đóng.
+    """
     print("start invoke agent=========")
-    full_output = ""
+    assembler = ChunkAssembler(f"detect-{label}")
     try:
         response = bedrock.invoke_agent(
             agentId=AGENT_ID,
             agentAliasId=AGENT_ALIAS_ID,
-            sessionId=str(int(time.time())),
+            sessionId=f"{int(time.time())}-{uuid.uuid4().hex[:8]}",
             inputText=question
         )
         print("response:", response)
         for event in response["completion"]:
-            if "chunk" in event:
-                full_output += event["chunk"]["bytes"].decode("utf-8")
-        print(full_output)
-    except Exception as e:
-        logger.error(f"Agent invoke error: {str(e)}")
-    return full_output
-
-# === EXTRACT JSON ===
-def extract_json_from_text(text: str):
-    try:
-        print("=== [TRACE] START extract_json_from_text ===")
-        full_text = text.strip()
-        print(f"[TRACE] Raw : {full_text}")
-
-        # === B1: ƯU TIÊN TÌM JSON OBJECT { ... } ===
-        start_obj = full_text.find('{')
-        end_obj = full_text.rfind('}') + 1
-
-        if start_obj != -1 and end_obj > start_obj:
-            json_str = full_text[start_obj:end_obj]
-            is_array = False
-            print(f"[TRACE] Found JSON object: {len(json_str)} chars")
-        else:
-            # Nếu không có object, thử array
-            start_arr = full_text.find('[')
-            end_arr = full_text.rfind(']') + 1
-            if start_arr != -1 and end_arr > start_arr:
-                json_str = full_text[start_arr:end_arr]
-                is_array = True
-                print(f"[TRACE] Found JSON array: {len(json_str)} chars")
-            else:
-                print("[TRACE] No JSON found")
-                return {}
-
-        # === B2: Fix content bị cắt ===
-        fixed = ""
-        i = 0
-        in_content = False
-
-        while i < len(json_str):
-            if not in_content and json_str[i:i+10] == '"content":':
-                in_content = True
-                fixed += json_str[i:i+10]
-                i += 10
-                quote = json_str.find('"', i)
-                if quote == -1:
-                    fixed += ' ""'
-                    break
-                fixed += json_str[i:quote+1]
-                i = quote + 1
+            text = assembler.add_event(event)
+            if stream is None or not text:
                 continue
-
-            if in_content and json_str[i] == '"' and json_str[i-1] != '\\':
-                next_part = json_str[i+1:i+5]
-                if any(x in next_part for x in [',', '}', '\n', '\r']):
-                    in_content = False
-            fixed += json_str[i]
-            i += 1
-
-        if in_content:
-            fixed += '"INCOMPLETE"'
-
-        json_str = fixed
-
-        # === B3: Dọn phẩy thừa + đóng ngoặc ===
-        json_str = re.sub(r',\s*([\]}])', r'\1', json_str)
-        json_str = re.sub(r',\s*$', '', json_str)
-
-        open_b = json_str.count('{')
-        close_b = json_str.count('}')
-        open_br = json_str.count('[')
-        close_br = json_str.count(']')
-
-        while open_b > close_b:
-            json_str += '}'
-            close_b += 1
-        while open_br > close_br:
-            json_str += ']'
-            close_br += 1
-
-        print(f"[TRACE] Final JSON: {json_str}")
-
-        # === B4: Parse ===
-        try:
-            data = json.loads(json_str)
-            if is_array:
-                print(f"[TRACE] Parsed array: {len(data)} items")
-                return data
-            else:
-                print(f"[TRACE] Parsed object: {list(data.keys())}")
-                return data
-        except json.JSONDecodeError as e:
-            print(f"[TRACE] JSON Error: {e}")
-            print(f"[TRACE] JSON string:\n{json_str[:600]}")
-            return {}  # Luôn trả object nếu là object
-
+            for _, item in stream.feed(text):
+                if on_item:
+                    on_item(item)
+            if stream.done:
+                logger.info(f"Agent JSON closed after {stream.chars_read} chars, stop reading")
+                response["completion"].close()
+                break
     except Exception as e:
-        print(f"[TRACE] Exception: {e}")
-        return {}
-    finally:
-        print("=== [TRACE] END extract_json_from_text ===")
\ No newline at end of file
+        # text đang ghép dở không phải verdict hợp lệ → marker lỗi (agent_cache không lưu)
+        logger.error(f"Agent invoke error: {str(e)} ({len(assembler.text())} chars received)")
+        return f"Agent invoke error: {str(e)}"
+    assembler.log_stats()
+    return assembler.text()
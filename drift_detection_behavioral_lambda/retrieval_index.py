@@ -0,0 +1,275 @@
+# ========================================
+# retrieval_index.py — INDEX TRUY XUẤT TRONG PROCESS (BM25 + COSINE TUỲ CHỌN) TRÊN DOCUMENT iac_config / aws_state
+# ========================================
+import io
+import os
+import re
+import json
+import math
+import heapq
+import logging
+from prompt_builder import estimate_tokens
+from resource_resolver import RESOURCE_TYPE_MAPPING, document_identifier, iac_name_hints, normalize_address, split_address
+
+try:
+    import numpy as np
+except ImportError:   # cosine search là tuỳ chọn, thiếu numpy thì chỉ dùng BM25
+    np = None
+
+logger = logging.getLogger()
+
+# số document aws_state ứng viên cho IaC chưa có aws_identifier; 0 = chỉ lấy document khớp chính xác
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "2"))
+# token tối đa của phần document chọn sẵn / shard; 0 = không giới hạn
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get("RETRIEVAL_TOKEN_BUDGET", "3000"))
+RETRIEVAL_BLOCK_CHARS = int(os.environ.get("RETRIEVAL_BLOCK_CHARS", "1500"))
+# s3://bucket/key.npz với mảng "ids" + "vectors" (embedding tính sẵn của document); rỗng = chỉ BM25
+RETRIEVAL_EMBEDDINGS_URI = os.environ.get("RETRIEVAL_EMBEDDINGS_URI", "")
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60    # reciprocal rank fusion khi có cả BM25 và cosine
+# ứng viên có score < tỉ lệ này × score tốt nhất (vd chỉ khớp resource type) bị bỏ
+CANDIDATE_SCORE_RATIO = 0.5
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:-[a-z0-9]+)*")
+
+
+def tokenize(text: str):
+    """'AWS__EC2__Instance_i-0ab' → aws, ec2, instance, i-0ab, i, 0ab"""
+    tokens = []
+    for token in TOKEN_RE.findall(str(text).lower()):
+        tokens.append(token)
+        if "-" in token:
+            tokens.extend(token.split("-"))
+    return tokens
+
+
+def _compact(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), sort_keys=True, default=str)
+
+
+# === DOCUMENT → TEXT ===
+def iac_text(doc: dict):
+    attributes = doc.get("attributes")
+    return " ".join([doc["resource_address"], doc.get("content") or "", _compact(attributes) if attributes else ""])
+
+
+def state_text(doc: dict):
+    meta = doc.get("metadata") or {}
+    return " ".join([
+        document_identifier(doc),
+        " ".join(str(v) for v in meta.values() if v),
+        _compact(doc.get("configuration") or {}),
+        _compact(doc.get("tags") or {}),
+    ])
+
+
+def iac_block(doc: dict):
+    body = doc.get("content") or _compact(doc.get("attributes") or {})
+    return body.strip()
+
+
+def state_block(doc: dict):
+    return _compact({"metadata": doc.get("metadata") or {}, "configuration": doc.get("configuration") or {}})
+
+
+def iac_query(doc_or_address):
+    """Query tìm document aws_state cho 1 resource IaC: AWS type + tên + name hint trong content."""
+    doc = doc_or_address if isinstance(doc_or_address, dict) else {"resource_address": doc_or_address}
+    tf_type, name = split_address(normalize_address(doc["resource_address"]))
+    terms = [RESOURCE_TYPE_MAPPING.get(tf_type, tf_type or ""), name]
+    for key, value in iac_name_hints(doc).items():
+        terms.append(value.get("Name", "") if key == "tags" and isinstance(value, dict) else str(value))
+    return " ".join(t for t in terms if t)
+
+
+# === INDEX ===
+class RetrievalIndex:
+    """
+    Inverted index (term → {doc: tf}) + BM25 trên document iac_config và aws_state
+    của 1 scan; tuỳ chọn ma trận embedding đã chuẩn hoá để tìm theo cosine (numpy).
+    Document được tra chính xác theo resource_address / aws_identifier trước,
+    BM25/cosine chỉ dùng cho resource IaC chưa biết identifier.
+    """
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.ids = []           # doc index -> (kind, doc id)
+        self.docs = []
+        self.lengths = []
+        self.postings = {}      # term -> {doc index: tf}
+        self.by_key = {}        # (kind, doc id) -> doc index
+        self.vectors = None     # np.ndarray [n_docs, dim] đã chuẩn hoá (hàng 0 = không có embedding)
+
+    @classmethod
+    def from_documents(cls, iac_docs=(), state_docs=()):
+        index = cls()
+        for doc in iac_docs:
+            if doc.get("resource_address"):
+                index.add("iac", normalize_address(doc["resource_address"]), doc, iac_text(doc))
+        for doc in state_docs:
+            index.add("state", document_identifier(doc), doc, state_text(doc))
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, kind: str, doc_id: str, doc: dict, text: str):
+        key = (kind, doc_id)
+        if key in self.by_key:
+            return self.by_key[key]
+        i = len(self.ids)
+        self.ids.append(key)
+        self.docs.append(doc)
+        self.by_key[key] = i
+        tokens = tokenize(text)
+        self.lengths.append(len(tokens))
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            self.postings.setdefault(token, {})[i] = tf
+        return i
+
+    def get(self, kind: str, doc_id: str):
+        i = self.by_key.get((kind, normalize_address(doc_id) if kind == "iac" else doc_id))
+        return None if i is None else self.docs[i]
+
+    # --- BM25 ---
+    def bm25(self, query: str, kind: str = None):
+        n = len(self.ids)
+        if not n:
+            return {}
+        avg_length = sum(self.lengths) / n or 1
+        scores = {}
+        for term in dict.fromkeys(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for i, tf in posting.items():
+                if kind and self.ids[i][0] != kind:
+                    continue
+                norm = tf + self.k1 * (1 - self.b + self.b * self.lengths[i] / avg_length)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return scores
+
+    # --- COSINE ---
+    def load_embeddings(self, ids, vectors):
+        """ids: doc id (identifier / resource_address), vectors: [len(ids), dim]."""
+        if np is None:
+            logger.warning("numpy is not available, retrieval index uses BM25 only")
+            return 0
+        vectors = np.asarray(vectors, dtype=np.float32)
+        matrix = np.zeros((len(self.ids), vectors.shape[1]), dtype=np.float32)
+        rows = {doc_id: i for i, (_, doc_id) in enumerate(self.ids)}
+        loaded = 0
+        for doc_id, vector in zip(ids, vectors):
+            i = rows.get(normalize_address(str(doc_id)))
+            if i is not None:
+                matrix[i] = vector
+                loaded += 1
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.vectors = matrix / np.where(norms == 0, 1, norms)
+        return loaded
+
+    def vector(self, kind: str, doc_id: str):
+        i = self.by_key.get((kind, doc_id))
+        if self.vectors is None or i is None or not self.vectors[i].any():
+            return None
+        return self.vectors[i]
+
+    def cosine(self, vector, kind: str = None, k: int = 10):
+        similarities = self.vectors @ vector
+        if kind:
+            mask = np.fromiter((key[0] == kind for key in self.ids), dtype=bool, count=len(self.ids))
+            similarities = np.where(mask, similarities, -np.inf)
+        k = min(k, len(self.ids))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        return {int(i): float(similarities[i]) for i in top if np.isfinite(similarities[i])}
+
+    # --- SEARCH ---
+    def search(self, query: str, k: int = 5, kind: str = None, vector=None):
+        """[(kind, doc id, score)] tốt nhất; có vector → gộp BM25 + cosine bằng reciprocal rank fusion."""
+        scores = self.bm25(query, kind)
+        if vector is not None and self.vectors is not None:
+            fused = {}
+            dense = self.cosine(vector, kind, k * 4)
+            for ranking in (scores, dense):
+                ranked = heapq.nlargest(k * 4, ranking.items(), key=lambda x: x[1])
+                for rank, (i, _) in enumerate(ranked):
+                    fused[i] = fused.get(i, 0.0) + 1.0 / (RRF_K + rank + 1)
+            scores = fused
+        return [(*self.ids[i], score) for i, score in heapq.nlargest(k, scores.items(), key=lambda x: x[1])]
+
+    # --- CHỌN SẴN DOCUMENT CHO PROMPT ---
+    def context(self, resources: dict, top_k: int = None, budget_tokens: int = None):
+        """
+        resources: short id → {"resource_address", "aws_identifier"} (input của 1 shard).
+        Trả text các block document liên quan, theo thứ tự input, dừng khi hết budget.
+        """
+        top_k = RETRIEVAL_TOP_K if top_k is None else top_k
+        budget = RETRIEVAL_TOKEN_BUDGET if budget_tokens is None else budget_tokens
+        blocks, seen, used, skipped = [], set(), 0, 0
+        for short_id, resource in resources.items():
+            for label, kind, doc_id, doc in self._resource_documents(short_id, resource, top_k):
+                if (kind, doc_id) in seen:
+                    continue
+                seen.add((kind, doc_id))
+                body = iac_block(doc) if kind == "iac" else state_block(doc)
+                if len(body) > RETRIEVAL_BLOCK_CHARS:
+                    body = body[:RETRIEVAL_BLOCK_CHARS] + "...(truncated)"
+                block = f"[{label}] {'iac_config' if kind == 'iac' else 'aws_state'} {doc_id}:\n{body}"
+                tokens = estimate_tokens(block) + 1
+                if budget and used + tokens > budget:
+                    skipped += 1
+                    continue
+                blocks.append(block)
+                used += tokens
+        if skipped:
+            logger.info(f"Retrieval context: {len(blocks)} blocks ({used} tokens), {skipped} over budget left to KB search")
+        return "\n".join(blocks)
+
+    def _resource_documents(self, short_id: str, resource: dict, top_k: int):
+        address = normalize_address(resource.get("resource_address"))
+        aws_id = resource.get("aws_identifier")
+        iac_doc = self.get("iac", address) if address else None
+        if iac_doc is not None:
+            yield short_id, "iac", address, iac_doc
+        if aws_id:
+            state_doc = self.get("state", aws_id)
+            if state_doc is not None:
+                yield short_id, "state", aws_id, state_doc
+        elif address and top_k:
+            # chưa biết identifier → ứng viên aws_state theo BM25 (+ cosine với embedding của IaC)
+            query = iac_query(iac_doc or address)
+            candidates = self.search(query, top_k, "state", self.vector("iac", address))
+            for _, doc_id, score in candidates:
+                if score >= candidates[0][2] * CANDIDATE_SCORE_RATIO:
+                    yield f"{short_id} candidate", "state", doc_id, self.get("state", doc_id)
+
+
+def load_embeddings(s3, uri: str = RETRIEVAL_EMBEDDINGS_URI):
+    """(ids, vectors) từ file .npz trên S3; None nếu không cấu hình / không có numpy."""
+    if not uri or np is None:
+        return None
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    data = np.load(io.BytesIO(body), allow_pickle=False)
+    return [str(i) for i in data["ids"]], data["vectors"]
+
+
+def build_index(iac_docs, state_docs, s3=None):
+    index = RetrievalIndex.from_documents(iac_docs, state_docs)
+    if s3 is not None:
+        try:
+            embeddings = load_embeddings(s3)
+            if embeddings:
+                loaded = index.load_embeddings(*embeddings)
+                logger.info(f"Retrieval index: {loaded} cached embeddings loaded")
+        except Exception as e:
+            logger.warning(f"Cached embeddings unavailable, BM25 only: {str(e)}")
+    logger.info(f"Retrieval index: {len(index)} documents, {len(index.postings)} terms")
+    return index
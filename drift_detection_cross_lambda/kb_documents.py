@@ -0,0 +1,56 @@
+# ========================================
+# kb_documents.py — ĐỌC TRỰC TIẾP DOCUMENT CỦA KB TỪ S3 DATA SOURCE
+# ========================================
+import os
+import json
+import logging
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+KB_BUCKET = os.environ.get("KB_BUCKET", "")
+# get_object song song (1 document / resource nên 1 prefix có thể hàng nghìn object)
+KB_LOAD_CONCURRENCY = int(os.environ.get("KB_LOAD_CONCURRENCY", "16"))
+
+s3 = boto3.client("s3")
+
+
+def list_keys(prefix: str):
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=KB_BUCKET, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if not obj["Key"].endswith("/"):
+                yield obj["Key"]
+
+
+def read_document(key: str):
+    body = s3.get_object(Bucket=KB_BUCKET, Key=key)["Body"].read()
+    try:
+        data = json.loads(body)
+    except ValueError:
+        logger.warning(f"Skip non-JSON KB document: {key}")
+        return []
+    return data if isinstance(data, list) else [data]
+
+
+def load_documents(prefix: str, concurrency: int = KB_LOAD_CONCURRENCY):
+    """Mỗi object là 1 document JSON hoặc 1 mảng document; giữ thứ tự key."""
+    keys = list(list_keys(prefix))
+    if concurrency > 1 and len(keys) > 1:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(keys))) as pool:
+            parts = list(pool.map(read_document, keys))
+    else:
+        parts = [read_document(key) for key in keys]
+    return [doc for part in parts for doc in part]
+
+
+def load_iac_documents(repo_prefix: str):
+    return [d for d in load_documents(f"iac_config/{repo_prefix}/") if d.get("resource_address")]
+
+
+def load_state_documents(region: str):
+    return [
+        d for d in load_documents(f"aws_state/{region}/")
+        if (d.get("metadata") or {}).get("status") != "ResourceDeleted"
+    ]
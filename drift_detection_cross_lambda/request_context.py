@@ -0,0 +1,81 @@
+# ========================================
+# request_context.py — DỮ LIỆU RIÊNG CỦA TỪNG INVOCATION (THAY CHO DICT `results` GLOBAL)
+# ========================================
+import copy
+import uuid
+import threading
+
+
+class RequestContext:
+    """
+    Giá trị lấy từ event của 1 invocation. Mỗi request tạo context mới từ
+    `fields` (field → default), nên warm container không mang giá trị của
+    lần gọi trước sang, và nhiều scan chạy song song (thread/asyncio) không
+    ghi đè lẫn nhau. `aliases`: key trong event → tên field (mặc định key = field).
+    """
+
+    def __init__(self, fields: dict, aliases: dict = None, request_id: str = None):
+        self.fields = fields
+        self.aliases = aliases or {}
+        self.request_id = request_id or uuid.uuid4().hex
+        self.values = {k: copy.deepcopy(v) for k, v in fields.items()}
+        self.report = None
+        self._memo = {}
+        self._memo_lock = threading.RLock()
+
+    @classmethod
+    def from_event(cls, event, fields: dict, aliases: dict = None, lambda_context=None, schema=None):
+        """
+        Có `schema` (event_schema.EventSchema): tra đúng các path khai báo;
+        chỉ khi event có shape lạ mới duyệt cả event cho các field còn thiếu.
+        """
+        ctx = cls(fields, aliases, getattr(lambda_context, "aws_request_id", None))
+        if schema is None:
+            ctx.extract(event)
+            return ctx
+        values, ctx.report = schema.extract(event)
+        ctx.values.update(values)
+        if schema.needs_fallback(ctx.report):
+            walked = cls(fields, aliases)
+            walked.extract(event)
+            for name in list(ctx.report.missing):
+                if walked.values[name] != fields[name]:
+                    ctx.values[name] = walked.values[name]
+                    ctx.report.fallback.append(name)
+        ctx.report.log(f"request {ctx.request_id}")
+        return ctx
+
+    def extract(self, obj):
+        """Duyệt event, gán field theo key (key trùng → giá trị gặp sau cùng)."""
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                field = self.aliases.get(k) if self.aliases else (k if k in self.fields else None)
+                if field is not None:
+                    self.values[field] = v
+                else:
+                    self.extract(v)
+        elif isinstance(obj, list):
+            for item in obj:
+                self.extract(item)
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def memo(self, key, build):
+        """Giá trị tính 1 lần / invocation (vd document KB), dùng chung giữa các thread của request."""
+        with self._memo_lock:
+            if key not in self._memo:
+                self._memo[key] = build()
+            return self._memo[key]
+
+    def as_dict(self):
+        return dict(self.values)
+
+    def __repr__(self):
+        return f"RequestContext({self.request_id}, {self.values})"
@@ -0,0 +1,238 @@
+# ========================================
+# attribute_drift.py — SO SÁNH ATTRIBUTE IaC vs AWS CONFIG (KHÔNG CẦN LLM)
+# ========================================
+import json
+import re
+from resource_resolver import RESOURCE_TYPE_MAPPING, ResourceResolver, document_tags, split_address
+
+# Terraform attribute → đường dẫn trong AWS Config `configuration`.
+# Attribute không có ở đây được so bằng tên chuẩn hoá (instance_type ~ InstanceType).
+ATTRIBUTE_MAPPING = {
+    "aws_instance": {
+        "ami": "imageId",
+        "vpc_security_group_ids": "securityGroups[].groupId",
+        "iam_instance_profile": "iamInstanceProfile.arn",
+        "availability_zone": "placement.availabilityZone",
+        "monitoring": "monitoring.state",
+    },
+    "aws_s3_bucket": {
+        "bucket": "name",
+    },
+    "aws_security_group": {
+        "name": "groupName",
+    },
+    "aws_db_instance": {
+        "identifier": "dBInstanceIdentifier",
+        "instance_class": "dBInstanceClass",
+        "db_name": "dBName",
+        "username": "masterUsername",
+        "vpc_security_group_ids": "vpcSecurityGroups[].vpcSecurityGroupId",
+    },
+    "aws_vpc": {
+        "enable_dns_support": "enableDnsSupport",
+        "enable_dns_hostnames": "enableDnsHostnames",
+    },
+}
+
+# Meta-argument của Terraform, không có trên AWS
+IGNORED_ATTRIBUTES = {"count", "for_each", "depends_on", "lifecycle", "provider", "timeouts", "tags_all"}
+
+HIGH_RISK_ATTRIBUTES = {
+    "ami", "instance_type", "vpc_security_group_ids", "subnet_id", "associate_public_ip_address",
+    "publicly_accessible", "storage_encrypted", "kms_key_id", "iam_instance_profile",
+    "cidr_block", "instance_class", "engine_version", "deletion_protection",
+}
+
+ASSIGN_RE = re.compile(r'^\s*"?([\w\-]+)"?\s*=\s*(.*?)\s*$')
+BLOCK_RE = re.compile(r'^\s*([\w\-]+)\s*\{\s*$')
+NUMBER_RE = re.compile(r"^-?\d+(\.\d+)?$")
+
+
+class Unresolved:
+    """Giá trị là expression (var.x, aws_vpc.main.id, ...) — không so được ở local."""
+
+    def __init__(self, expr):
+        self.expr = expr
+
+
+# === PARSE IaC CONTENT ===
+def parse_iac_attributes(doc: dict):
+    if isinstance(doc.get("attributes"), dict):
+        return dict(doc["attributes"])
+    content = doc.get("content") or ""
+    attrs = {}
+    depth = 0
+    nested_name = None
+    nested = {}
+    for line in content.splitlines():
+        stripped = line.split("#", 1)[0].strip()
+        if not stripped:
+            continue
+        if depth == 0:
+            if stripped.startswith("resource") and stripped.endswith("{"):
+                depth = 1
+            continue
+        if depth == 1:
+            m = ASSIGN_RE.match(stripped)
+            if m and m.group(2) in ("{", "["):
+                nested_name, nested = m.group(1), {}
+                depth = 2
+                continue
+            if m:
+                attrs[m.group(1)] = parse_literal(m.group(2))
+                continue
+            m = BLOCK_RE.match(stripped)
+            if m:
+                attrs[m.group(1)] = Unresolved(m.group(1) + " block")
+                nested_name = None
+                depth = 2
+                continue
+            if stripped == "}":
+                break
+            continue
+        # depth >= 2: chỉ giữ map đơn giản (tags = { Name = "web" })
+        depth += stripped.count("{") + stripped.count("[") - stripped.count("}") - stripped.count("]")
+        if depth == 2 and nested_name:
+            m = ASSIGN_RE.match(stripped)
+            if m:
+                nested[m.group(1)] = parse_literal(m.group(2))
+        if depth <= 1:
+            if nested_name:
+                attrs[nested_name] = nested if nested else Unresolved(nested_name)
+            nested_name = None
+            depth = 1
+    return attrs
+
+
+def parse_literal(raw: str):
+    raw = raw.rstrip(",").strip()
+    if raw in ("true", "false"):
+        return raw == "true"
+    if NUMBER_RE.match(raw):
+        return float(raw) if "." in raw else int(raw)
+    if (raw.startswith('"') and raw.endswith('"')) or (raw.startswith("[") and raw.endswith("]")):
+        if "${" in raw:
+            return Unresolved(raw)
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return Unresolved(raw)
+    return Unresolved(raw)
+
+
+# === LẤY GIÁ TRỊ TỪ AWS CONFIG ===
+def normalize_key(name: str):
+    return name.replace("_", "").replace("-", "").lower()
+
+
+def lookup_config(configuration, path: str):
+    """Hỗ trợ 'a.b' và 'a[].b' (trả list)."""
+    values = [configuration]
+    for part in path.split("."):
+        is_list = part.endswith("[]")
+        key = normalize_key(part[:-2] if is_list else part)
+        next_values = []
+        for value in values:
+            if not isinstance(value, dict):
+                continue
+            found = next((v for k, v in value.items() if normalize_key(k) == key), None)
+            if found is None:
+                continue
+            if is_list and isinstance(found, list):
+                next_values.extend(found)
+            else:
+                next_values.append(found)
+        if not next_values:
+            return None
+        values = next_values
+    if "[]" in path:
+        return values
+    return values[0]
+
+
+def is_structured(value):
+    """dict hoặc list chứa dict/list — shape AWS khác HCL, để agent so."""
+    if isinstance(value, dict):
+        return True
+    return isinstance(value, list) and any(isinstance(v, (dict, list)) for v in value)
+
+
+def comparable(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (list, tuple)):
+        # phần tử có thể là dict → sort theo JSON, không so trực tiếp
+        return sorted((comparable(v) for v in value), key=lambda v: json.dumps(v, sort_keys=True, default=str))
+    if isinstance(value, dict):
+        return {str(k): comparable(v) for k, v in value.items()}
+    if value is None:
+        return None
+    return str(value)
+
+
+# === ENGINE ===
+def compare_resources(iac_docs: list, state_docs: list, resolver: ResourceResolver = None):
+    """
+    Trả về (drifted_resources, unmapped):
+    - drifted_resources: record cùng schema với output của agent
+    - unmapped: cặp resource có attribute không so được ở local → gửi cho LLM
+    """
+    resolver = resolver or ResourceResolver(state_docs=state_docs)
+
+    drifted, unmapped = [], []
+    for iac_doc in iac_docs:
+        address = iac_doc["resource_address"]
+        tf_type, _ = split_address(address)
+        if tf_type not in RESOURCE_TYPE_MAPPING:
+            continue
+        attrs = parse_iac_attributes(iac_doc)
+        identifier = resolver.match(address, attrs)
+        state_doc = resolver.document(identifier) if identifier else None
+        if not state_doc:
+            continue  # không có trên AWS Desired State → bỏ qua (rule 5)
+
+        configuration = state_doc.get("configuration") or {}
+        mapping = ATTRIBUTE_MAPPING.get(tf_type, {})
+        unknown = []
+        for attr, iac_value in attrs.items():
+            if attr in IGNORED_ATTRIBUTES:
+                continue
+            if attr == "tags":
+                drifted.extend(compare_tags(address, iac_value, document_tags(state_doc)))
+                continue
+            aws_value = lookup_config(configuration, mapping.get(attr, attr))
+            if isinstance(iac_value, Unresolved) or aws_value is None or is_structured(aws_value):
+                unknown.append(attr)
+                continue
+            if comparable(iac_value) != comparable(aws_value):
+                drifted.append(drift_record(address, attr, iac_value, aws_value))
+
+        if unknown:
+            unmapped.append({
+                "resource_address": address,
+                "aws_identifier": identifier,
+                "attributes": unknown,
+            })
+    return drifted, unmapped
+
+
+def compare_tags(address: str, iac_tags, aws_tags: dict):
+    if not isinstance(iac_tags, dict):
+        return []
+    records = []
+    for key, value in iac_tags.items():
+        if isinstance(value, Unresolved):
+            continue
+        if comparable(value) != comparable(aws_tags.get(key)):
+            records.append(drift_record(address, f'tags["{key}"]', value, aws_tags.get(key), risk="medium"))
+    return records
+
+
+def drift_record(address: str, attr: str, iac_value, aws_value, risk: str = None):
+    return {
+        "resource_address": address,
+        "issue": f"{attr} mismatch: IaC={json.dumps(iac_value)} AWS={json.dumps(aws_value)}",
+        "risk": risk or ("high" if attr in HIGH_RISK_ATTRIBUTES else "medium"),
+        "remediation_update_iac": f"Update {attr} = {json.dumps(aws_value)} in {address}",
+        "remediation_remove_source": f"Re-apply {address} to restore {attr} = {json.dumps(iac_value)} on AWS",
+    }
@@ -0,0 +1,193 @@
+# ========================================
+# prompt_serializer.py — ĐƯA iac_data / state_data / cicd_drift VÀO PROMPT DẠNG GỌN + CHIA SHARD THEO TOKEN
+# ========================================
+import os
+import re
+import json
+import logging
+from prompt_builder import estimate_tokens
+
+logger = logging.getLogger()
+
+# token tối đa cho phần input của 1 prompt (InvokeAgent giới hạn inputText 25.000 ký tự)
+PROMPT_INPUT_TOKEN_BUDGET = int(os.environ.get("PROMPT_INPUT_TOKEN_BUDGET", "4000"))
+# số resource tối đa / shard (giới hạn cả độ dài output của 1 lần gọi agent)
+PROMPT_SHARD_MAX_RESOURCES = int(os.environ.get("PROMPT_SHARD_MAX_RESOURCES", "40"))
+MIN_PREFIX_USES = 2
+
+PREFIX_REF_RE = re.compile(r"^p(\d+)/(.*)$", re.S)
+EMPTY = "(none)"
+
+
+def split_prefix(value: str):
+    """module.x.aws_instance.web → ("module.x.aws_instance.", "web"); AWS__EC2__Instance_i-1 → ("AWS__EC2__Instance_", "i-1")"""
+    i = value.rfind("__")
+    if i != -1:
+        j = value.find("_", i + 2)
+        return (value[:j + 1], value[j + 1:]) if j != -1 else ("", value)
+    bracket = value.find("[")
+    base = value if bracket == -1 else value[:bracket]
+    cut = base.rfind(".")
+    return (value[:cut + 1], value[cut + 1:]) if cut != -1 else ("", value)
+
+
+class CompactInputs:
+    """
+    Mã hoá input của detector:
+    - prefix lặp lại (module.../resource type, AWS type) → bảng từ điển p1, p2...
+      và tham chiếu "p1/web"
+    - mỗi resource có short id (r1 IaC, s1 AWS, c1 CICD drift, u1 unmanaged);
+      agent trả short id trong resource_address, decode_records() đổi lại.
+    Vượt budget → chia shard theo dòng (không cắt bớt resource nào).
+    """
+
+    def __init__(self, iac_data=None, state_data=None, cicd_drift=None):
+        self.lines = []             # (section, id, refs, parts): part int = index của ref cần encode
+        self.resources = {}         # short id -> {"resource_address", "aws_identifier"}
+        self._counters = {}
+        self.prefixes = {}          # prefix -> code
+        self._codes = {}            # code -> prefix
+        self.summary = ""
+        self._add_iac(iac_data or [])
+        self._add_state(state_data or [])
+        self._add_cicd(cicd_drift or {})
+        self._build_prefixes()
+
+    # --- ĐỌC INPUT ---
+    def _new_id(self, kind: str, address=None, aws_identifier=None):
+        self._counters[kind] = self._counters.get(kind, 0) + 1
+        short_id = f"{kind}{self._counters[kind]}"
+        self.resources[short_id] = {"resource_address": address, "aws_identifier": aws_identifier}
+        return short_id
+
+    def _add_iac(self, iac_data):
+        for entry in iac_data if isinstance(iac_data, list) else []:
+            if isinstance(entry, str):
+                entry = {"resource_address": entry}
+            if not isinstance(entry, dict) or not entry.get("resource_address"):
+                continue
+            address, aws_id = entry["resource_address"], entry.get("aws_identifier")
+            refs, parts = [address], [0]
+            if aws_id:
+                refs.append(aws_id)
+                parts += [" -> ", 1]
+            if entry.get("attributes"):
+                parts.append(" " + json.dumps(entry["attributes"], ensure_ascii=False, separators=(",", ":"), default=str))
+            self.lines.append(("iac", self._new_id("r", address, aws_id), refs, parts))
+
+    def _add_state(self, state_data):
+        for aws_id in state_data if isinstance(state_data, list) else []:
+            if isinstance(aws_id, str) and aws_id:
+                self.lines.append(("state", self._new_id("s", None, aws_id), [aws_id], [0]))
+
+    def _add_cicd(self, cicd_drift):
+        if not isinstance(cicd_drift, dict):
+            return
+        if cicd_drift:
+            self.summary = (f"total_refreshed={cicd_drift.get('total_refreshed', 0)} "
+                            f"managed_count={cicd_drift.get('managed_count', 0)}")
+        for d in cicd_drift.get("drifted") or []:
+            if not isinstance(d, dict):
+                continue
+            address, aws_id = d.get("resource_address"), d.get("aws_identifier")
+            refs = [address or "", aws_id or ""]
+            parts = [0, " -> ", 1, f" | {d.get('change_type', '')} | {d.get('drift_details', '')}"]
+            self.lines.append(("cicd", self._new_id("c", address, aws_id), refs, parts))
+        for u in cicd_drift.get("unmanaged") or []:
+            if isinstance(u, dict) and u.get("aws_identifier"):
+                parts = [0, f" (unmanaged: {u.get('reason', '')})"]
+                self.lines.append(("cicd", self._new_id("u", None, u["aws_identifier"]), [u["aws_identifier"]], parts))
+
+    def _build_prefixes(self):
+        counts = {}
+        for _, _, refs, _ in self.lines:
+            for ref in refs:
+                prefix = split_prefix(ref)[0]
+                if prefix:
+                    counts[prefix] = counts.get(prefix, 0) + 1
+        ranked = sorted((p for p, n in counts.items() if n >= MIN_PREFIX_USES), key=lambda p: -counts[p])
+        self.prefixes = {p: f"p{i + 1}" for i, p in enumerate(ranked)}
+        self._codes = {c: p for p, c in self.prefixes.items()}
+
+    # --- ENCODE ---
+    def encode_ref(self, value: str):
+        prefix, rest = split_prefix(value)
+        code = self.prefixes.get(prefix)
+        return f"{code}/{rest}" if code else value
+
+    def _render_line(self, line):
+        _, short_id, refs, parts = line
+        return f"{short_id} = " + "".join(self.encode_ref(refs[p]) if isinstance(p, int) else p for p in parts)
+
+    def shards(self, budget_tokens: int = None, max_resources: int = None):
+        """List các dict {prefixes, iac_data, state_data, cicd_drift} (đều là text), mỗi dict ≤ budget."""
+        budget = PROMPT_INPUT_TOKEN_BUDGET if budget_tokens is None else budget_tokens
+        max_resources = PROMPT_SHARD_MAX_RESOURCES if max_resources is None else max_resources
+        rendered = [(line[0], self._render_line(line), line[2], line[1]) for line in self.lines]
+        table_tokens = estimate_tokens("\n".join(f"{c} = {p}" for p, c in self.prefixes.items()))
+        groups, current, used = [], [], table_tokens
+        for item in rendered:
+            tokens = estimate_tokens(item[1]) + 1
+            full = (budget and used + tokens > budget) or (max_resources and len(current) >= max_resources)
+            if current and full:
+                groups.append(current)
+                current, used = [], table_tokens
+            if budget and table_tokens + tokens > budget:
+                logger.warning(f"Prompt input line alone exceeds budget ({tokens} tokens): {item[1][:80]}...")
+            current.append(item)
+            used += tokens
+        groups.append(current)
+        shards = [self._shard(group) for group in groups]
+        if len(shards) > 1:
+            logger.info(f"Prompt inputs split into {len(shards)} shards "
+                        f"(budget {budget} tokens / {max_resources} resources, {len(rendered)} lines)")
+        return shards
+
+    def _shard(self, group):
+        used = {split_prefix(r)[0] for _, _, refs, _ in group for r in refs}
+        sections = {"iac": [], "state": [], "cicd": []}
+        for section, text, _, _ in group:
+            sections[section].append(text)
+        cicd = sections["cicd"]
+        if self.summary:
+            cicd = [self.summary] + cicd
+        return {
+            "prefixes": "\n".join(f"{c} = {p}" for p, c in self.prefixes.items() if p in used) or EMPTY,
+            "iac_data": "\n".join(sections["iac"]) or EMPTY,
+            "state_data": "\n".join(sections["state"]) or EMPTY,
+            "cicd_drift": "\n".join(cicd) or EMPTY,
+            "resource_ids": [short_id for _, _, _, short_id in group],
+        }
+
+    def shard_resources(self, shard: dict):
+        """short id → {"resource_address", "aws_identifier"} của các resource trong 1 shard."""
+        return {i: self.resources[i] for i in shard.get("resource_ids", [])}
+
+    # --- DECODE OUTPUT ---
+    def decode_ref(self, value):
+        if not isinstance(value, str):
+            return value
+        value = value.strip()
+        if value in self.resources:
+            resource = self.resources[value]
+            return resource["resource_address"] or resource["aws_identifier"]
+        m = PREFIX_REF_RE.match(value)
+        if m:
+            prefix = self._codes.get(f"p{m.group(1)}")
+            if prefix:
+                return prefix + m.group(2)
+        return value
+
+    def decode_records(self, records):
+        """Đổi short id / tham chiếu prefix trong output của agent về address + identifier thật."""
+        for record in records or []:
+            if not isinstance(record, dict):
+                continue
+            raw = str(record.get("resource_address", "")).strip()
+            resource = self.resources.get(raw)
+            record["resource_address"] = self.decode_ref(raw)
+            if resource and resource["aws_identifier"] and not record.get("aws_identifier"):
+                record["aws_identifier"] = resource["aws_identifier"]
+            elif record.get("aws_identifier"):
+                record["aws_identifier"] = self.decode_ref(record["aws_identifier"])
+        return records
@@ -0,0 +1,65 @@
+# ========================================
+# shard_results.py — GỘP OUTPUT CÁC SHARD AGENT + DRIFT TÌM ĐƯỢC Ở LOCAL
+# ========================================
+from resource_resolver import normalize_address
+
+RISK_ORDER = {"high": 3, "medium": 2, "low": 1}
+
+
+def merge_shard_outputs(outputs: list):
+    if len(outputs) <= 1:
+        return outputs[0] if outputs else {}
+    merged = dict(outputs[0])
+    merged["drifted_resources"] = dedupe_drifts([r for o in outputs for r in (o.get("drifted_resources") or [])])
+    merged["summary"] = " | ".join(str(o["summary"]) for o in outputs if o.get("summary"))
+    merged["shards"] = len(outputs)
+    return merged
+
+
+def dedupe_drifts(records: list):
+    """1 record / resource_address: giữ risk cao nhất, gộp issue khác nhau."""
+    by_address, output = {}, []
+    for record in records:
+        if not isinstance(record, dict) or not record.get("resource_address"):
+            output.append(record)
+            continue
+        address = normalize_address(record["resource_address"])
+        existing = by_address.get(address)
+        if existing is None:
+            by_address[address] = record
+            output.append(record)
+            continue
+        issues = [existing.get("issue"), record.get("issue")]
+        if RISK_ORDER.get(str(record.get("risk")).lower(), 0) > RISK_ORDER.get(str(existing.get("risk")).lower(), 0):
+            existing.update({k: v for k, v in record.items() if k != "resource_address"})
+        if issues[0] and issues[1] and issues[1] not in issues[0]:
+            existing["issue"] = f"{issues[0]}; {issues[1]}"
+    return output
+
+
+def detection_result(detection_type: str, type_: str, outputs: list, local_drifts: list = ()):
+    """
+    outputs: output đã parse của từng shard ({} = shard lỗi; [] = không gọi agent).
+    Drift local luôn qua dedupe_drifts như khi gộp với output agent.
+    Shard lỗi không có verdict → ghi failed_shards để không bị coi là "không drift"
+    (finish_incremental_scan không lưu fingerprint), kể cả khi đã có drift local.
+    """
+    failed_shards = sum(1 for o in outputs if not o)
+    parsed = merge_shard_outputs([o for o in outputs if o])
+    if parsed:
+        parsed["detection_type"] = detection_type
+        parsed["type"] = type_
+        if local_drifts:
+            parsed["drifted_resources"] = dedupe_drifts(list(local_drifts) + (parsed.get("drifted_resources") or []))
+    else:
+        parsed = {
+            "detection_type": detection_type,
+            "type": type_,
+            "drifted_resources": dedupe_drifts(list(local_drifts)),
+            "summary": "No drift detected or parsing failed" if outputs and not local_drifts
+                       else f"{len(local_drifts)} attribute drifts found by local comparison"
+        }
+    if failed_shards:
+        parsed["failed_shards"] = failed_shards
+        parsed["summary"] = f"{parsed.get('summary', '')} ({failed_shards}/{len(outputs)} shards failed)".strip()
+    return parsed
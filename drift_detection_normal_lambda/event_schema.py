@@ -0,0 +1,103 @@
+# ========================================
+# event_schema.py — LẤY FIELD TỪ EVENT STEP FUNCTIONS THEO PATH KHAI BÁO SẴN
+# ========================================
+import logging
+
+logger = logging.getLogger()
+
+# output của Lambda task (không có OutputPath) được bọc trong "Payload"
+PAYLOAD_KEY = "Payload"
+
+
+def compile_path(path: str):
+    """"detections[].normal" → ("detections", "[]", "normal")"""
+    segments = []
+    for part in path.split("."):
+        if part.endswith("[]"):
+            if part[:-2]:
+                segments.append(part[:-2])
+            segments.append("[]")
+        elif part:
+            segments.append(part)
+    return tuple(segments)
+
+
+def resolve_path(node, segments, i=0):
+    """Các giá trị tại path; list chỉ duyệt ở segment "[]", Payload tự bóc."""
+    if i == len(segments):
+        yield node
+        return
+    segment = segments[i]
+    if segment == "[]":
+        if isinstance(node, list):
+            for item in node:
+                yield from resolve_path(item, segments, i + 1)
+        return
+    if isinstance(node, dict):
+        if segment in node:
+            yield from resolve_path(node[segment], segments, i + 1)
+        elif isinstance(node.get(PAYLOAD_KEY), dict):
+            yield from resolve_path(node[PAYLOAD_KEY], segments, i)
+
+
+class EventField:
+    def __init__(self, name: str, paths: str, types):
+        self.name = name
+        self.paths = [compile_path(p.strip()) for p in paths.split("|")]
+        self.types = types if isinstance(types, tuple) else (types,)
+
+
+class ExtractionReport:
+    def __init__(self):
+        self.found = []
+        self.missing = []
+        self.invalid = []        # (field, type thực tế)
+        self.duplicates = []     # field có nhiều giá trị khác nhau
+        self.fallback = []       # field lấy bằng cách duyệt cả event
+
+    def log(self, label: str):
+        if self.invalid or self.duplicates or self.fallback:
+            logger.warning(
+                f"[{label}] event fields: missing={self.missing} invalid={self.invalid} "
+                f"duplicates={self.duplicates} fallback={self.fallback}"
+            )
+        elif self.missing:
+            logger.info(f"[{label}] event fields not present: {self.missing}")
+
+
+class EventSchema:
+    """
+    Schema khai báo 1 lần lúc import: field → các path ứng viên (theo thứ tự
+    ưu tiên, ngăn bằng "|") + kiểu hợp lệ. extract() chỉ tra đúng các path đó
+    thay vì duyệt mọi node của event.
+    """
+
+    def __init__(self, fields: dict, required=()):
+        self.fields = [EventField(name, paths, types) for name, (paths, types) in fields.items()]
+        self.required = tuple(required)
+
+    def extract(self, event):
+        """Trả (values, report); field không có trong event không có trong values."""
+        values, report = {}, ExtractionReport()
+        for field in self.fields:
+            matches = [
+                value
+                for segments in field.paths
+                for value in resolve_path(event, segments)
+                if value is not None
+            ]
+            if not matches:
+                report.missing.append(field.name)
+                continue
+            value = matches[0]
+            if any(m is not value and m != value for m in matches[1:]):
+                report.duplicates.append(field.name)
+            if not isinstance(value, field.types):
+                report.invalid.append((field.name, type(value).__name__))
+                continue
+            values[field.name] = value
+            report.found.append(field.name)
+        return values, report
+
+    def needs_fallback(self, report: ExtractionReport):
+        return not report.found or any(name in report.missing for name in self.required)
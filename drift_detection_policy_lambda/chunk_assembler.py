@@ -0,0 +1,95 @@
+# ========================================
+# chunk_assembler.py — GHÉP CHUNK TỪ completion STREAM CỦA BEDROCK AGENT
+# ========================================
+import io
+import time
+import codecs
+import logging
+
+logger = logging.getLogger()
+
+
+class ChunkAssembler:
+    """
+    Ghép chunk theo đúng thứ tự nhận (hoặc theo `sequence` nếu có), không
+    dedupe theo nội dung: chunk lặp lại như '},' là dữ liệu hợp lệ.
+    Bytes được decode UTF-8 incremental nên ký tự bị cắt giữa 2 chunk không lỗi.
+    buffer = "list" (join 1 lần ở cuối) | "stringio".
+    """
+
+    def __init__(self, label: str = "agent", buffer: str = "list"):
+        self.label = label
+        self._parts = io.StringIO() if buffer == "stringio" else []
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._pending = {}           # sequence -> data, chunk đến sớm
+        self.next_sequence = 0
+        self.chunks = 0
+        self.duplicates = 0
+        self.bytes = 0
+        self.chars = 0
+        self.started_at = time.time()
+        self.first_chunk_at = None
+
+    def add(self, data, sequence: int = None):
+        """Thêm 1 chunk (bytes/str). Trả về text mới ghép được (có thể rỗng)."""
+        if sequence is None:
+            sequence = self.next_sequence
+        if sequence < self.next_sequence or sequence in self._pending:
+            self.duplicates += 1     # gửi lại cùng sequence → bỏ
+            return ""
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.time()
+        self._pending[sequence] = data
+        out = []
+        while self.next_sequence in self._pending:
+            out.append(self._append(self._pending.pop(self.next_sequence)))
+            self.next_sequence += 1
+        return "".join(out)
+
+    def add_event(self, event: dict):
+        """Event của response["completion"]; event không có chunk bytes → ""."""
+        data = (event.get("chunk") or {}).get("bytes")
+        return self.add(data) if data else ""
+
+    def _append(self, data):
+        self.chunks += 1
+        if isinstance(data, bytes):
+            self.bytes += len(data)
+            data = self._decoder.decode(data)
+        else:
+            self.bytes += len(data.encode("utf-8"))
+        self._write(data)
+        return data
+
+    def _write(self, text: str):
+        if not text:
+            return
+        self.chars += len(text)
+        if isinstance(self._parts, list):
+            self._parts.append(text)
+        else:
+            self._parts.write(text)
+
+    def text(self):
+        self._write(self._decoder.decode(b"", final=True))
+        if self._pending:
+            logger.warning(f"[{self.label}] {len(self._pending)} chunks missing before sequence {min(self._pending)}")
+        if isinstance(self._parts, list):
+            joined = "".join(self._parts)
+            self._parts = [joined]
+            return joined
+        return self._parts.getvalue()
+
+    def stats(self):
+        ttfc = None if self.first_chunk_at is None else round((self.first_chunk_at - self.started_at) * 1000)
+        return {
+            "chunks": self.chunks,
+            "bytes": self.bytes,
+            "chars": self.chars,
+            "duplicates": self.duplicates,
+            "time_to_first_chunk_ms": ttfc,
+            "elapsed_ms": round((time.time() - self.started_at) * 1000),
+        }
+
+    def log_stats(self):
+        logger.info(f"[{self.label}] Agent stream: {self.stats()}")
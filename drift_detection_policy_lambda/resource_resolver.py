@@ -0,0 +1,204 @@
+# ========================================
+# resource_resolver.py — MAP resource_address ↔ AWS identifier BẰNG DICT INDEX
+# ========================================
+import re
+
+# Terraform type ↔ AWS Config type
+RESOURCE_TYPE_MAPPING = {
+    "aws_instance": "AWS::EC2::Instance",
+    "aws_s3_bucket": "AWS::S3::Bucket",
+    "aws_security_group": "AWS::EC2::SecurityGroup",
+    "aws_db_instance": "AWS::RDS::DBInstance",
+    "aws_vpc": "AWS::EC2::VPC",
+    "aws_subnet": "AWS::EC2::Subnet",
+    "aws_internet_gateway": "AWS::EC2::InternetGateway",
+    "aws_nat_gateway": "AWS::EC2::NatGateway",
+    "aws_route_table": "AWS::EC2::RouteTable",
+    "aws_eip": "AWS::EC2::EIP",
+    "aws_ebs_volume": "AWS::EC2::Volume",
+    "aws_network_interface": "AWS::EC2::NetworkInterface",
+    "aws_iam_role": "AWS::IAM::Role",
+    "aws_iam_policy": "AWS::IAM::Policy",
+    "aws_iam_user": "AWS::IAM::User",
+    "aws_lambda_function": "AWS::Lambda::Function",
+    "aws_dynamodb_table": "AWS::DynamoDB::Table",
+    "aws_lb": "AWS::ElasticLoadBalancingV2::LoadBalancer",
+    "aws_alb": "AWS::ElasticLoadBalancingV2::LoadBalancer",
+    "aws_kms_key": "AWS::KMS::Key",
+    "aws_sns_topic": "AWS::SNS::Topic",
+    "aws_sqs_queue": "AWS::SQS::Queue",
+}
+
+# attribute IaC thường chứa tên/ID thật trên AWS
+IAC_NAME_ATTRIBUTES = ("id", "name", "bucket", "identifier", "arn", "function_name", "role_name")
+
+INDEX_RE = re.compile(r"\[[^\]]*\]")
+NAME_HINT_RE = re.compile(r'^\s*(%s|Name)\s*=\s*"([^"$]+)"' % "|".join(IAC_NAME_ATTRIBUTES), re.M)
+
+
+# === IDENTIFIER HELPERS ===
+def normalize_address(address: str):
+    """resource.aws_instance.web (format KB iac_config) → aws_instance.web (format output của agent)"""
+    address = str(address or "").strip()
+    return address[len("resource."):] if address.startswith("resource.") else address
+
+
+def split_address(address: str):
+    """module.x.aws_instance.web["a"] → ("aws_instance", "web")"""
+    parts = INDEX_RE.sub("", address).split(".")
+    return (parts[-2], parts[-1]) if len(parts) >= 2 else (None, address)
+
+
+def make_identifier(resource_type: str, name: str):
+    """AWS::EC2::Instance + i-123 → AWS__EC2__Instance_i-123"""
+    return f"{resource_type.replace('::', '__')}_{name}"
+
+
+def parse_identifier(identifier: str):
+    """AWS__EC2__Instance_i-123 → ("AWS::EC2::Instance", "i-123")"""
+    parts = identifier.split("__", 2)
+    if len(parts) < 3 or "_" not in parts[-1]:
+        return None, identifier
+    service_type, _, name = parts[-1].partition("_")
+    return "::".join(parts[:-1] + [service_type]), name
+
+
+def to_aws_identifier(address: str, resource_id: str):
+    """module.sg.aws_security_group.app + sg-123 → AWS__EC2__SecurityGroup_sg-123"""
+    aws_type = RESOURCE_TYPE_MAPPING.get(split_address(address)[0])
+    if not aws_type or not resource_id:
+        return resource_id
+    return make_identifier(aws_type, resource_id)
+
+
+def document_identifier(doc: dict):
+    if doc.get("id"):
+        return doc["id"]
+    meta = doc.get("metadata") or {}
+    return make_identifier(meta.get("resourceType", ""), meta.get("resourceId") or meta.get("resourceName"))
+
+
+def iac_name_hints(doc: dict):
+    """Lấy nhanh name/bucket/tags.Name từ content HCL để match (không parse toàn bộ block)."""
+    if isinstance(doc.get("attributes"), dict):
+        return doc["attributes"]
+    hints = {}
+    for key, value in NAME_HINT_RE.findall(doc.get("content") or ""):
+        if key == "Name":
+            hints.setdefault("tags", {}).setdefault("Name", value)
+        else:
+            hints.setdefault(key, value)
+    return hints
+
+
+def document_tags(doc: dict):
+    configuration = doc.get("configuration") or {}
+    tags = doc.get("tags") or configuration.get("tags") or configuration.get("Tags") or {}
+    if isinstance(tags, list):
+        return {t.get("key") or t.get("Key"): t.get("value") or t.get("Value") for t in tags if isinstance(t, dict)}
+    return tags if isinstance(tags, dict) else {}
+
+
+class ResourceResolver:
+    """
+    Index các resource AWS (document aws_state hoặc chỉ identifier string)
+    theo type, name, id, ARN và tag; match với resource_address của IaC
+    theo cả hai chiều bằng tra dict O(1).
+    """
+
+    def __init__(self, state_docs=(), identifiers=()):
+        self.documents = {}          # identifier -> document (hoặc None nếu chỉ có string)
+        self.by_type = {}            # resourceType -> [identifier]
+        self.by_name = {}            # (resourceType, name|id|arn|tag Name) -> identifier
+        self.by_id = {}              # resourceId -> identifier
+        self.by_arn = {}             # arn -> identifier
+        self.by_tag = {}             # (tag key, tag value) -> [identifier]
+        self.address_to_identifier = {}
+        self.identifier_to_address = {}
+        for doc in state_docs:
+            self.add_document(doc)
+        for identifier in identifiers:
+            self.add_identifier(identifier)
+
+    # --- INDEX ---
+    def add_document(self, doc: dict):
+        meta = doc.get("metadata") or {}
+        identifier = document_identifier(doc)
+        resource_type = meta.get("resourceType")
+        self.documents[identifier] = doc
+        self.by_type.setdefault(resource_type, []).append(identifier)
+        tags = document_tags(doc)
+        for name in (meta.get("resourceName"), meta.get("resourceId"), meta.get("arn"), tags.get("Name")):
+            if name:
+                self.by_name.setdefault((resource_type, name), identifier)
+        if meta.get("resourceId"):
+            self.by_id.setdefault(meta["resourceId"], identifier)
+        if meta.get("arn"):
+            self.by_arn.setdefault(meta["arn"], identifier)
+        for key, value in tags.items():
+            self.by_tag.setdefault((key, value), []).append(identifier)
+        return identifier
+
+    def add_identifier(self, identifier: str):
+        if identifier in self.documents:
+            return identifier
+        resource_type, name = parse_identifier(identifier)
+        self.documents[identifier] = None
+        self.by_type.setdefault(resource_type, []).append(identifier)
+        self.by_name.setdefault((resource_type, name), identifier)
+        self.by_id.setdefault(name, identifier)
+        return identifier
+
+    # --- LOOKUP ---
+    def match(self, address: str, attrs: dict = None):
+        """resource_address (+ attribute IaC nếu có) → AWS identifier, ghi nhớ cả 2 chiều."""
+        if address in self.address_to_identifier:
+            return self.address_to_identifier[address]
+        tf_type, name = split_address(address)
+        aws_type = RESOURCE_TYPE_MAPPING.get(tf_type)
+        if not aws_type:
+            return None
+        attrs = attrs or {}
+        keys = [attrs[attr] for attr in IAC_NAME_ATTRIBUTES if isinstance(attrs.get(attr), str)]
+        tags = attrs.get("tags")
+        if isinstance(tags, dict) and isinstance(tags.get("Name"), str):
+            keys.append(tags["Name"])
+        keys.append(name)
+        for key in keys:
+            identifier = self.by_name.get((aws_type, key))
+            if identifier and identifier not in self.identifier_to_address:
+                self.address_to_identifier[address] = identifier
+                self.identifier_to_address[identifier] = address
+                return identifier
+        return None
+
+    def resolve(self, address: str):
+        return self.address_to_identifier.get(address)
+
+    def reverse(self, identifier: str):
+        return self.identifier_to_address.get(identifier)
+
+    def lookup_id(self, resource_id: str):
+        return self.by_id.get(resource_id) or self.by_arn.get(resource_id)
+
+    def lookup_tag(self, key: str, value: str):
+        return self.by_tag.get((key, value), [])
+
+    def document(self, identifier: str):
+        return self.documents.get(identifier)
+
+    # --- KẾT QUẢ ---
+    def pairs(self):
+        return [
+            {"resource_address": address, "aws_identifier": identifier}
+            for address, identifier in self.address_to_identifier.items()
+        ]
+
+    def unmatched_identifiers(self):
+        return [i for i in self.documents if i not in self.identifier_to_address]
+
+
+def resolve_addresses(addresses, resolver: ResourceResolver):
+    """Match cả danh sách; trả (pairs, unmatched_addresses)."""
+    unmatched = [a for a in addresses if not resolver.match(a)]
+    return resolver.pairs(), unmatched
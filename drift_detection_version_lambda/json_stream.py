@@ -0,0 +1,191 @@
+# ========================================
+# json_stream.py — ĐỌC JSON THEO CHUNK, TRẢ VỀ TỪNG PHẦN TỬ CỦA MẢNG
+# ========================================
+import json
+import re
+
+STRUCT_RE = re.compile(r'[{}\[\]",:]')
+STRING_RE = re.compile(r'["\\]')
+OPEN_RE = re.compile(r'[{\[]')
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class JsonArrayStream:
+    """
+    Push parser: feed() từng đoạn text, nhận lại các phần tử đã đóng của
+    những mảng nằm ở `paths` (tuple key tính từ object gốc, () = mảng gốc).
+    Bộ nhớ chỉ giữ phần tử đang đọc dở, không giữ cả document.
+    Text đứng trước { hoặc [ đầu tiên bị bỏ qua (agent hay chèn lời dẫn).
+    keep_rest=True: giữ lại phần document ngoài các phần tử đã trả về
+    (xem rest()) để lấy các field còn lại mà không parse lại cả document.
+    Phần tử không phải JSON hợp lệ → failed=True (error giữ lỗi), ngừng trả
+    phần tử; caller tự parse lại cả text bằng parser chịu lỗi.
+    """
+
+    def __init__(self, *paths, keep_rest: bool = False):
+        self.paths = {tuple(p) for p in paths} or {()}
+        self._rest = [] if keep_rest else None
+        self.done = False            # đã đóng object/array gốc
+        self.failed = False          # gặp phần tử lỗi, không đọc tiếp
+        self.error = None
+        self.chars_read = 0
+        self._stack = []             # '{' hoặc '['
+        self._keys = []              # key hiện tại của từng object trên stack
+        self._expect_key = False
+        self._in_string = False
+        self._escape = False
+        self._key_buf = None         # đang đọc key string
+        self._capture = None         # các đoạn text của phần tử đang đọc
+        self._capture_depth = 0
+        self._capture_path = None
+
+    def feed(self, text: str):
+        if self.failed:
+            return []
+        items = []
+        i, n = 0, len(text)
+        start = 0 if self._capture is not None else None
+        out_start = None if self._capture is not None else 0
+        self.chars_read += n
+
+        while i < n and not self.done and not self.failed:
+            if self._in_string:
+                i = self._scan_string(text, i, n)
+                continue
+
+            if not self._stack:
+                m = OPEN_RE.search(text, i)
+                i = out_start = m.start() if m else n
+                if not m:
+                    break
+
+            if self._capture is None:
+                path = self._target_path()
+                if path is not None:
+                    while i < n and text[i] in " \t\r\n":
+                        i += 1
+                    if i >= n:
+                        break
+                    if text[i] not in ",]":
+                        self._capture, self._capture_depth, self._capture_path = [], len(self._stack), path
+                        start = i
+                        if self._rest is not None:
+                            self._rest.append(text[out_start:start])
+                        out_start = None
+
+            m = STRUCT_RE.search(text, i)
+            if not m:
+                break
+            c, pos = m.group(), m.start()
+            i = m.end()
+
+            if c == '"':
+                self._in_string = True
+                self._key_buf = [] if self._expect_key else None
+                self._expect_key = False
+            elif c in "{[":
+                self._stack.append(c)
+                self._keys.append(None)
+                self._expect_key = c == "{"
+            elif c in "}]":
+                if self._capture is not None and len(self._stack) == self._capture_depth:
+                    # phần tử scalar kết thúc bởi ]
+                    items.append(self._finish(text, start, pos))
+                    start, out_start = None, pos
+                self._stack.pop()
+                self._keys.pop()
+                if self._capture is not None and len(self._stack) == self._capture_depth:
+                    items.append(self._finish(text, start, pos + 1))
+                    start, out_start = None, pos + 1
+                if not self._stack:
+                    self.done = True
+            elif c == ",":
+                if self._capture is not None and len(self._stack) == self._capture_depth:
+                    items.append(self._finish(text, start, pos))
+                    start, out_start = None, pos
+                self._expect_key = self._stack[-1] == "{" if self._stack else False
+
+        if self.failed:
+            return [item for item in items if item is not None]
+        if self._capture is not None and start is not None:
+            self._capture.append(text[start:])
+        if self._rest is not None and out_start is not None:
+            self._rest.append(text[out_start:i if self.done else n])
+        return items
+
+    def rest(self):
+        """Document không có các phần tử đã trả về, vd {"a": [,,], "summary": "..."} (cần parser chịu lỗi)."""
+        return "".join(self._rest or [])
+
+    def _scan_string(self, text, i, n):
+        if self._escape:
+            self._escape = False
+            if self._key_buf is not None:
+                self._key_buf.append(text[i])
+            return i + 1
+        m = STRING_RE.search(text, i)
+        if not m:
+            if self._key_buf is not None:
+                self._key_buf.append(text[i:])
+            return n
+        end = m.start()
+        if m.group() == "\\":
+            if self._key_buf is not None:
+                self._key_buf.append(text[i:end + 2])
+            if end + 1 >= n:
+                self._escape = True
+            return end + 2
+        if self._key_buf is not None:
+            self._key_buf.append(text[i:end])
+            try:
+                self._keys[-1] = json.loads('"' + "".join(self._key_buf) + '"')
+            except ValueError as e:
+                self.failed, self.error = True, e
+            self._key_buf = None
+        self._in_string = False
+        return end + 1
+
+    def _target_path(self):
+        depth = len(self._stack)
+        if not depth or self._stack[-1] != "[":
+            return None
+        path = tuple(self._keys[:depth - 1])
+        if path in self.paths and all(c == "{" for c in self._stack[:-1]):
+            return path
+        return None
+
+    def _finish(self, text, start, end):
+        raw = "".join(self._capture) + text[start:end]
+        path = self._capture_path
+        self._capture = None
+        self._capture_path = None
+        if self.failed:
+            return None
+        try:
+            return path, json.loads(raw)
+        except ValueError as e:
+            self.failed, self.error = True, e
+            return None
+
+
+def iter_array_items(chunks, *paths):
+    """Duyệt (path, item) từ một iterable các chunk str/bytes."""
+    stream = JsonArrayStream(*paths)
+    decoder = None
+    for chunk in chunks:
+        if isinstance(chunk, bytes):
+            if decoder is None:
+                import codecs
+                decoder = codecs.getincrementaldecoder("utf-8")()
+            chunk = decoder.decode(chunk)
+        yield from stream.feed(chunk)
+        if stream.failed:
+            raise stream.error
+        if stream.done:
+            return
+
+
+def iter_text_chunks(text: str, size: int = READ_CHUNK_SIZE):
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
@@ -0,0 +1,251 @@
+# ========================================
+# agent_cache.py — CACHE RESPONSE CỦA BEDROCK AGENT THEO HASH INPUT
+# ========================================
+import os
+import json
+import time
+import base64
+import hashlib
+import logging
+import threading
+import zlib
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+# === CONFIG ===
+# memory | dynamodb | local | none  (memory luôn đứng trước backend bền vững)
+AGENT_CACHE_BACKEND = os.environ.get("AGENT_CACHE_BACKEND", "memory")
+AGENT_CACHE_TABLE = os.environ.get("AGENT_CACHE_TABLE", "agentResponseCache")
+AGENT_CACHE_DIR = os.environ.get("AGENT_CACHE_DIR", "/tmp/agent-cache")
+AGENT_CACHE_TTL_SEC = int(os.environ.get("AGENT_CACHE_TTL_SEC", str(8 * 24 * 3600)))
+AGENT_CACHE_MAX_ITEMS = int(os.environ.get("AGENT_CACHE_MAX_ITEMS", "256"))
+AGENT_CACHE_MAX_BYTES = int(os.environ.get("AGENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+ERROR_PREFIXES = ("Agent invoke error", "Agent failed")
+
+
+def agent_failed(text):
+    """Marker lỗi của invoke_agent (không phải output của agent)."""
+    return not isinstance(text, str) or text.startswith(ERROR_PREFIXES)
+
+
+# === KEY ===
+def normalize(value):
+    """Chuẩn hoá input trước khi hash: strip string, list string không phụ thuộc thứ tự."""
+    if isinstance(value, dict):
+        return {str(k): normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        items = [normalize(v) for v in value]
+        if all(isinstance(v, str) for v in items):
+            return sorted(items)
+        return items
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def make_key(namespace: str, version: str, inputs):
+    payload = json.dumps(normalize(inputs), sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    return f"{namespace}:{version}:{digest}"
+
+
+def template_version(version: str, template: str):
+    """Version = version khai báo + hash template, sửa prompt là tự đổi key."""
+    return f"{version}-{hashlib.sha256(template.encode('utf-8')).hexdigest()[:12]}"
+
+
+# === BACKENDS ===
+class MemoryBackend:
+    """LRU trong warm container, giới hạn theo số item và tổng bytes."""
+
+    def __init__(self, max_items: int = AGENT_CACHE_MAX_ITEMS, max_bytes: int = AGENT_CACHE_MAX_BYTES):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                self._remove(key)
+                return None
+            self._items.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, value: str, expires_at: float):
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (value, expires_at)
+            self.size += len(value)
+            while self._items and (len(self._items) > self.max_items or self.size > self.max_bytes):
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        value, _ = self._items.pop(key)
+        self.size -= len(value)
+
+
+class DynamoDBBackend:
+    """Table key = cacheKey (S), TTL attribute = expiresAt. Value nén zlib (giới hạn 400KB/item)."""
+
+    MAX_ITEM_BYTES = 350 * 1024
+
+    def __init__(self, table):
+        self.table = table
+        self.evictions = 0
+
+    def get(self, key: str):
+        item = self.table.get_item(Key={"cacheKey": key}).get("Item")
+        if not item or float(item.get("expiresAt", 0)) <= time.time():
+            return None
+        return zlib.decompress(bytes(item["value"])).decode("utf-8")
+
+    def put(self, key: str, value: str, expires_at: float):
+        data = zlib.compress(value.encode("utf-8"))
+        if len(data) > self.MAX_ITEM_BYTES:
+            logger.warning(f"Agent cache: value too large for DynamoDB ({len(data)} bytes), skip")
+            return
+        self.table.put_item(Item={"cacheKey": key, "value": data, "expiresAt": int(expires_at)})
+
+
+class LocalFileBackend:
+    """Stand-in cho DynamoDB khi chạy local/test: mỗi key 1 file JSON trong AGENT_CACHE_DIR."""
+
+    def __init__(self, directory: str = AGENT_CACHE_DIR, max_items: int = AGENT_CACHE_MAX_ITEMS):
+        self.directory = directory
+        self.max_items = max_items
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, key: str):
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if item["expiresAt"] <= time.time():
+            return None
+        return zlib.decompress(base64.b64decode(item["value"])).decode("utf-8")
+
+    def put(self, key: str, value: str, expires_at: float):
+        item = {"cacheKey": key, "expiresAt": expires_at,
+                "value": base64.b64encode(zlib.compress(value.encode("utf-8"))).decode("ascii")}
+        with open(self._path(key), "w", encoding="utf-8") as f:
+            json.dump(item, f)
+        files = sorted(
+            (os.path.join(self.directory, n) for n in os.listdir(self.directory)),
+            key=os.path.getmtime
+        )
+        for path in files[:max(0, len(files) - self.max_items)]:
+            os.remove(path)
+            self.evictions += 1
+
+
+# === CACHE ===
+class AgentCache:
+    def __init__(self, backend=None, memory: MemoryBackend = None, ttl_sec: int = AGENT_CACHE_TTL_SEC):
+        self.memory = memory or MemoryBackend()
+        self.backend = backend
+        self.ttl_sec = ttl_sec
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is None and self.backend is not None:
+            try:
+                value = self.backend.get(key)
+            except Exception as e:
+                logger.warning(f"Agent cache backend get failed: {str(e)}")
+                value = None
+            if value is not None:
+                self.memory.put(key, value, time.time() + self.ttl_sec)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key: str, value: str):
+        expires_at = time.time() + self.ttl_sec
+        self.memory.put(key, value, expires_at)
+        if self.backend is not None:
+            try:
+                self.backend.put(key, value, expires_at)
+            except Exception as e:
+                logger.warning(f"Agent cache backend put failed: {str(e)}")
+
+    def cached_call(self, namespace: str, version: str, inputs, call):
+        """Trả response cache nếu có, không thì gọi `call()` và lưu (bỏ qua output rỗng/lỗi)."""
+        key = make_key(namespace, version, inputs)
+        value = self.get(key)
+        if value is not None:
+            logger.info(f"Agent cache HIT {namespace} ({len(value)} chars)")
+            self.log_metrics(namespace, hit=True)
+            return value
+        value = call()
+        if isinstance(value, str) and value.strip() and not value.startswith(ERROR_PREFIXES):
+            self.put(key, value)
+        self.log_metrics(namespace, hit=False)
+        return value
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_items": len(self.memory._items),
+            "memory_bytes": self.memory.size,
+            "evictions": self.memory.evictions + getattr(self.backend, "evictions", 0),
+        }
+
+    def log_metrics(self, namespace: str, hit: bool):
+        # CloudWatch Embedded Metric Format — mỗi lần gọi ghi 1 hit hoặc 1 miss
+        logger.info(json.dumps({
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": "DriftDetection/AgentCache",
+                    "Dimensions": [["CacheNamespace"]],
+                    "Metrics": [{"Name": "Hit", "Unit": "Count"}, {"Name": "Miss", "Unit": "Count"}],
+                }],
+            },
+            "CacheNamespace": namespace,
+            "Hit": 1 if hit else 0,
+            "Miss": 0 if hit else 1,
+            "stats": self.stats(),
+        }))
+
+
+def build_cache():
+    backend = None
+    if AGENT_CACHE_BACKEND == "none":
+        return None
+    if AGENT_CACHE_BACKEND == "dynamodb":
+        import boto3
+        backend = DynamoDBBackend(boto3.resource("dynamodb").Table(AGENT_CACHE_TABLE))
+    elif AGENT_CACHE_BACKEND == "local":
+        backend = LocalFileBackend()
+    return AgentCache(backend=backend)
+
+
+agent_cache = build_cache()
+
+
+def cached_agent_call(namespace: str, version: str, inputs, call):
+    if agent_cache is None:
+        return call()
+    return agent_cache.cached_call(namespace, version, inputs, call)
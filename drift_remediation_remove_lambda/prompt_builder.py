@@ -0,0 +1,88 @@
+# ========================================
+# prompt_builder.py — GHÉP PROMPT TỪ FRAGMENT DÙNG CHUNG + ĐẾM TOKEN
+# ========================================
+import os
+import json
+import logging
+
+logger = logging.getLogger()
+
+# 0 = không giới hạn
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "0"))
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str):
+    """Ước lượng nhanh ~4 ký tự / token (đủ để so với budget, không cần tokenizer)."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+class Fragment:
+    """
+    1 đoạn prompt có version. drop_priority = None: luôn giữ; số càng nhỏ
+    càng bị bỏ trước khi prompt vượt budget (đoạn lặp lại / nhắc lại rule).
+    Text dùng cú pháp str.format ({{ }} cho ngoặc nhọn thật).
+    """
+
+    def __init__(self, name: str, version: str, text: str, drop_priority: int = None):
+        self.name = name
+        self.version = version
+        self.text = text.strip("\n")
+        self.drop_priority = drop_priority
+
+    def with_values(self, **values):
+        """Fragment dùng chung nhưng điền sẵn 1 phần placeholder (vd detection_type)."""
+        text = self.text
+        for key, value in values.items():
+            text = text.replace("{" + key + "}", str(value))
+        return Fragment(self.name, self.version, text, self.drop_priority)
+
+
+class PromptTemplate:
+    def __init__(self, name: str, fragments: list):
+        self.name = name
+        self.fragments = fragments
+
+    @property
+    def text(self):
+        """Toàn bộ template (dùng để hash version cache)."""
+        return "\n\n".join(f.text for f in self.fragments)
+
+    @property
+    def version(self):
+        return ",".join(f"{f.name}@{f.version}" for f in self.fragments)
+
+    def has_fragment(self, name: str):
+        return any(f.name == name for f in self.fragments)
+
+    def fragment_tokens(self):
+        return {f.name: estimate_tokens(f.text) for f in self.fragments}
+
+    def render(self, budget_tokens: int = None, **values):
+        """Trả (prompt, report). Vượt budget → bỏ fragment có drop_priority nhỏ nhất trước."""
+        budget = PROMPT_TOKEN_BUDGET if budget_tokens is None else budget_tokens
+        parts = [(f, f.text.format(**values)) for f in self.fragments]
+        tokens = {f.name: estimate_tokens(text) for f, text in parts}
+        total = sum(tokens.values())
+        dropped = []
+        if budget and total > budget:
+            for f, _ in sorted((p for p in parts if p[0].drop_priority is not None),
+                               key=lambda p: p[0].drop_priority):
+                if total <= budget:
+                    break
+                dropped.append(f.name)
+                total -= tokens[f.name]
+        prompt = "\n\n".join(text for f, text in parts if f.name not in dropped)
+        report = {
+            "template": self.name,
+            "version": self.version,
+            "fragments": tokens,
+            "total_tokens": estimate_tokens(prompt),
+            "budget": budget or None,
+            "dropped": dropped,
+        }
+        if budget and report["total_tokens"] > budget:
+            logger.warning(f"Prompt {self.name} still over budget after dropping sections: {json.dumps(report)}")
+        else:
+            logger.info(f"Prompt {self.name}: {json.dumps(report)}")
+        return prompt, report
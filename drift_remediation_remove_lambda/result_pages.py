@@ -0,0 +1,104 @@
+# ========================================
+# result_pages.py — CHIA drifted_resources THÀNH PAGE, PAGE 2.. LƯU RA S3 (PAYLOAD STEP FUNCTIONS ≤ 256KB)
+# ========================================
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger()
+
+RESULT_PAGE_SIZE = int(os.environ.get("RESULT_PAGE_SIZE", "200"))
+# rỗng = không có page store, trả đầy đủ trong payload
+RESULT_PAGE_BUCKET = os.environ.get("RESULT_PAGE_BUCKET", "")
+RESULT_PAGE_PREFIX = os.environ.get("RESULT_PAGE_PREFIX", "detection-results")
+
+
+def paginate(records: list, page_size: int = RESULT_PAGE_SIZE):
+    page_size = max(1, page_size)
+    return [records[i:i + page_size] for i in range(0, len(records), page_size)] or [[]]
+
+
+class S3PageStore:
+    def __init__(self, bucket: str, prefix: str = RESULT_PAGE_PREFIX):
+        import boto3
+        self.s3 = boto3.client("s3")
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, key: str, records: list):
+        key = f"{self.prefix}/{key}"
+        self.s3.put_object(Bucket=self.bucket, Key=key, ContentType="application/json",
+                           Body=json.dumps(records, ensure_ascii=False).encode("utf-8"))
+        return f"s3://{self.bucket}/{key}"
+
+    def get(self, uri: str):
+        bucket, _, key = uri[len("s3://"):].partition("/")
+        return json.loads(self.s3.get_object(Bucket=bucket, Key=key)["Body"].read())
+
+
+class MemoryPageStore:
+    """Stand-in local/test cho S3."""
+
+    def __init__(self):
+        self.pages = {}
+        self._lock = threading.Lock()
+
+    def put(self, key: str, records: list):
+        with self._lock:
+            self.pages[key] = json.loads(json.dumps(records))
+        return f"memory://{key}"
+
+    def get(self, uri: str):
+        with self._lock:
+            return self.pages[uri[len("memory://"):]]
+
+
+def build_page_store():
+    if not RESULT_PAGE_BUCKET:
+        return None
+    if RESULT_PAGE_BUCKET == "memory":
+        return MemoryPageStore()
+    return S3PageStore(RESULT_PAGE_BUCKET)
+
+
+page_store = build_page_store()
+
+
+def page_result(result: dict, key: str, field: str = "drifted_resources",
+                page_size: int = RESULT_PAGE_SIZE, store=None):
+    """
+    Luôn ghi total_drifts/pages. Có page store và vượt 1 page → giữ page 1
+    trong payload, các page sau lưu ra store (page_uris). Không có store → giữ đủ.
+    """
+    store = store or page_store
+    records = result.get(field) or []
+    result["total_drifts"] = len(records)
+    if store is None or len(records) <= page_size:
+        result["pages"] = 1
+        return result
+    pages = paginate(records, page_size)
+    result[field] = pages[0]
+    result["pages"] = len(pages)
+    result["page_uris"] = [store.put(f"{key}/page-{i:04d}.json", page) for i, page in enumerate(pages[1:], start=2)]
+    logger.info(f"Result {key}: {len(records)} records in {len(pages)} pages")
+    return result
+
+
+def expand_pages(result, field: str = "drifted_resources", store=None):
+    """Ngược với page_result: nạp lại các page từ store, trả result đầy đủ."""
+    if not isinstance(result, dict) or not result.get("page_uris"):
+        return result
+    store = store or page_store
+    if store is None and all(uri.startswith("s3://") for uri in result["page_uris"]):
+        store = S3PageStore("")  # bucket nằm trong URI
+    if store is None:
+        logger.warning(f"Result has {len(result['page_uris'])} stored pages but no page store configured")
+        return result
+    records = list(result.get(field) or [])
+    for uri in result["page_uris"]:
+        records.extend(store.get(uri))
+    expanded = {k: v for k, v in result.items() if k != "page_uris"}
+    expanded[field] = records
+    expanded["pages"] = 1
+    return expanded
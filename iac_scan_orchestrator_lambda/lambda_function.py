@@ -2,15 +2,70 @@ import boto3
 import os
 import json
 from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
 from datetime import datetime, timezone
+import time
 import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from work_queue import build_work_queue, process_batch, drain, Message, RetryLater, SQS_BATCH
 
 dynamodb = boto3.resource("dynamodb")
 table = dynamodb.Table("repoSubscriptions")
+# client dùng chung được giữa các thread (resource/Table thì không)
+ddb_client = dynamodb.meta.client
 sf = boto3.client("stepfunctions")
 STEP_FUNCTION_ARN = os.environ.get("STEP_FUNCTION_ARN", "arn:aws:states:us-east-1:933000400558:stateMachine:DriftReportAgentASL")
 lambda_client = boto3.client("lambda")
 LAMBDA_NAME = os.environ.get("LAMBDA_NAME", "iacScanOrchestrator")
+# "fan_out": 7 detector lambda song song | "in_process": 1 lambda chạy cả 7 detector
+DETECTION_MODE = os.environ.get("DETECTION_MODE", "fan_out")
+
+# === SỐ EXECUTION CHẠY SONG SONG ===
+# MAX_IN_FLIGHT > 0: cố định K. 0: tính từ quota InvokeAgent của Bedrock:
+# K = quota/phút × thời gian 1 execution (phút) / số lần gọi agent của 1 execution
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", "0"))
+BEDROCK_AGENT_RPM = int(os.environ.get("BEDROCK_AGENT_RPM", "20"))
+AGENT_CALLS_PER_SCAN = int(os.environ.get("AGENT_CALLS_PER_SCAN", "12"))
+SCAN_MINUTES = float(os.environ.get("SCAN_MINUTES", "6"))
+MAX_IN_FLIGHT_CAP = int(os.environ.get("MAX_IN_FLIGHT_CAP", "10"))
+
+# === LEASE ===
+# lease phải dài hơn 1 execution bình thường; reaper gia hạn nếu execution vẫn RUNNING
+LEASE_SECONDS = int(os.environ.get("LEASE_SECONDS", "3600"))
+MAX_SCAN_ATTEMPTS = int(os.environ.get("MAX_SCAN_ATTEMPTS", "3"))
+CLAIM_HEADROOM = int(os.environ.get("CLAIM_HEADROOM", "2"))
+
+# === ƯU TIÊN ===
+# điểm = pendingChanges × CHANGE_WEIGHT_HOURS + số giờ từ lần quét trước
+# (1 thay đổi từ AWS Config > repo chưa quét cả 1 chu kỳ tuần, repo đã ở hạn cap)
+CHANGE_WEIGHT_HOURS = float(os.environ.get("CHANGE_WEIGHT_HOURS", "336"))
+STALENESS_CAP_HOURS = float(os.environ.get("STALENESS_CAP_HOURS", "720"))
+# GSI thưa (partition changedScan, sort pendingChanges, project thêm scanStatus, active,
+# detectionMode, scanCycle, lastScanAt): chỉ chứa repo có thay đổi chưa quét.
+# Rỗng = lọc pendingChanges > 0 trên active-scanStatus-index
+CHANGED_INDEX = os.environ.get("CHANGED_INDEX", "")
+CHANGED_SCAN = "CHANGED"   # giá trị changedScan do auto_snapshot ghi, claim thì xoá
+# số repo PENDING tối đa được đọc khi tìm repo có thay đổi bằng filter
+PRIORITY_WINDOW = int(os.environ.get("PRIORITY_WINDOW", "1000"))
+
+# === RESET ===
+RESET_SCAN_SEGMENTS = int(os.environ.get("RESET_SCAN_SEGMENTS", "4"))   # parallel scan
+RESET_CONCURRENCY = int(os.environ.get("RESET_CONCURRENCY", "32"))      # update_item song song
+RESET_PROGRESS_EVERY = int(os.environ.get("RESET_PROGRESS_EVERY", "1000"))
+
+# === WORK QUEUE ===
+# có SCAN_QUEUE_URL: reset đẩy 1 message / repo, worker (SQS trigger hoặc event "scan")
+# nhận theo batch; report lambda gửi message "completed" thay vì self-invoke orchestrator
+work_queue = build_work_queue()
+# hết slot → message hiện lại sau chừng này giây
+SLOT_RETRY_SECONDS = int(os.environ.get("SLOT_RETRY_SECONDS", "60"))
+# dừng drain khi Lambda còn ít hơn chừng này ms
+DRAIN_SAFETY_MS = int(os.environ.get("DRAIN_SAFETY_MS", "30000"))
+
+# thống kê throughput mỗi chu kỳ quét (key: cycleId)
+cycle_table = dynamodb.Table(os.environ.get("SCAN_CYCLE_TABLE", "iacScanCycles"))
 
 
 def now_utc():
@@ -20,75 +75,507 @@ def extract_repo_url(text: str):
     m = re.search(r"https?://github\.com/[a-zA-Z0-9_\-]+/[a-zA-Z0-9_\-]+", text)
     return m.group(0) if m else None
 
+def scan_priority(repo: dict, now: float):
+    changes = int(repo.get("pendingChanges", 0) or 0)
+    staleness = STALENESS_CAP_HOURS
+    if repo.get("lastScanAt"):
+        last = datetime.strptime(repo["lastScanAt"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+        staleness = min(STALENESS_CAP_HOURS, max(0.0, (now - last.timestamp()) / 3600))
+    return changes * CHANGE_WEIGHT_HOURS + staleness
+
+PRIORITY_PROJECTION = "repoUrl, detectionMode, scanCycle, pendingChanges, lastScanAt"
+
+def changed_candidates(n: int):
+    """≤ n repo PENDING có thay đổi chưa quét, điểm cao nhất trước."""
+    if CHANGED_INDEX:
+        # index thưa đã sắp theo pendingChanges giảm dần → top-N chỉ cần đọc đầu index
+        kwargs = dict(
+            IndexName=CHANGED_INDEX,
+            KeyConditionExpression=Key('changedScan').eq(CHANGED_SCAN),
+            FilterExpression=Attr('active').eq('ACTIVE') & Attr('scanStatus').eq('PENDING'),
+            ScanIndexForward=False,
+            Limit=n,
+        )
+    else:
+        kwargs = dict(
+            IndexName='active-scanStatus-index',
+            KeyConditionExpression=Key('active').eq('ACTIVE') & Key('scanStatus').eq('PENDING'),
+            FilterExpression=Attr("pendingChanges").gt(0),
+            Limit=PRIORITY_WINDOW,
+        )
+    kwargs["ProjectionExpression"] = PRIORITY_PROJECTION
+    found, read = [], 0
+    while len(found) < n and read < PRIORITY_WINDOW:
+        response = table.query(**kwargs)
+        found.extend(response.get("Items", []))
+        read += response.get("ScannedCount", len(response.get("Items", [])))
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    now = time.time()
+    return sorted(found, key=lambda repo: scan_priority(repo, now), reverse=True)[:n]
+
+def priority_candidates(n: int, only_changed: bool = False):
+    """
+    n repo PENDING: repo có thay đổi chưa quét trước (changed_candidates),
+    phần còn lại đọc có Limit theo thứ tự active-scanStatus-index.
+    """
+    if n <= 0:
+        return []
+    candidates = changed_candidates(n)
+    if only_changed or len(candidates) >= n:
+        return candidates
+    seen = {repo["repoUrl"] for repo in candidates}
+    kwargs = dict(
+        IndexName='active-scanStatus-index',
+        KeyConditionExpression=Key('active').eq('ACTIVE') & Key('scanStatus').eq('PENDING'),
+        ProjectionExpression=PRIORITY_PROJECTION,
+        Limit=n,
+    )
+    while len(candidates) < n:
+        response = table.query(**kwargs)
+        for repo in response.get("Items", []):
+            if repo["repoUrl"] not in seen and len(candidates) < n:
+                candidates.append(repo)
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return candidates
+
+def max_in_flight():
+    if MAX_IN_FLIGHT > 0:
+        return MAX_IN_FLIGHT
+    derived = int(BEDROCK_AGENT_RPM * SCAN_MINUTES // max(1, AGENT_CALLS_PER_SCAN))
+    return max(1, min(MAX_IN_FLIGHT_CAP, derived))
+
 # --- Handler 1: Reset Weekly ---
 def reset_scan_status():
     print("🔄 Reset scanStatus to PENDING")
-    response = table.scan(
-        FilterExpression=Attr("active").eq("ACTIVE")
-    )
-    for item in response.get("Items", []):
-        table.update_item(
-            Key={"repoUrl": item["repoUrl"]},
-            UpdateExpression="SET scanStatus = :p, updatedAt = :t",
-            ExpressionAttributeValues={":p": "PENDING", ":t": now_utc()},
-        )
-    print("✅ Reset done. Starting first scan...")
+    cycle_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    started = time.time()
+    segments = max(1, RESET_SCAN_SEGMENTS)
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        repo_urls = [url for urls in pool.map(lambda i: scan_active_repos(i, segments), range(segments)) for url in urls]
+    print(f"📋 {len(repo_urls)} active repos listed in {time.time() - started:.1f}s")
+
+    progress = {"done": 0, "failed": []}
+    lock = threading.Lock()
+    updated_at = now_utc()
+
+    def reset_one(repo_url):
+        try:
+            ddb_client.update_item(
+                TableName=table.name,
+                Key={"repoUrl": repo_url},
+                UpdateExpression="SET scanStatus = :p, scanCycle = :c, updatedAt = :t, scanAttempts = :z "
+                                 "REMOVE leaseOwner, leaseExpiresAt, executionArn",
+                ExpressionAttributeValues={":p": "PENDING", ":c": cycle_id, ":t": updated_at, ":z": 0},
+            )
+        except ClientError as e:
+            with lock:
+                progress["failed"].append(repo_url)
+            print(f"⚠️ Reset failed for {repo_url}: {e}")
+            return
+        with lock:
+            progress["done"] += 1
+            if progress["done"] % RESET_PROGRESS_EVERY == 0:
+                print(f"🔄 Reset {progress['done']}/{len(repo_urls)} ({time.time() - started:.1f}s)")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(RESET_CONCURRENCY, len(repo_urls) or 1))) as pool:
+        list(pool.map(reset_one, repo_urls))
+        if work_queue is not None:
+            failed = set(progress["failed"])
+            bodies = [{"kind": "scan", "repoUrl": url, "scanCycle": cycle_id} for url in repo_urls if url not in failed]
+            queued = sum(pool.map(work_queue.send_batch,
+                                  [bodies[i:i + SQS_BATCH] for i in range(0, len(bodies), SQS_BATCH)]))
+            print(f"📨 {queued} scan messages queued")
+
+    start_cycle(cycle_id, progress["done"])
+    print(f"✅ Reset done ({progress['done']} repos, {len(progress['failed'])} failed, "
+          f"{time.time() - started:.1f}s, cycle {cycle_id}). Starting first scans...")
     lambda_client.invoke(
         FunctionName=LAMBDA_NAME,
         InvocationType="Event",
         Payload=json.dumps({"eventName": "scan"})
     )
-    return {"status": "reset_done"}
+    return {"status": "reset_done", "repos": progress["done"], "failed": len(progress["failed"])}
 
 
-# --- Handler 2: Scan Next Repo ---
-def scan_next_repo():
-    response = table.query(
-        IndexName='active-scanStatus-index',
-        KeyConditionExpression=Key('active').eq('ACTIVE') & Key('scanStatus').eq('PENDING')
+def scan_active_repos(segment: int, total_segments: int):
+    """1 segment của parallel scan, đi hết LastEvaluatedKey, chỉ lấy repoUrl."""
+    kwargs = dict(
+        TableName=table.name,
+        ProjectionExpression="repoUrl",
+        FilterExpression=Attr("active").eq("ACTIVE"),
+        Segment=segment,
+        TotalSegments=total_segments,
     )
-    items = response.get("Items", [])
-    if not items:
+    repo_urls = []
+    while True:
+        response = ddb_client.scan(**kwargs)
+        repo_urls.extend(item["repoUrl"] for item in response.get("Items", []))
+        if "LastEvaluatedKey" not in response:
+            return repo_urls
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+# --- Handler 2: Scan Next Repo ---
+def scan_next_repo(owner: str = None):
+    """Lấp đầy các slot trống: giữ tối đa K lease IN_PROGRESS còn hạn cùng lúc."""
+    owner = owner or uuid.uuid4().hex
+    limit = max_in_flight()
+    in_flight = reap_expired_leases()
+    free = limit - in_flight
+    if free <= 0:
+        print(f"⏳ {in_flight}/{limit} executions in flight, no free slot.")
+        return {"status": "busy", "in_flight": in_flight, "limit": limit}
+
+    # repo có nhiều thay đổi chưa quét / lâu chưa quét đi trước (dư 1 chút vì worker khác có thể claim trước)
+    candidates = priority_candidates(free + CLAIM_HEADROOM)
+    started, cycle_id = [], None
+    for repo in candidates:
+        if len(started) >= free:
+            break
+        if claim_repo(repo["repoUrl"], owner) and start_repo_scan(repo, owner):
+            started.append(repo["repoUrl"])
+            cycle_id = cycle_id or repo.get("scanCycle")
+            if repo.get("pendingChanges"):
+                print(f"🎯 {repo['repoUrl']} prioritized: {int(repo['pendingChanges'])} pending changes")
+
+    if not candidates:
         print("✅ No more repos to scan.")
-        return {"status": "done"}
+        return {"status": "done", "in_flight": in_flight}
+    record_in_flight(cycle_id, in_flight + len(started))
+    print(f"🚀 Started {len(started)} scans ({in_flight + len(started)}/{limit} in flight, owner {owner})")
+    return {"status": "started", "repos": started, "in_flight": in_flight + len(started), "limit": limit}
+
+
+def claim_repo(repo_url: str, owner: str):
+    """PENDING → IN_PROGRESS có điều kiện + lease (owner, hết hạn). False nếu worker khác đã claim."""
+    now = int(time.time())
+    try:
+        table.update_item(
+            Key={"repoUrl": repo_url},
+            UpdateExpression="SET scanStatus = :s, updatedAt = :t, scanStartedAt = :e, "
+                             "leaseOwner = :o, leaseExpiresAt = :x, pendingChanges = :z REMOVE changedScan",
+            ConditionExpression="scanStatus = :p",
+            ExpressionAttributeValues={
+                ":s": "IN_PROGRESS", ":p": "PENDING", ":t": now_utc(), ":e": now,
+                ":o": owner, ":x": now + LEASE_SECONDS, ":z": 0,
+            }
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            print(f"↪️ {repo_url} already claimed by another worker")
+            return False
+        raise
 
-    repo = items[0]
+
+def start_repo_scan(repo, owner: str):
     repo_url = repo["repoUrl"]
+    payload = {
+        "query": f"Hãy so sánh drift toàn bộ resource trong repo {repo_url}",
+        "type": "full_scan",
+        "detection_mode": repo.get("detectionMode", DETECTION_MODE)
+    }
 
-    # mark in-progress
+    try:
+        execution = sf.start_execution(
+            stateMachineArn=STEP_FUNCTION_ARN,
+            input=json.dumps(payload)
+        )
+    except ClientError as e:
+        # không start được → trả lease ngay, không chờ hết hạn
+        print(f"⚠️ Start execution failed for {repo_url}: {e}")
+        release_lease(repo_url, owner, "PENDING")
+        return False
     table.update_item(
         Key={"repoUrl": repo_url},
-        UpdateExpression="SET scanStatus = :s, updatedAt = :t",
-        ExpressionAttributeValues={":s": "IN_PROGRESS", ":t": now_utc()}
+        UpdateExpression="SET executionArn = :a",
+        ConditionExpression="leaseOwner = :o",
+        ExpressionAttributeValues={":a": execution.get("executionArn", ""), ":o": owner},
     )
+    print(f"🚀 Step Function triggered for: {repo_url}")
+    return True
 
-    payload = {
-        "query": f"Hãy so sánh drift toàn bộ resource trong repo {repo_url}",
-        "type": "full_scan"
+
+def release_lease(repo_url: str, owner: str, status: str):
+    try:
+        table.update_item(
+            Key={"repoUrl": repo_url},
+            UpdateExpression="SET scanStatus = :s, updatedAt = :t REMOVE leaseOwner, leaseExpiresAt",
+            ConditionExpression="leaseOwner = :o",
+            ExpressionAttributeValues={":s": status, ":t": now_utc(), ":o": owner},
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise
+
+
+# --- Queue worker ---
+def queue_worker(owner: str):
+    """
+    Handler cho message của work queue + budget slot dùng chung trong 1 invocation.
+    "scan": claim + start nếu còn slot, hết slot → RetryLater; "completed": ghi thống kê.
+    """
+    limit = max_in_flight()
+    in_flight = reap_expired_leases()
+    state = {"free": limit - in_flight, "in_flight": in_flight, "started": [], "cycle": None}
+    lock = threading.Lock()
+
+    def take_slot():
+        with lock:
+            if state["free"] <= 0:
+                return False
+            state["free"] -= 1
+            return True
+
+    def give_back():
+        with lock:
+            state["free"] += 1
+
+    def handle(body: dict):
+        if body.get("kind") == "completed":
+            record_completion(body["repoUrl"])
+            return
+        repo_url = body["repoUrl"]
+        if not take_slot():
+            raise RetryLater("no free slot", SLOT_RETRY_SECONDS)
+        repo = table.get_item(
+            Key={"repoUrl": repo_url},
+            ProjectionExpression="repoUrl, scanStatus, detectionMode, scanCycle",
+        ).get("Item")
+        if not repo or repo.get("scanStatus") != "PENDING" or repo.get("scanCycle") != body.get("scanCycle"):
+            # message cũ (repo đã xong / đã bị claim / thuộc chu kỳ trước) → bỏ
+            give_back()
+            print(f"↪️ Skip stale scan message for {repo_url}")
+            return
+        if not claim_repo(repo_url, owner):
+            give_back()
+            return
+        if not start_repo_scan(repo, owner):
+            give_back()
+            raise RuntimeError(f"Could not start execution for {repo_url}")
+        with lock:
+            state["started"].append(repo_url)
+            state["cycle"] = state["cycle"] or repo.get("scanCycle")
+
+    # repo có thay đổi từ AWS Config được start trước các message theo thứ tự reset;
+    # message của chúng về sau thành stale và bị bỏ
+    for repo in priority_candidates(state["free"], only_changed=True):
+        if not take_slot():
+            break
+        if claim_repo(repo["repoUrl"], owner) and start_repo_scan(repo, owner):
+            state["started"].append(repo["repoUrl"])
+            state["cycle"] = state["cycle"] or repo.get("scanCycle")
+        else:
+            give_back()
+
+    return handle, state
+
+
+def finish_queue_batch(state: dict, outcome: dict):
+    in_flight = state["in_flight"] + len(state["started"])
+    record_in_flight(state["cycle"], in_flight)
+    depth = work_queue.depth()
+    print(f"📨 Queue batch: {len(outcome['done'])} done, {len(outcome['retried'])} retried, "
+          f"{len(outcome['dead'])} dead-lettered | started {len(state['started'])} "
+          f"({in_flight}/{max_in_flight()} in flight) | queue depth {json.dumps(depth)}")
+    return {
+        "status": "queue",
+        "repos": state["started"],
+        "in_flight": in_flight,
+        "retried": len(outcome["retried"]),
+        "dead": len(outcome["dead"]),
+        "queue_depth": depth,
     }
 
-    sf.start_execution(
-        stateMachineArn=STEP_FUNCTION_ARN,
-        input=json.dumps(payload)
+
+def handle_queue_records(records: list, owner: str):
+    """SQS event source mapping: message lỗi/chưa xử lý trả về qua batchItemFailures."""
+    handle, state = queue_worker(owner)
+    outcome = process_batch(work_queue, [Message.from_record(r) for r in records], handle)
+    result = finish_queue_batch(state, outcome)
+    # message chờ slot / lỗi đã được gửi lại thành message mới; chỉ message không gửi lại được trả về SQS
+    result["batchItemFailures"] = [{"itemIdentifier": message_id} for message_id in outcome["unacked"]]
+    return result
+
+
+def drain_queue(owner: str, context=None):
+    """Pull mode (event "scan"): nhận batch đến khi hết slot, queue rỗng hoặc sắp hết giờ Lambda."""
+    handle, state = queue_worker(owner)
+    deadline = None
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        deadline = time.time() + (context.get_remaining_time_in_millis() - DRAIN_SAFETY_MS) / 1000
+    outcome = drain(work_queue, handle, lambda: state["free"], deadline=deadline)
+    return finish_queue_batch(state, outcome)
+
+
+# --- Reaper ---
+def reap_expired_leases():
+    """
+    Lease IN_PROGRESS hết hạn: execution còn RUNNING → gia hạn; đã dừng/không rõ
+    → trả về PENDING (quá MAX_SCAN_ATTEMPTS lần → FAILED). Trả số lease còn sống.
+    """
+    now = int(time.time())
+    kwargs = dict(
+        IndexName='active-scanStatus-index',
+        KeyConditionExpression=Key('active').eq('ACTIVE') & Key('scanStatus').eq('IN_PROGRESS'),
+        ProjectionExpression="repoUrl, leaseOwner, leaseExpiresAt, executionArn, scanAttempts",
     )
+    live = reaped = 0
+    while True:
+        response = table.query(**kwargs)
+        for item in response.get("Items", []):
+            if int(item.get("leaseExpiresAt", 0)) > now:
+                live += 1
+            elif renew_or_reap(item, now):
+                live += 1
+            else:
+                reaped += 1
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    if reaped:
+        print(f"🧹 Reaped {reaped} expired leases ({live} still in flight)")
+    return live
+
+
+def renew_or_reap(item, now: int):
+    """True nếu lease được gia hạn (execution vẫn chạy)."""
+    repo_url, owner = item["repoUrl"], item.get("leaseOwner")
+    status = None
+    if item.get("executionArn"):
+        try:
+            status = sf.describe_execution(executionArn=item["executionArn"]).get("status")
+        except ClientError as e:
+            print(f"⚠️ describe_execution failed for {repo_url}: {e}")
+    if status == "RUNNING":
+        try:
+            table.update_item(
+                Key={"repoUrl": repo_url},
+                UpdateExpression="SET leaseExpiresAt = :x",
+                ConditionExpression="leaseOwner = :o AND leaseExpiresAt = :old",
+                ExpressionAttributeValues={":x": now + LEASE_SECONDS, ":o": owner,
+                                           ":old": item.get("leaseExpiresAt")},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+        return True
+    attempts = int(item.get("scanAttempts", 0)) + 1
+    next_status = "FAILED" if attempts >= MAX_SCAN_ATTEMPTS else "PENDING"
+    try:
+        table.update_item(
+            Key={"repoUrl": repo_url},
+            UpdateExpression="SET scanStatus = :s, scanAttempts = :n, updatedAt = :t "
+                             "REMOVE leaseOwner, leaseExpiresAt, executionArn",
+            ConditionExpression="scanStatus = :ip AND leaseOwner = :o",
+            ExpressionAttributeValues={":s": next_status, ":n": attempts, ":t": now_utc(),
+                                       ":ip": "IN_PROGRESS", ":o": owner},
+        )
+        print(f"🧹 Lease expired for {repo_url} (execution {status or 'unknown'}) → {next_status}")
+        if next_status == "FAILED":
+            # bỏ cuộc: tính là đã xong trong thống kê chu kỳ
+            record_completion(repo_url)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+    return False
 
-    print(f"🚀 Step Function triggered for: {repo_url}")
-    return {"status": "started", "repo": repo_url}
+
+# --- Thống kê chu kỳ ---
+def start_cycle(cycle_id: str, total: int):
+    cycle_table.put_item(Item={
+        "cycleId": cycle_id,
+        "startedAt": int(time.time()),
+        "totalRepos": total,
+        "completed": 0,
+        "latencySeconds": 0,
+        "peakInFlight": 0,
+        "inFlightLimit": max_in_flight(),
+    })
+
+def record_in_flight(cycle_id, in_flight: int):
+    if not cycle_id or not in_flight:
+        return
+    try:
+        cycle_table.update_item(
+            Key={"cycleId": cycle_id},
+            UpdateExpression="SET peakInFlight = :n",
+            ConditionExpression="peakInFlight < :n",
+            ExpressionAttributeValues={":n": in_flight},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+
+def record_completion(repo_url: str):
+    """Gọi khi combined report báo 1 repo xong (ScanNextRepo có repoUrl)."""
+    repo = table.get_item(Key={"repoUrl": repo_url}).get("Item") or {}
+    cycle_id = repo.get("scanCycle")
+    if not cycle_id:
+        return
+    now = int(time.time())
+    latency = max(0, now - int(repo.get("scanStartedAt", now)))
+    cycle = cycle_table.update_item(
+        Key={"cycleId": cycle_id},
+        UpdateExpression="ADD completed :one, latencySeconds :lat",
+        ExpressionAttributeValues={":one": 1, ":lat": latency},
+        ReturnValues="ALL_NEW",
+    )["Attributes"]
+    completed, total = int(cycle["completed"]), int(cycle["totalRepos"])
+    elapsed = max(1, now - int(cycle["startedAt"]))
+    stats = {
+        "cycle": cycle_id,
+        "completed": completed,
+        "total": total,
+        "elapsed_s": elapsed,
+        "repos_per_hour": round(completed * 3600 / elapsed, 2),
+        "avg_latency_s": round(int(cycle["latencySeconds"]) / completed, 1),
+        "peak_in_flight": int(cycle.get("peakInFlight", 0)),
+        "limit": int(cycle.get("inFlightLimit", 0)),
+    }
+    print(f"📈 Repo {repo_url} done in {latency}s | cycle stats: {json.dumps(stats)}")
+    if completed >= total:
+        cycle_table.update_item(
+            Key={"cycleId": cycle_id},
+            UpdateExpression="SET finishedAt = :t, reposPerHour = :r",
+            ExpressionAttributeValues={":t": now, ":r": str(stats["repos_per_hour"])},
+        )
+        print(f"🏁 Cycle {cycle_id} finished: {json.dumps(stats)}")
 
 
 # --- Master Handler ---
 def lambda_handler(event, context):
+    owner = getattr(context, "aws_request_id", None) or uuid.uuid4().hex
+    if event.get("Records") and work_queue is not None:
+        # 📨 SQS trigger: batch message scan / completed
+        return handle_queue_records(event["Records"], owner)
+
     event_name = event.get("eventName")
     query = event.get("query", "").strip()
     repo_url = extract_repo_url(query)
     print(f"🔍 Event: {event_name}, Query: {query}, Repo: {repo_url}")
     
-    event["repoUrl"] = repo_url
+    event["repoUrl"] = repo_url or event.get("repoUrl")
 
     if event_name == "reset":
         return reset_scan_status()
 
     if event_name == "scan":
-        return scan_next_repo()
+        return drain_queue(owner, context) if work_queue is not None else scan_next_repo(owner)
+
+    if event_name == "reap":
+        return {"status": "reaped", "in_flight": reap_expired_leases()}
+
+    if event_name == "ScanNextRepo":
+        # chuỗi cũ (không có queue): 1 execution vừa xong → ghi thống kê rồi lấp slot trống
+        if event["repoUrl"]:
+            record_completion(event["repoUrl"])
+        return drain_queue(owner, context) if work_queue is not None else scan_next_repo(owner)
 
     return {"error": f"Unknown eventName: {event_name}"}
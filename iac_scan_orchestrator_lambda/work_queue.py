@@ -0,0 +1,290 @@
+# ========================================
+# work_queue.py — HÀNG ĐỢI CÔNG VIỆC CHO SCAN SCHEDULER (SQS + BẢN IN-MEMORY ĐỂ TEST)
+# ========================================
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+# rỗng = không dùng queue (chuỗi self-invoke cũ); "memory" = in-memory
+SCAN_QUEUE_URL = os.environ.get("SCAN_QUEUE_URL", "")
+SCAN_DLQ_URL = os.environ.get("SCAN_DLQ_URL", "")
+VISIBILITY_TIMEOUT = int(os.environ.get("QUEUE_VISIBILITY_TIMEOUT", "300"))
+# số lần xử lý lỗi thật (exception / Lambda chết giữa chừng) trước khi vào DLQ;
+# chờ slot (RetryLater) không tính
+MAX_RECEIVES = int(os.environ.get("QUEUE_MAX_RECEIVES", "5"))
+RETRY_BASE_SECONDS = int(os.environ.get("QUEUE_RETRY_BASE_SECONDS", "30"))
+MAX_VISIBILITY = 12 * 3600   # giới hạn của SQS
+MAX_DELAY = 900              # DelaySeconds tối đa của SQS
+FAILURES_KEY = "failures"    # số lần lỗi thật, mang theo khi gửi lại message
+SQS_BATCH = 10
+
+
+class RetryLater(Exception):
+    """Handler chưa xử lý được (vd hết slot) → message hiện lại sau delay giây."""
+
+    def __init__(self, reason: str = "", delay: int = None):
+        super().__init__(reason)
+        self.delay = delay
+
+
+class Message:
+    def __init__(self, message_id: str, body: dict, receipt: str, receive_count: int = 1):
+        self.id = message_id
+        self.body = body
+        self.receipt = receipt
+        self.receive_count = receive_count
+
+    @classmethod
+    def from_record(cls, record: dict):
+        """Record của Lambda SQS event source mapping."""
+        return cls(
+            record["messageId"],
+            json.loads(record["body"]),
+            record["receiptHandle"],
+            int(record.get("attributes", {}).get("ApproximateReceiveCount", 1)),
+        )
+
+
+def retry_delay(receive_count: int):
+    return min(MAX_VISIBILITY, RETRY_BASE_SECONDS * 2 ** max(0, receive_count - 1))
+
+
+def failure_count(message: Message):
+    """
+    Lỗi thật của message: số đã mang theo trong body + các lần nhận trước của
+    bản hiện tại không kết thúc sạch (Lambda timeout/crash trước khi kịp ack).
+    """
+    carried = message.body.get(FAILURES_KEY, 0) if isinstance(message.body, dict) else 0
+    return int(carried or 0) + max(0, message.receive_count - 1)
+
+
+def with_failures(body, failures: int):
+    if not isinstance(body, dict):
+        return body
+    body = {k: v for k, v in body.items() if k != FAILURES_KEY}
+    if failures:
+        body[FAILURES_KEY] = failures
+    return body
+
+
+class SqsWorkQueue:
+    def __init__(self, queue_url: str, dlq_url: str = SCAN_DLQ_URL, visibility_timeout: int = VISIBILITY_TIMEOUT):
+        import boto3
+        self.sqs = boto3.client("sqs")
+        self.queue_url = queue_url
+        self.dlq_url = dlq_url
+        self.visibility_timeout = visibility_timeout
+
+    def send_batch(self, bodies: list, delay_seconds: int = 0):
+        sent = 0
+        for i in range(0, len(bodies), SQS_BATCH):
+            entries = [
+                {"Id": str(j), "MessageBody": json.dumps(body), "DelaySeconds": delay_seconds}
+                for j, body in enumerate(bodies[i:i + SQS_BATCH])
+            ]
+            response = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            failed = response.get("Failed", [])
+            if failed:
+                # thử lại 1 lần các entry lỗi (throttle...), vẫn lỗi thì báo
+                retry = [e for e in entries if e["Id"] in {f["Id"] for f in failed}]
+                failed = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=retry).get("Failed", [])
+                if failed:
+                    raise RuntimeError(f"SQS send_message_batch failed for {len(failed)} messages: {failed[:3]}")
+            sent += len(entries)
+        return sent
+
+    def receive(self, max_messages: int = SQS_BATCH, wait_seconds: int = 0):
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=max(1, min(SQS_BATCH, max_messages)),
+            WaitTimeSeconds=wait_seconds,
+            VisibilityTimeout=self.visibility_timeout,
+            AttributeNames=["ApproximateReceiveCount"],
+        )
+        return [
+            Message(m["MessageId"], json.loads(m["Body"]), m["ReceiptHandle"],
+                    int(m.get("Attributes", {}).get("ApproximateReceiveCount", 1)))
+            for m in response.get("Messages", [])
+        ]
+
+    def delete_batch(self, messages: list):
+        for i in range(0, len(messages), SQS_BATCH):
+            self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=[
+                {"Id": str(j), "ReceiptHandle": m.receipt} for j, m in enumerate(messages[i:i + SQS_BATCH])
+            ])
+
+    def retry_later(self, message: Message, delay: int):
+        self.sqs.change_message_visibility(
+            QueueUrl=self.queue_url, ReceiptHandle=message.receipt, VisibilityTimeout=min(MAX_VISIBILITY, delay)
+        )
+
+    def dead_letter(self, message: Message, reason: str):
+        if self.dlq_url:
+            self.sqs.send_message(QueueUrl=self.dlq_url, MessageBody=json.dumps({
+                "body": message.body, "reason": reason, "receive_count": message.receive_count
+            }))
+        self.delete_batch([message])
+
+    def depth(self):
+        attrs = self.sqs.get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=["ApproximateNumberOfMessages", "ApproximateNumberOfMessagesNotVisible"],
+        ).get("Attributes", {})
+        return {
+            "visible": int(attrs.get("ApproximateNumberOfMessages", 0)),
+            "in_flight": int(attrs.get("ApproximateNumberOfMessagesNotVisible", 0)),
+        }
+
+
+class MemoryWorkQueue:
+    """Stand-in local/test cho SQS: cùng API, visibility timeout theo đồng hồ truyền vào."""
+
+    def __init__(self, visibility_timeout: int = VISIBILITY_TIMEOUT, clock=time.time):
+        self.visibility_timeout = visibility_timeout
+        self.clock = clock
+        self.messages = {}        # id -> {"body", "visible_at", "receive_count", "receipt"}
+        self.dead_letters = []
+        self._lock = threading.Lock()
+
+    def send_batch(self, bodies: list, delay_seconds: int = 0):
+        with self._lock:
+            for body in bodies:
+                self.messages[uuid.uuid4().hex] = {
+                    "body": json.loads(json.dumps(body)), "visible_at": self.clock() + delay_seconds,
+                    "receive_count": 0, "receipt": None,
+                }
+        return len(bodies)
+
+    def receive(self, max_messages: int = SQS_BATCH, wait_seconds: int = 0):
+        now, received = self.clock(), []
+        with self._lock:
+            for message_id, m in self.messages.items():
+                if len(received) >= min(SQS_BATCH, max_messages):
+                    break
+                if m["visible_at"] > now:
+                    continue
+                m["receive_count"] += 1
+                m["receipt"] = uuid.uuid4().hex
+                m["visible_at"] = now + self.visibility_timeout
+                received.append(Message(message_id, m["body"], m["receipt"], m["receive_count"]))
+        return received
+
+    def _find(self, message: Message):
+        m = self.messages.get(message.id)
+        return m if m and m["receipt"] == message.receipt else None
+
+    def delete_batch(self, messages: list):
+        with self._lock:
+            for message in messages:
+                if self._find(message):
+                    del self.messages[message.id]
+
+    def retry_later(self, message: Message, delay: int):
+        with self._lock:
+            m = self._find(message)
+            if m:
+                m["visible_at"] = self.clock() + min(MAX_VISIBILITY, delay)
+
+    def dead_letter(self, message: Message, reason: str):
+        self.dead_letters.append({"body": message.body, "reason": reason, "receive_count": message.receive_count})
+        self.delete_batch([message])
+
+    def depth(self):
+        now = self.clock()
+        with self._lock:
+            visible = sum(1 for m in self.messages.values() if m["visible_at"] <= now)
+            return {"visible": visible, "in_flight": len(self.messages) - visible}
+
+
+def build_work_queue():
+    if not SCAN_QUEUE_URL:
+        return None
+    if SCAN_QUEUE_URL == "memory":
+        return MemoryWorkQueue()
+    return SqsWorkQueue(SCAN_QUEUE_URL)
+
+
+def process_batch(queue, messages: list, handler, concurrency: int = 1):
+    """
+    Chạy handler(body) cho từng message (song song ≤ concurrency).
+    OK → xoá; RetryLater/lỗi → gửi lại thành message mới với DelaySeconds và xoá bản cũ,
+    nên ApproximateReceiveCount không bị cộng dồn bởi các lần chờ slot. Số lỗi thật
+    được mang theo trong body (FAILURES_KEY); lỗi thứ MAX_RECEIVES → DLQ.
+    Trả {"done", "retried", "dead", "unacked"} (list message id); "unacked" là message
+    gửi lại không được, để SQS tự hiện lại sau backoff (batchItemFailures).
+    """
+    outcome = {"done": [], "retried": [], "dead": [], "unacked": []}
+
+    def run(message):
+        try:
+            handler(message.body)
+            return message, "done", None
+        except RetryLater as e:
+            return message, "retry", e
+        except Exception as e:
+            logger.exception(f"Work item {message.id} failed (failure #{failure_count(message) + 1})")
+            return message, "retry", e
+
+    if concurrency > 1 and len(messages) > 1:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(messages))) as pool:
+            results = list(pool.map(run, messages))
+    else:
+        results = [run(m) for m in messages]
+
+    done, resend = [], {}   # delay -> [(message, body mới)]
+    for message, status, error in results:
+        if status == "done":
+            done.append(message)
+            outcome["done"].append(message.id)
+            continue
+        failures = failure_count(message)
+        if isinstance(error, RetryLater):
+            delay = error.delay or retry_delay(1)
+        else:
+            failures += 1
+            if failures >= MAX_RECEIVES:
+                queue.dead_letter(message, f"{type(error).__name__}: {error}")
+                outcome["dead"].append(message.id)
+                continue
+            delay = retry_delay(failures)
+        resend.setdefault(min(MAX_DELAY, delay), []).append((message, with_failures(message.body, failures)))
+
+    for delay, entries in resend.items():
+        try:
+            queue.send_batch([body for _, body in entries], delay_seconds=delay)
+        except Exception:
+            logger.exception(f"Could not re-enqueue {len(entries)} work items, leaving them to visibility timeout")
+            for message, _ in entries:
+                queue.retry_later(message, delay)
+                outcome["unacked"].append(message.id)
+            continue
+        done.extend(message for message, _ in entries)
+        outcome["retried"].extend(message.id for message, _ in entries)
+    if done:
+        queue.delete_batch(done)
+    return outcome
+
+
+def drain(queue, handler, budget, concurrency: int = 1, deadline: float = None):
+    """
+    Pull mode: nhận batch và xử lý đến khi queue rỗng, budget() ≤ 0
+    (hết slot) hoặc quá deadline (epoch giây). Trả tổng outcome.
+    """
+    totals = {"done": [], "retried": [], "dead": [], "unacked": []}
+    while deadline is None or time.time() < deadline:
+        free = budget()
+        if free <= 0:
+            break
+        messages = queue.receive(max_messages=free)
+        if not messages:
+            break
+        outcome = process_batch(queue, messages, handler, concurrency)
+        for key in totals:
+            totals[key].extend(outcome[key])
+    return totals
@@ -7,7 +7,14 @@ import time
 import logging
 import boto3
 import re
+import hashlib
 from botocore.config import Config
+from terraform_log_parser import parse_terraform_log
+from resource_resolver import ResourceResolver, iac_name_hints
+from kb_documents import KB_BUCKET, load_iac_documents, load_state_documents
+from json_repair import extract_json_from_text
+from chunk_assembler import ChunkAssembler
+from ownership_index import ownership_index, resource_identifier
 
 config = Config(
     retries={
@@ -27,6 +34,8 @@ def log_info(obj):
 REGION = os.environ.get("AWS_REGION", "us-east-1")
 AGENT_ID = os.environ.get("AGENT_ID", "LBQSCKGFJM")
 AGENT_ALIAS_ID = os.environ.get("AGENT_ALIAS_ID", "DTC1TK3HZA")
+# kiểm tra resource unmanaged của log CICD tốn 1 lần gọi agent / log → bật khi cần
+UNMANAGED_CHECK = os.environ.get("UNMANAGED_CHECK", "false").lower() == "true"
 bedrock = boto3.client("bedrock-agent-runtime", region_name=REGION, config=config)
 
 # ========================================
@@ -37,13 +46,25 @@ def lambda_handler(event, context):
 
     log_info({"step": "start", "type": query_type, "query_length": len(query)})
 
-    if query_type == "cicd_log":
+    if query_type == "cicd_log" and event.get("source") == "plan_json":
+        # plan JSON đã được parse ở cicd_step_state_lambda
+        cicd_drift = event.get("cicd_drift", {})
+        result = {
+            "cicd_drift": cicd_drift,
+            # drifted có thể chỉ là page 1 (page sau nằm trên S3, page_uris) → dùng total_drifts
+            "summary": f"{cicd_drift.get('total_refreshed', 0)} managed, "
+                       f"{cicd_drift.get('total_drifts', len(cicd_drift.get('drifted', [])))} drifted"
+        }
+    elif query_type == "cicd_log":
         result = parse_cicd_log(query)
     elif query_type == "full_scan":
         repo_url = extract_repo_url(query)
         if not repo_url:
             return {"error": "No repo_url found", "type": query_type}
-        result = retrieve_iac_and_state(repo_url)
+        result = retrieve_iac_and_state(repo_url, full_rescan=bool(event.get("full_rescan")))
+        if event.get("target_resources") and "error" not in result:
+            # 🎯 scan có mục tiêu (từ change event): chỉ giữ các resource bị ảnh hưởng
+            result = limit_to_targets(result, event["target_resources"])
     else:
         return {"error": "Invalid type", "type": query_type}
 
@@ -55,107 +76,171 @@ def lambda_handler(event, context):
 
 # ========================================
 def parse_cicd_log(log_text: str):
-    region= "us-east-1"
+    # Parse log bằng code (streaming) — chỉ gọi agent cho bước kiểm tra unmanaged
+    cicd_drift = parse_terraform_log(log_text)
+    refreshed = cicd_drift.pop("refreshed")
+    log_info({"step": "parsed_cicd_log", "total_refreshed": cicd_drift["total_refreshed"],
+              "drifted": len(cicd_drift["drifted"])})
+
+    candidates = [r for r in refreshed if not r["resource_address"].startswith("data.")]
+    if UNMANAGED_CHECK and candidates:
+        cicd_drift["unmanaged"] = find_unmanaged_resources(candidates)
+
+    return {
+        "cicd_drift": cicd_drift,
+        "summary": f"{cicd_drift['total_refreshed']} refreshed, {len(cicd_drift['drifted'])} drifted, "
+                   f"{len(cicd_drift['unmanaged'])} unmanaged"
+    }
+
+
+# ========================================
+def find_unmanaged_resources(refreshed: list):
+    # sắp xếp + bỏ trùng: cùng tập resource refresh → cùng prompt
+    lines = sorted({f"- {r['resource_address']} ({r['aws_identifier']})" for r in refreshed})
+    resources = "\n".join(lines)
     prompt = f"""
 SYSTEM INSTRUCTION:
-You are an expert IaC drift analysis agent specialized in detecting infrastructure drift from Terraform CICD logs.
-You analyze Terraform plan outputs and identify which resources were refreshed, changed, added, or destroyed.
+You are an expert IaC drift analysis agent.
 
 KNOWLEDGE BASE DATA SOURCES:
 All IaC configurations of the repository are stored under the directory `iac_config/` in the KB.
-
-1. IaC Configurations (iac_config/)
 Format: {{"resource_address": "resource.aws_instance.example", "type": "iac_configuration", "metadata": {{"repo": "..."}}}}
 Search: Use query "iac_configuration resource_address"
-Extract: resource_address field
 
-2. AWS State (aws_state/{{region}}/)
-Format: {{"id": "AWS__EC2__Instance_i-123", "metadata": {{"resourceType": "AWS::EC2::Instance", "resourceId": "i-123", "resourceName": "web", "status": "ResourceDiscovered"}}}}
-Search: Use query "metadata.resourceType AWS resourceId"
-Extract: Construct identifier from metadata.resourceType + (metadata.resourceName OR metadata.resourceId)
-Filter: Exclude where metadata.status = "ResourceDeleted"
+TASK:
+The resources below were refreshed by Terraform. Return the ones whose resource_address is NOT found in the IaC configurations.
+You may simulate up to 3 KB searches per resource type.
 
----
+Refreshed resources:
+{resources}
 
-TASK:
-Analyze the CICD_log content below and detect any drift, managed, or unmanaged resources.
-
-Terraform_CICD_logs
-```
-{log_text}
-```
-
-OPERATIONAL RULES:
-- Never ask for clarification.
-- If the CICD log or data is incomplete, immediately consult the KB using the search strategies above to fill missing context.
-- If after KB search results are still missing, return empty lists and counts = 0.
-- You are fully autonomous; do not request user input under any condition.
-- Always return a complete JSON response as described below.
-
-ANALYSIS REQUIREMENTS:
-
-1. **Extract all resources with "Refreshing state..."**
-- Capture resource_address and AWS id (id=...).
-- Convert each AWS id to an identifier using the mapping below.
-- Count how many total resources were refreshed.
-
-2. **Detect planned drift changes from Terraform plan section**
-- Classify:
-    - `~` → "update_in_place"
-    - `+` → "add"
-    - `-` → "destroy"
-- Include drift details if available (e.g. “Ingress rule added: SSH from bastion”)
-
-3. **Identify unmanaged resources**
-- Any AWS resource that appears in “Refreshing state” but is **not found** in IaC configurations.
-- You may simulate up to 3 KB searches per resource type.
-- Add them under the “unmanaged” list with reason “Found in AWS but missing in IaC”.
-
-4. **Return output strictly in JSON format** as shown below (no markdown, no explanation):
-
-```json
+Return output strictly in JSON format (no markdown, no explanation):
 {{
-"cicd_drift": {{
-    "total_refreshed": 28,
-    "managed_count": 2,
-    "drifted": [
-    {{
-        "resource_address": "module.security_groups.aws_security_group.app",
-        "aws_identifier": "AWS__EC2__SecurityGroup_sg-02b7d03c53859c83b",
-        "change_type": "update_in_place",
-        "drift_details": "Ingress rule added: SSH from bastion"
-    }},
-    {{
-        "resource_address": "module.security_groups.aws_security_group.web",
-        "aws_identifier": "AWS__EC2__SecurityGroup_sg-071c0740b90741a4c",
-        "change_type": "update_in_place",
-        "drift_details": "Ingress rule added: SSH from bastion (if needed)"
-    }}
-    ],
-    "unmanaged": [
+"unmanaged": [
     {{
         "aws_identifier": "AWS__EC2__SecurityGroup_sg-0ac94b35c49eced0b",
         "reason": "Found in AWS but missing in IaC"
     }}
-    ]
-}},
-"summary": "28 refreshed, 2 drifted, 1 unmanaged"
+]
 }}
 STRICT INSTRUCTION:
 - Never ask clarification questions.
-- Always proceed even if some inputs (iac_data, state_data, or cicd_drift) are missing or empty.
-- Only include up to 50 high-risk drifts in the output.
-- Never output explanations, reasoning, or commentary outside the JSON.
+- If no resource is unmanaged, return {{"unmanaged": []}}.
 - The output must always be valid JSON following the specified schema.
 """
-    return agent_query(prompt)
+    result = agent_query(prompt)
+    unmanaged = result.get("unmanaged", []) if isinstance(result, dict) else []
+    return unmanaged if isinstance(unmanaged, list) else []
 
 
 
 # ========================================
-def retrieve_iac_and_state(repo_url: str):
+def retrieve_iac_and_state(repo_url: str, full_rescan: bool = False):
     repo_prefix = repo_url.split("/")[-1]
     region = "us-east-1"
+    if KB_BUCKET:
+        # Đọc thẳng document của KB và match bằng resolver — không cần agent
+        return resolve_from_documents(repo_prefix, region, with_fingerprints=not full_rescan, repo_url=repo_url)
+    result = retrieve_with_agent(repo_url, repo_prefix, region)
+    if isinstance(result, dict) and "error" not in result:
+        resolver = ResourceResolver(identifiers=result.get("aws_state_resources") or [])
+        for address in result.get("iac_resources") or []:
+            resolver.match(address)
+        result["resolved_pairs"] = resolver.pairs()
+        update_ownership(repo_url, owned_identifiers(result["resolved_pairs"]))
+    return result
+
+
+# ========================================
+def owned_identifiers(pairs: list, resolver: ResourceResolver = None):
+    """awsIdentifier -> resource_address; thêm alias theo resourceId (change event chỉ có resourceId)."""
+    owned = {}
+    for pair in pairs:
+        owned[pair["aws_identifier"]] = pair["resource_address"]
+        doc = resolver.document(pair["aws_identifier"]) if resolver else None
+        meta = (doc or {}).get("metadata") or {}
+        if meta.get("resourceType") and meta.get("resourceId"):
+            owned.setdefault(resource_identifier(meta["resourceType"], meta["resourceId"]), pair["resource_address"])
+    return owned
+
+
+def update_ownership(repo_url: str, owned: dict):
+    if ownership_index is None or not repo_url:
+        return
+    try:
+        ownership_index.update_repo(repo_url, owned)
+    except Exception as e:
+        logger.warning(f"Ownership index update failed: {str(e)}")
+
+
+def limit_to_targets(result: dict, targets: list):
+    """Cắt inventory về các resource_address mục tiêu (+ identifier AWS đã match của chúng)."""
+    wanted = set(targets)
+    pairs = [p for p in result.get("resolved_pairs") or [] if p["resource_address"] in wanted]
+    identifiers = {p["aws_identifier"] for p in pairs}
+    limited = dict(result)
+    limited["iac_resources"] = [a for a in result.get("iac_resources") or [] if a in wanted]
+    limited["aws_state_resources"] = [i for i in result.get("aws_state_resources") or [] if i in identifiers]
+    limited["resolved_pairs"] = pairs
+    limited["resource_fingerprints"] = {
+        a: fp for a, fp in (result.get("resource_fingerprints") or {}).items() if a in wanted
+    }
+    limited["target_resources"] = [a for a in targets if a in set(limited["iac_resources"])]
+    limited["total_iac"] = len(limited["iac_resources"])
+    limited["total_state"] = len(limited["aws_state_resources"])
+    limited["summary"] = (f"Targeted scan: {len(limited['target_resources'])}/{len(targets)} target resources found, "
+                          f"{len(pairs)} matched in AWS")
+    return limited
+
+
+# ========================================
+def resolve_from_documents(repo_prefix: str, region: str, with_fingerprints: bool = True, repo_url: str = None):
+    iac_docs = load_iac_documents(repo_prefix)
+    resolver = ResourceResolver(state_docs=load_state_documents(region))
+    for doc in iac_docs:
+        resolver.match(doc["resource_address"], iac_name_hints(doc))
+    iac_resources = [doc["resource_address"] for doc in iac_docs]
+    aws_state_resources = list(resolver.documents)
+    pairs = resolver.pairs()
+    update_ownership(repo_url, owned_identifiers(pairs, resolver))
+    fingerprints = {}
+    if with_fingerprints:
+        # detector chỉ phân tích lại resource có fingerprint đổi so với lần scan trước
+        fingerprints = {
+            doc["resource_address"]: resource_fingerprint(
+                doc, resolver.document(resolver.resolve(doc["resource_address"]))
+            )
+            for doc in iac_docs
+        }
+    return {
+        "repo_url": repo_prefix,
+        "iac_resources": iac_resources,
+        "aws_state_resources": aws_state_resources,
+        "resolved_pairs": pairs,
+        "resource_fingerprints": fingerprints,
+        "total_iac": len(iac_resources),
+        "total_state": len(aws_state_resources),
+        "summary": f"{len(iac_resources)} IaC, {len(aws_state_resources)} AWS. {len(pairs)} common."
+    }
+
+
+# ========================================
+def resource_fingerprint(iac_doc: dict, state_doc: dict = None):
+    """Hash của block IaC + configuration AWS Config (nếu đã match)."""
+    state_doc = state_doc or {}
+    payload = json.dumps({
+        "iac": iac_doc.get("content") or iac_doc.get("attributes"),
+        "aws": {
+            "configuration": state_doc.get("configuration"),
+            "tags": state_doc.get("tags"),
+            "status": (state_doc.get("metadata") or {}).get("status"),
+        },
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+# ========================================
+def retrieve_with_agent(repo_url: str, repo_prefix: str, region: str):
     prompt = f"""
 TASK:
 Compare IaC and AWS State resources for repository: {repo_url}, 
@@ -217,122 +302,28 @@ def extract_repo_url(text: str):
 def agent_query(prompt: str):
     print("Invoking Bedrock Agent...")
     log_info(prompt)
-    try:
+
+    def stream_output():
         response = bedrock.invoke_agent(
             agentId=AGENT_ID,
             agentAliasId=AGENT_ALIAS_ID,
             sessionId=f"parser-{int(time.time())}",
             inputText=prompt
         )
-        
-        full_output = ""
-        seen = set()
+
+        assembler = ChunkAssembler("input_parser")
         for event in response.get("completion", []):
-            if "chunk" in event:
-                chunk = event["chunk"]["bytes"].decode("utf-8")
-                h = hash(chunk)
-                if h not in seen:
-                    seen.add(h)
-                    full_output += chunk
-        print("=== [TRACE] Full output ===", full_output)
+            assembler.add_event(event)
+        assembler.log_stats()
+        return assembler.text()
+
+    try:
+        # agent tự search KB → câu trả lời phụ thuộc nội dung KB lúc gọi, không cache theo prompt
+        full_output = stream_output()
+        print(f"=== [TRACE] Full output: {len(full_output)} chars ===")
         return extract_json_from_text(full_output)
         
     except Exception as e:
         log_info({"error": "Agent error", "detail": str(e)})
         return {"error": "Agent failed: "+ str(e)}
 
-
-# ========================================
-def extract_json_from_text(full_text: str):
-    try:
-        print("=== [TRACE] START extract_json_from_text ===", full_text)
-        full_text = full_text.strip()
-        print(f"[TRACE] Raw length: {len(full_text)}")
-
-        # === B1: ƯU TIÊN TÌM JSON OBJECT { ... } ===
-        start_obj = full_text.find('{')
-        end_obj = full_text.rfind('}') + 1
-
-        if start_obj != -1 and end_obj > start_obj:
-            json_str = full_text[start_obj:end_obj]
-            is_array = False
-            print(f"[TRACE] Found JSON object: {len(json_str)} chars")
-        else:
-            # Nếu không có object, thử array
-            start_arr = full_text.find('[')
-            end_arr = full_text.rfind(']') + 1
-            if start_arr != -1 and end_arr > start_arr:
-                json_str = full_text[start_arr:end_arr]
-                is_array = True
-                print(f"[TRACE] Found JSON array: {len(json_str)} chars")
-            else:
-                print("[TRACE] No JSON found")
-                return {}
-
-        # === B2: Fix content bị cắt ===
-        fixed = ""
-        i = 0
-        in_content = False
-
-        while i < len(json_str):
-            if not in_content and json_str[i:i+10] == '"content":':
-                in_content = True
-                fixed += json_str[i:i+10]
-                i += 10
-                quote = json_str.find('"', i)
-                if quote == -1:
-                    fixed += ' ""'
-                    break
-                fixed += json_str[i:quote+1]
-                i = quote + 1
-                continue
-
-            if in_content and json_str[i] == '"' and json_str[i-1] != '\\':
-                next_part = json_str[i+1:i+5]
-                if any(x in next_part for x in [',', '}', '\n', '\r']):
-                    in_content = False
-            fixed += json_str[i]
-            i += 1
-
-        if in_content:
-            fixed += '"INCOMPLETE"'
-
-        json_str = fixed
-
-        # === B3: Dọn phẩy thừa + đóng ngoặc ===
-        json_str = re.sub(r',\s*([\]}])', r'\1', json_str)
-        json_str = re.sub(r',\s*$', '', json_str)
-
-        open_b = json_str.count('{')
-        close_b = json_str.count('}')
-        open_br = json_str.count('[')
-        close_br = json_str.count(']')
-
-        while open_b > close_b:
-            json_str += '}'
-            close_b += 1
-        while open_br > close_br:
-            json_str += ']'
-            close_br += 1
-
-        print(f"[TRACE] Final JSON: {json_str}")
-
-        # === B4: Parse ===
-        try:
-            data = json.loads(json_str)
-            if is_array:
-                print(f"[TRACE] Parsed array: {len(data)} items")
-                return data
-            else:
-                print(f"[TRACE] Parsed object: {list(data.keys())}")
-                return data
-        except json.JSONDecodeError as e:
-            print(f"[TRACE] JSON Error: {e}")
-            print(f"[TRACE] JSON string:\n{json_str[:600]}")
-            return {}  # Luôn trả object nếu là object
-
-    except Exception as e:
-        print(f"[TRACE] Exception: {e}")
-        return {}
-    finally:
-        print("=== [TRACE] END extract_json_from_text ===")
\ No newline at end of file
@@ -0,0 +1,133 @@
+# ========================================
+# terraform_log_parser.py — PARSE TERRAFORM CICD LOG KHÔNG CẦN LLM
+# ========================================
+import io
+import re
+from resource_resolver import to_aws_identifier
+
+CHANGE_TYPES = {
+    "~": "update_in_place",
+    "+": "add",
+    "-": "destroy",
+    "-/+": "replace",
+    "+/-": "replace",
+}
+
+MAX_DETAIL_ITEMS = 5
+
+ANSI_RE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+REFRESH_RE = re.compile(r"(?P<address>[\w\-.\[\]\"]+): Refreshing state\.\.\. \[id=(?P<id>[^\]]+)\]")
+HEADER_RE = re.compile(
+    r"# (?P<address>\S+) (?:will be (?P<verb>created|destroyed|updated in-place|read during apply)"
+    r"|must be (?P<replaced>replaced)|has (?P<changed>changed|been deleted))"
+)
+RESOURCE_RE = re.compile(r"^\s*(?P<marker>-/\+|\+/-|~|\+|-|<=)\s+(?:resource|data)\s+\"(?P<type>[\w-]+)\"")
+ATTRIBUTE_RE = re.compile(r"^\s*(?P<marker>~|\+|-)\s+(?P<name>[\w\-\"]+)\s*(?:=\s*(?P<value>.*))?$")
+CHANGED_OUTSIDE_RE = re.compile(r"Objects have changed outside of Terraform")
+PLAN_ACTIONS_RE = re.compile(r"Terraform will perform the following actions")
+
+
+def parse_terraform_log(lines):
+    """
+    Duyệt log theo từng dòng (streaming), không giữ toàn bộ log trong bộ nhớ.
+    Trả về cấu trúc cicd_drift giống output cũ của agent.
+    """
+    if isinstance(lines, str):
+        lines = io.StringIO(lines)
+
+    refreshed = {}          # resource_address -> aws id
+    drifted = {}            # resource_address -> drift record
+    current = None          # block đang đọc
+    depth = 0
+    outside_section = False
+
+    for raw in lines:
+        line = ANSI_RE.sub("", raw.rstrip("\r\n"))
+
+        m = REFRESH_RE.search(line)
+        if m:
+            refreshed[m.group("address")] = m.group("id").strip()
+            continue
+
+        if CHANGED_OUTSIDE_RE.search(line):
+            outside_section = True
+            continue
+        if PLAN_ACTIONS_RE.search(line):
+            outside_section = False
+            continue
+
+        m = HEADER_RE.search(line)
+        if m:
+            _close_block(current, drifted)
+            current = {"address": m.group("address"), "marker": None, "details": [], "outside": outside_section}
+            depth = 0
+            continue
+
+        if current is None:
+            continue
+
+        if current["marker"] is None:
+            m = RESOURCE_RE.match(line)
+            if m:
+                current["marker"] = m.group("marker")
+                depth = 1 if line.rstrip().endswith("{") else 0
+            continue
+
+        # chỉ lấy attribute cấp 1 của block làm drift_details
+        if depth == 1:
+            m = ATTRIBUTE_RE.match(line)
+            if m and len(current["details"]) < MAX_DETAIL_ITEMS:
+                current["details"].append(_describe_attribute(m))
+        depth += line.count("{") + line.count("[") - line.count("}") - line.count("]")
+        if depth <= 0:
+            _close_block(current, drifted)
+            current = None
+
+    _close_block(current, drifted)
+
+    drifted_list = []
+    for address, record in drifted.items():
+        record["aws_identifier"] = to_aws_identifier(address, refreshed.get(address))
+        drifted_list.append(record)
+
+    return {
+        "total_refreshed": len(refreshed),
+        "managed_count": len(drifted_list),
+        "drifted": drifted_list,
+        "refreshed": [
+            {"resource_address": address, "aws_identifier": to_aws_identifier(address, rid)}
+            for address, rid in refreshed.items()
+        ],
+        "unmanaged": [],
+    }
+
+
+def _describe_attribute(m):
+    marker, name, value = m.group("marker"), m.group("name").strip('"'), (m.group("value") or "").strip()
+    if value in ("", "{", "[", "({", "(["):
+        verb = {"~": "changed", "+": "added", "-": "removed"}[marker]
+        return f"{name} {verb}"
+    return f"{name}: {value}" if marker == "~" else f"{name} {'added' if marker == '+' else 'removed'}: {value}"
+
+
+def _close_block(block, drifted):
+    if not block or not block["marker"] or block["marker"] == "<=":
+        return
+    change_type = CHANGE_TYPES.get(block["marker"], "update_in_place")
+    details = "; ".join(block["details"])
+    if block["outside"]:
+        details = f"Changed outside of Terraform: {details}" if details else "Changed outside of Terraform"
+    existing = drifted.get(block["address"])
+    if existing:
+        # cùng resource xuất hiện ở cả "changed outside" và plan → gộp details
+        if details and details not in existing["drift_details"]:
+            existing["drift_details"] = "; ".join(x for x in [existing["drift_details"], details] if x)
+        if not block["outside"]:
+            existing["change_type"] = change_type
+        return
+    drifted[block["address"]] = {
+        "resource_address": block["address"],
+        "aws_identifier": None,
+        "change_type": change_type,
+        "drift_details": details,
+    }
@@ -0,0 +1,24 @@
+# ========================================
+# conftest.py — CHẠY TEST CÁC MODULE DÙNG CHUNG CỦA LAMBDA (KHÔNG CẦN AWS)
+# ========================================
+# Mỗi lambda import module anh em theo tên (copy giống nhau giữa các package),
+# nên chỉ cần đưa 1 package đại diện cho mỗi nhóm vào sys.path.
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGES = (
+    "drift_detection_normal_lambda",
+    "auto_snapshot_aws_config_lambda",
+    "iac_scan_orchestrator_lambda",
+    "cicd_step_state_lambda",
+)
+
+# backend in-memory cho các module tạo store lúc import
+for name in ("FINGERPRINT_BACKEND", "SNAPSHOT_GATE_BACKEND", "OWNERSHIP_BACKEND", "AGENT_CACHE_BACKEND"):
+    os.environ.setdefault(name, "memory")
+
+for package in reversed(PACKAGES):
+    path = os.path.join(ROOT, package)
+    if path not in sys.path:
+        sys.path.insert(0, path)
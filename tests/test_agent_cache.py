@@ -0,0 +1,35 @@
+from agent_cache import AgentCache, agent_failed, make_key
+
+
+def test_error_marker_is_not_cached():
+    cache = AgentCache()
+    calls = []
+
+    def failing():
+        calls.append(1)
+        return "Agent invoke error: stream closed"
+
+    assert agent_failed(cache.cached_call("policy", "1", {"a": 1}, failing))
+    cache.cached_call("policy", "1", {"a": 1}, failing)
+    assert len(calls) == 2
+
+
+def test_valid_output_is_cached():
+    cache = AgentCache()
+    calls = []
+
+    def ok():
+        calls.append(1)
+        return '{"drifted_resources": []}'
+
+    cache.cached_call("policy", "1", {"a": 1}, ok)
+    assert cache.cached_call("policy", "1", {"a": 1}, ok) == '{"drifted_resources": []}'
+    assert len(calls) == 1
+
+
+def test_content_changes_the_key():
+    inputs = {"iac_data": ["aws_instance.web"], "fingerprints": {"aws_instance.web": "a"}}
+    changed = {"iac_data": ["aws_instance.web"], "fingerprints": {"aws_instance.web": "b"}}
+    assert make_key("policy", "1", inputs) != make_key("policy", "1", changed)
+    # thứ tự list string không ảnh hưởng key
+    assert make_key("policy", "1", {"x": ["b", "a"]}) == make_key("policy", "1", {"x": ["a", "b"]})
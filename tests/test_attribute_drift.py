@@ -0,0 +1,24 @@
+from attribute_drift import comparable, compare_resources
+from resource_resolver import ResourceResolver
+
+
+def sg_docs(iac_groups, aws_groups):
+    iac = [{"resource_address": "aws_instance.web",
+            "attributes": {"instance_type": "t3.micro", "security_groups": iac_groups}}]
+    state = [{"metadata": {"resourceType": "AWS::EC2::Instance", "resourceId": "i-1", "resourceName": "web"},
+              "configuration": {"instanceType": "t3.large", "securityGroups": aws_groups}}]
+    return iac, state
+
+
+def test_comparable_sorts_list_of_dicts():
+    a = [{"groupId": "sg-2", "groupName": "b"}, {"groupId": "sg-1", "groupName": "a"}]
+    assert comparable(a) == comparable(list(reversed(a)))
+    assert comparable([{"x": 1}, "y", [2]]) == comparable([[2], "y", {"x": 1}])
+
+
+def test_list_of_dicts_goes_to_agent_instead_of_crashing():
+    iac, state = sg_docs(["app"], [{"groupId": "sg-1", "groupName": "app"}])
+    drifted, unmapped = compare_resources(iac, state, ResourceResolver(state_docs=state))
+    assert [d["issue"].split(" ")[0] for d in drifted] == ["instance_type"]
+    assert unmapped == [{"resource_address": "aws_instance.web", "aws_identifier": "AWS__EC2__Instance_i-1",
+                         "attributes": ["security_groups"]}]
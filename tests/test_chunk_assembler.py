@@ -0,0 +1,43 @@
+from chunk_assembler import ChunkAssembler
+
+
+def test_repeated_chunks_are_data_not_duplicates():
+    assembler = ChunkAssembler()
+    for part in ('{"a": [', "{}", "},", "{}", "},", "{}]}"):
+        assembler.add(part)
+    assert assembler.text() == '{"a": [{}},{}},{}]}'
+    assert assembler.stats()["chunks"] == 6 and assembler.duplicates == 0
+
+
+def test_utf8_character_split_between_chunks():
+    data = "Cấu hình đã thay đổi ✓".encode("utf-8")
+    for buffer in ("list", "stringio"):
+        assembler = ChunkAssembler(buffer=buffer)
+        for i in range(len(data)):
+            assembler.add(data[i:i + 1])
+        assert assembler.text() == "Cấu hình đã thay đổi ✓"
+        assert assembler.bytes == len(data)
+
+
+def test_out_of_order_sequences_and_resends():
+    assembler = ChunkAssembler()
+    assert assembler.add("c", sequence=2) == ""
+    assert assembler.add("a", sequence=0) == "a"
+    assert assembler.add("a", sequence=0) == ""     # gửi lại
+    assert assembler.add("b", sequence=1) == "bc"
+    assert assembler.text() == "abc"
+    assert assembler.duplicates == 1
+
+
+def test_missing_sequence_keeps_contiguous_prefix():
+    assembler = ChunkAssembler()
+    assembler.add("a", sequence=0)
+    assembler.add("c", sequence=2)
+    assert assembler.text() == "a"
+
+
+def test_completion_events_without_bytes_are_skipped():
+    assembler = ChunkAssembler()
+    events = [{"trace": {}}, {"chunk": {"bytes": b"ok"}}, {"chunk": {}}]
+    assert [assembler.add_event(e) for e in events] == ["", "ok", ""]
+    assert assembler.text() == "ok"
@@ -0,0 +1,87 @@
+import gzip
+import io
+import json
+
+import config_snapshot
+from config_snapshot import SnapshotDelta, diff_sorted, item_key, iter_gzip_chunks, snapshot_scope, sorted_index
+
+
+def ci(resource_id, instance_type="t3.micro", status="OK", capture="2026-01-01T00:00:00Z"):
+    return {
+        "resourceType": "AWS::EC2::Instance", "resourceId": resource_id,
+        "configurationItemStatus": status, "configurationItemCaptureTime": capture,
+        "configuration": {"instanceType": instance_type},
+    }
+
+
+def snapshot(items):
+    data = gzip.compress(json.dumps({"fileVersion": "1.0", "configurationItems": items}).encode("utf-8"))
+    return lambda: iter_gzip_chunks(data[i:i + 97] for i in range(0, len(data), 97))
+
+
+def index_lines(pairs):
+    return [f"{k}\t{h}\n".encode("utf-8") for k, h in pairs]
+
+
+def test_gzip_chunks_are_bounded(monkeypatch):
+    monkeypatch.setattr(config_snapshot, "READ_CHUNK_BYTES", 1024)
+    raw = b"x" * 100_000
+    chunks = list(iter_gzip_chunks([gzip.compress(raw)]))
+    assert b"".join(chunks) == raw
+    assert max(len(c) for c in chunks) <= 1024
+
+
+def test_sorted_index_merges_spilled_runs_and_dedupes():
+    items = [ci(f"i-{i % 50:03d}") for i in range(120)] + [ci("i-999", status="ResourceDeleted")]
+    index = list(sorted_index(items, run_size=7))
+    keys = [k for k, _ in index]
+    assert keys == sorted(set(keys)) and len(keys) == 50
+    assert "AWS__EC2__Instance_i-999" not in keys
+
+
+def test_diff_sorted():
+    previous = iter([("a", "1"), ("b", "1"), ("d", "1")])
+    current = iter([("b", "2"), ("c", "1"), ("d", "1")])
+    assert list(diff_sorted(previous, current)) == [("deleted", "a"), ("changed", "b"), ("added", "c")]
+
+
+def test_first_snapshot_counts_everything_as_added():
+    out = io.StringIO()
+    delta = SnapshotDelta(snapshot([ci("i-1"), ci("i-2")]), (), out)
+    assert delta.compute() == {"added": 2, "changed": 0, "deleted": 0, "unchanged": 0, "total": 2}
+    assert len(out.getvalue().splitlines()) == 2
+
+
+def test_delta_against_previous_index():
+    first = io.StringIO()
+    SnapshotDelta(snapshot([ci("i-1"), ci("i-2"), ci("i-3")]), (), first).compute()
+    previous = index_lines(line.split("\t") for line in first.getvalue().splitlines())
+
+    current = [
+        ci("i-1", capture="2026-02-01T00:00:00Z"),       # chỉ đổi field volatile → không đổi
+        ci("i-2", instance_type="t3.large"),
+        ci("i-3", status="ResourceDeleted"),
+        ci("i-4"),
+    ]
+    delta = SnapshotDelta(snapshot(current), previous, io.StringIO(), run_size=2)
+    assert delta.compute() == {"added": 1, "changed": 1, "deleted": 1, "unchanged": 1, "total": 3}
+    emitted = [(status, item_key(item)) for status, item in delta.items()]
+    assert emitted == [
+        ("changed", "AWS__EC2__Instance_i-2"),
+        ("added", "AWS__EC2__Instance_i-4"),
+        ("deleted", "AWS__EC2__Instance_i-3"),
+    ]
+
+
+def test_unchanged_snapshot_emits_nothing():
+    first = io.StringIO()
+    SnapshotDelta(snapshot([ci("i-1")]), (), first).compute()
+    delta = SnapshotDelta(snapshot([ci("i-1")]), index_lines(l.split("\t") for l in first.getvalue().splitlines()))
+    assert delta.compute()["unchanged"] == 1
+    assert list(delta.items()) == []
+
+
+def test_snapshot_scope():
+    key = "AWSLogs/123/Config/us-east-1/2026/1/1/ConfigSnapshot/123_Config_us-east-1_ConfigSnapshot_x.json.gz"
+    assert snapshot_scope(key) == "123/us-east-1"
+    assert snapshot_scope("other/key.json") == "default"
@@ -0,0 +1,48 @@
+from event_schema import EventSchema, compile_path, resolve_path
+
+SCHEMA = EventSchema({
+    "query": ("query|input.query", str),
+    "type": ("type|input.type|parsed.type", str),
+    "iac_resources": ("iac_resources|parsed.iac_resources|input_parser.iac_resources", list),
+    "detections": ("detections[].drifted_resources[]", dict),
+}, required=("query", "type"))
+
+
+def test_compile_path():
+    assert compile_path("detections[].normal") == ("detections", "[]", "normal")
+    assert compile_path("[].a") == ("[]", "a")
+
+
+def test_payload_is_unwrapped():
+    event = {"input_parser": {"Payload": {"iac_resources": ["aws_instance.web"]}}}
+    assert list(resolve_path(event, compile_path("input_parser.iac_resources"))) == [["aws_instance.web"]]
+
+
+def test_first_path_wins_and_nested_paths_are_used():
+    event = {
+        "input": {"query": "scan https://github.com/o/r", "type": "full_scan"},
+        "parsed": {"Payload": {"iac_resources": ["a"], "type": "full_scan"}},
+    }
+    values, report = SCHEMA.extract(event)
+    assert values == {"query": "scan https://github.com/o/r", "type": "full_scan", "iac_resources": ["a"]}
+    assert report.missing == ["detections"]
+    assert report.duplicates == [] and not SCHEMA.needs_fallback(report)
+
+
+def test_conflicting_values_are_reported():
+    values, report = SCHEMA.extract({"query": "q", "type": "full_scan", "input": {"type": "cicd_log"}})
+    assert values["type"] == "full_scan"
+    assert report.duplicates == ["type"]
+
+
+def test_wrong_type_is_invalid_and_required_missing_needs_fallback():
+    values, report = SCHEMA.extract({"query": ["not", "a", "string"], "something": {"type": "full_scan"}})
+    assert "query" not in values
+    assert report.invalid == [("query", "list")]
+    assert SCHEMA.needs_fallback(report)
+
+
+def test_list_segments_only_iterate_lists():
+    event = {"detections": [{"drifted_resources": [{"r": 1}]}, {"drifted_resources": {"r": 2}}]}
+    values, _ = SCHEMA.extract({"query": "q", "type": "t", **event})
+    assert values["detections"] == {"r": 1}
@@ -0,0 +1,35 @@
+from fingerprint_store import FingerprintStore, MemoryFingerprintTable, group_by_address, split_changed
+
+
+def test_kb_addresses_and_agent_addresses_match():
+    # KB iac_config giữ "resource.", output agent thì không
+    fingerprints = {"resource.aws_instance.web": "a", "resource.aws_s3_bucket.logs": "b"}
+    changed, carried, removed = split_changed(fingerprints, {})
+    assert changed == ["aws_instance.web", "aws_s3_bucket.logs"]
+    verdicts = group_by_address([{"resource_address": "aws_instance.web", "issue": "x"}], changed)
+    assert [r["issue"] for r in verdicts["aws_instance.web"]] == ["x"]
+    assert verdicts["aws_s3_bucket.logs"] == []
+
+
+def test_unchanged_resources_carry_verdicts():
+    store = FingerprintStore(MemoryFingerprintTable())
+    fingerprints = {"resource.aws_instance.web": "a", "resource.aws_s3_bucket.logs": "b"}
+    changed, _, removed = split_changed(fingerprints, store.load("repo", "policy"))
+    verdicts = group_by_address([{"resource_address": "resource.aws_instance.web", "issue": "x"}], changed)
+    store.save("repo", "policy", {"aws_instance.web": "a", "aws_s3_bucket.logs": "b"}, verdicts, removed)
+
+    changed, carried, removed = split_changed(fingerprints, store.load("repo", "policy"))
+    assert changed == [] and removed == []
+    assert carried == [{"resource_address": "resource.aws_instance.web", "issue": "x"}]
+
+    changed, _, removed = split_changed({"resource.aws_instance.web": "a2"}, store.load("repo", "policy"))
+    assert changed == ["aws_instance.web"]
+    assert removed == ["aws_s3_bucket.logs"]
+
+
+def test_legacy_prefixed_keys_are_rescanned_and_removed():
+    stored = {"resource.aws_vpc.main": {"fingerprint": "c", "verdicts": []}}
+    changed, carried, removed = split_changed({"resource.aws_vpc.main": "c"}, stored)
+    assert changed == ["aws_vpc.main"]
+    assert carried == []
+    assert removed == ["resource.aws_vpc.main"]
@@ -0,0 +1,77 @@
+import json
+
+from json_repair import extract_json_from_text, repair_json
+
+
+def test_valid_json_inside_text():
+    text = 'Here is the report:\n{"drifted_resources": [{"a": 1}], "summary": "ok"}\nThanks'
+    assert extract_json_from_text(text) == {"drifted_resources": [{"a": 1}], "summary": "ok"}
+
+
+def test_array_when_no_object():
+    assert extract_json_from_text("result: [1, 2, 3]") == [1, 2, 3]
+
+
+def test_no_json():
+    assert extract_json_from_text("no drift found") == {}
+    assert extract_json_from_text("") == {}
+
+
+def test_unescaped_quote_inside_string_is_content():
+    text = '{"issue": "SSH from "bastion" host open", "risk": "high"}'
+    assert extract_json_from_text(text) == {"issue": 'SSH from "bastion" host open', "risk": "high"}
+
+
+def test_several_unescaped_quotes_in_one_string():
+    text = '{"issue": "tag "Env" changed to "prod" manually", "risk": "low"}'
+    assert extract_json_from_text(text) == {"issue": 'tag "Env" changed to "prod" manually', "risk": "low"}
+
+
+def test_quote_before_newline_closes_string():
+    # thiếu dấu phẩy giữa 2 field ở 2 dòng
+    text = '{"issue": "drift"\n "risk": "high"}'
+    assert extract_json_from_text(text) == {"issue": "drift", "risk": "high"}
+
+
+def test_truncated_string_and_containers():
+    text = '{"drifted_resources": [{"resource_address": "aws_instance.web", "issue": "Instance type chan'
+    assert extract_json_from_text(text) == {
+        "drifted_resources": [{"resource_address": "aws_instance.web", "issue": "Instance type chan"}]
+    }
+
+
+def test_truncated_after_key_and_colon():
+    assert extract_json_from_text('{"a": 1, "b"') == {"a": 1, "b": None}
+    assert extract_json_from_text('{"a": 1, "b":') == {"a": 1, "b": None}
+
+
+def test_truncated_literal_and_trailing_backslash():
+    assert extract_json_from_text('{"a": [1, tr') == {"a": [1, None]}
+    assert extract_json_from_text('{"a": "x\\') == {"a": "x"}
+
+
+def test_trailing_and_duplicate_commas():
+    text = '{"items": [1, 2,, 3,], "summary": "ok",}'
+    assert extract_json_from_text(text) == {"items": [1, 2, 3], "summary": "ok"}
+
+
+def test_missing_value_becomes_null():
+    assert extract_json_from_text('{"a": , "b": 2}') == {"a": None, "b": 2}
+
+
+def test_control_characters_are_escaped():
+    text = '{"issue": "line 1\nline 2\ttab\x01", "risk": "high",}'
+    assert extract_json_from_text(text) == {"issue": "line 1\nline 2\ttab\x01", "risk": "high"}
+
+
+def test_python_literals_and_bare_keys():
+    assert extract_json_from_text("{ok: True, missing: None, count: 2,}") == {"ok": True, "missing": None, "count": 2}
+
+
+def test_stops_after_first_top_level_value():
+    text = '{"a": [1, 2,]} and another {"b": 2}'
+    assert extract_json_from_text(text) == {"a": [1, 2]}
+
+
+def test_extra_closing_brackets_are_dropped():
+    assert json.loads(repair_json('{"a": [1]]], "b": 2}')) == {"a": [1], "b": 2}
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+from json_repair import extract_json_from_text
+from json_stream import JsonArrayStream, iter_array_items, iter_text_chunks
+
+DOC = {
+    "format_version": "1.2",
+    "resource_drift": [{"address": "aws_instance.a", "note": "quote \" and brace } inside"}],
+    "resource_changes": [
+        {"address": "aws_s3_bucket.b", "change": {"actions": ["update"], "after": {"tags": {"k": "v]"}}}},
+        {"address": "aws_vpc.c", "values": [1, 2, [3]]},
+    ],
+    "summary": "done",
+}
+
+
+def items(text, size, *paths):
+    return list(iter_array_items(iter_text_chunks(text, size), *paths))
+
+
+def test_items_of_nested_paths_for_every_chunk_size():
+    text = "Plan output:\n" + json.dumps(DOC)
+    expected = [(("resource_drift",), DOC["resource_drift"][0])] + [
+        (("resource_changes",), change) for change in DOC["resource_changes"]
+    ]
+    for size in (1, 2, 3, 7, 64, len(text)):
+        assert items(text, size, ("resource_drift",), ("resource_changes",)) == expected, size
+
+
+def test_root_array_of_scalars():
+    text = '[1, "two", true, null, {"three": 3}, [4]]'
+    for size in (1, 5, len(text)):
+        assert [item for _, item in items(text, size)] == [1, "two", True, None, {"three": 3}, [4]]
+
+
+def test_escape_split_across_chunks():
+    text = json.dumps({"a": ['back\\slash "quoted"', "x"]})
+    for size in range(1, 12):
+        assert [item for _, item in items(text, size, ("a",))] == ['back\\slash "quoted"', "x"]
+
+
+def test_utf8_bytes_split_inside_character():
+    data = json.dumps({"a": ["Tiếng Việt", "✓"]}, ensure_ascii=False).encode("utf-8")
+    chunks = [data[i:i + 1] for i in range(len(data))]
+    assert [item for _, item in iter_array_items(chunks, ("a",))] == ["Tiếng Việt", "✓"]
+
+
+def test_arrays_outside_paths_are_not_split():
+    text = json.dumps({"other": [1, 2], "nested": {"a": [3]}, "a": [4]})
+    assert items(text, 4, ("a",)) == [(("a",), 4)]
+
+
+def test_rest_keeps_fields_outside_streamed_items():
+    stream = JsonArrayStream(("drifted_resources",), keep_rest=True)
+    text = 'Here: {"drifted_resources": [{"r": 1}, {"r": 2}], "summary": "ok"} trailing'
+    streamed = [item for chunk in iter_text_chunks(text, 5) for _, item in stream.feed(chunk)]
+    assert streamed == [{"r": 1}, {"r": 2}]
+    assert stream.done
+    rest = stream.rest()
+    assert rest.startswith('{"drifted_resources": [') and rest.endswith('"summary": "ok"}')
+
+
+def test_malformed_item_stops_stream_and_full_text_is_repaired():
+    text = 'Report: {"drifted_resources": [{"r": 1}, {"r": 2, "issue": "port "22" open"}, {"r": 3}], "summary": "ok"}'
+    for size in (1, 7, len(text)):
+        stream = JsonArrayStream(("drifted_resources",), keep_rest=True)
+        streamed = [item for chunk in iter_text_chunks(text, size) for _, item in stream.feed(chunk)]
+        assert streamed == [{"r": 1}], size
+        assert stream.failed and not stream.done
+    assert extract_json_from_text(text)["drifted_resources"][1] == {"r": 2, "issue": 'port "22" open'}
+
+
+def test_iter_array_items_raises_on_malformed_item():
+    with pytest.raises(ValueError):
+        items('{"a": [1, {"b": tru}]}', 4, ("a",))
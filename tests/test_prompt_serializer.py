@@ -0,0 +1,86 @@
+import re
+
+from prompt_serializer import EMPTY, CompactInputs, split_prefix
+
+IAC = [
+    {"resource_address": "module.net.aws_security_group.app", "aws_identifier": "AWS__EC2__SecurityGroup_sg-1"},
+    {"resource_address": "module.net.aws_security_group.db", "attributes": {"description": "db"}},
+    "aws_instance.web",
+    'aws_instance.worker["a"]',
+]
+STATE = ["AWS__EC2__SecurityGroup_sg-1", "AWS__EC2__SecurityGroup_sg-2", "AWS__EC2__Instance_i-1"]
+CICD = {
+    "total_refreshed": 4, "managed_count": 1,
+    "drifted": [{"resource_address": "aws_instance.web", "aws_identifier": "AWS__EC2__Instance_i-1",
+                 "change_type": "update_in_place", "drift_details": "instance_type: t2 -> t3"}],
+    "unmanaged": [{"aws_identifier": "AWS__EC2__Instance_i-9", "reason": "missing in IaC"}],
+}
+REF_RE = re.compile(r"p\d+/[^\s]+")
+
+
+def test_split_prefix():
+    assert split_prefix("module.x.aws_instance.web") == ("module.x.aws_instance.", "web")
+    assert split_prefix("AWS__EC2__Instance_i-1") == ("AWS__EC2__Instance_", "i-1")
+    assert split_prefix('aws_instance.w["a.b"]') == ("aws_instance.", 'w["a.b"]')
+    assert split_prefix("plain") == ("", "plain")
+
+
+def test_every_ref_round_trips():
+    compact = CompactInputs(IAC, STATE, CICD)
+    assert compact.prefixes  # prefix lặp lại được đưa vào bảng
+    for line in compact.lines:
+        for ref in line[2]:
+            encoded = compact.encode_ref(ref)
+            assert compact.decode_ref(encoded) == ref
+    short_ids = {line[1] for line in compact.lines}
+    assert {i[0] for i in short_ids} == {"r", "s", "c", "u"}
+    for short_id in short_ids:
+        resource = compact.resources[short_id]
+        assert compact.decode_ref(short_id) == (resource["resource_address"] or resource["aws_identifier"])
+
+
+def test_rendered_prefix_refs_decode_with_shard_table():
+    compact = CompactInputs(IAC, STATE, CICD)
+    [shard] = compact.shards(budget_tokens=0, max_resources=0)
+    table = dict(line.split(" = ", 1) for line in shard["prefixes"].splitlines())
+    text = "\n".join(shard[k] for k in ("iac_data", "state_data", "cicd_drift"))
+    refs = REF_RE.findall(text)
+    assert refs
+    for ref in refs:
+        code, rest = ref.split("/", 1)
+        assert code in table
+        assert compact.decode_ref(ref) == table[code] + rest
+    assert shard["cicd_drift"].startswith("total_refreshed=4 managed_count=1")
+
+
+def test_decode_records_restores_address_and_identifier():
+    compact = CompactInputs(IAC, STATE, CICD)
+    r1 = next(i for i, r in compact.resources.items() if r["resource_address"] == IAC[0]["resource_address"])
+    records = compact.decode_records([
+        {"resource_address": r1, "issue": "x"},
+        {"resource_address": compact.encode_ref("module.net.aws_security_group.db"),
+         "aws_identifier": compact.encode_ref("AWS__EC2__SecurityGroup_sg-2")},
+        "not a record",
+    ])
+    assert records[0]["resource_address"] == "module.net.aws_security_group.app"
+    assert records[0]["aws_identifier"] == "AWS__EC2__SecurityGroup_sg-1"
+    assert records[1] == {"resource_address": "module.net.aws_security_group.db",
+                          "aws_identifier": "AWS__EC2__SecurityGroup_sg-2"}
+
+
+def test_shards_split_by_resource_count_without_dropping_lines():
+    iac = [f"aws_instance.w{i}" for i in range(25)]
+    compact = CompactInputs(iac)
+    shards = compact.shards(budget_tokens=0, max_resources=10)
+    assert [len(s["resource_ids"]) for s in shards] == [10, 10, 5]
+    decoded = [r["resource_address"] for s in shards for r in compact.shard_resources(s).values()]
+    assert decoded == iac
+    assert all(s["state_data"] == EMPTY for s in shards)
+
+
+def test_shards_respect_token_budget():
+    compact = CompactInputs([{"resource_address": f"aws_instance.w{i}", "attributes": {"tags": "x" * 200}}
+                             for i in range(10)])
+    shards = compact.shards(budget_tokens=200, max_resources=0)
+    assert len(shards) > 1
+    assert sum(len(s["resource_ids"]) for s in shards) == 10
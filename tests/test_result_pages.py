@@ -0,0 +1,48 @@
+from result_pages import MemoryPageStore, expand_pages, page_result, paginate
+
+
+def records(n):
+    return [{"resource_address": f"aws_instance.w{i}"} for i in range(n)]
+
+
+def test_paginate():
+    assert paginate([1, 2, 3, 4, 5], 2) == [[1, 2], [3, 4], [5]]
+    assert paginate([], 2) == [[]]
+    assert paginate([1], 0) == [[1]]
+
+
+def test_small_result_stays_inline():
+    store = MemoryPageStore()
+    result = page_result({"drifted_resources": records(3)}, "scan/normal", page_size=5, store=store)
+    assert result["pages"] == 1 and result["total_drifts"] == 3
+    assert "page_uris" not in result and store.pages == {}
+
+
+def test_large_result_round_trips_through_store():
+    store = MemoryPageStore()
+    original = records(12)
+    result = page_result({"drifted_resources": list(original), "summary": "s"}, "scan/normal",
+                         page_size=5, store=store)
+    assert result["drifted_resources"] == original[:5]
+    assert result["pages"] == 3 and result["total_drifts"] == 12
+    assert result["page_uris"] == ["memory://scan/normal/page-0002.json", "memory://scan/normal/page-0003.json"]
+
+    expanded = expand_pages(result, store=store)
+    assert expanded["drifted_resources"] == original
+    assert expanded["pages"] == 1 and "page_uris" not in expanded
+    assert expanded["summary"] == "s"
+
+
+def test_other_field_and_passthrough():
+    store = MemoryPageStore()
+    cicd = page_result({"drifted": records(4), "total_refreshed": 9}, "cicd/x", field="drifted",
+                       page_size=3, store=store)
+    assert len(cicd["drifted"]) == 3
+    assert len(expand_pages(cicd, field="drifted", store=store)["drifted"]) == 4
+    assert expand_pages({"drifted": [1]}, field="drifted", store=store) == {"drifted": [1]}
+    assert expand_pages("not a dict") == "not a dict"
+
+
+def test_no_store_keeps_everything():
+    result = page_result({"drifted_resources": records(12)}, "k", page_size=5, store=None)
+    assert len(result["drifted_resources"]) == 12 and result["pages"] == 1
@@ -0,0 +1,68 @@
+from retrieval_index import RetrievalIndex, iac_query, tokenize
+
+IAC = [
+    {"resource_address": "resource.aws_instance.web",
+     "content": 'resource "aws_instance" "web" {\n  tags = {\n    Name = "web-server"\n  }\n}'},
+    {"resource_address": "resource.aws_s3_bucket.logs", "content": 'bucket = "acme-logs"'},
+]
+STATE = [
+    {"id": "AWS__EC2__Instance_i-0web", "metadata": {"resourceType": "AWS::EC2::Instance", "resourceName": "web-server"},
+     "configuration": {"instanceType": "t3.micro"}, "tags": {"Name": "web-server"}},
+    {"id": "AWS__EC2__Instance_i-0db", "metadata": {"resourceType": "AWS::EC2::Instance", "resourceName": "db"},
+     "configuration": {"instanceType": "r5.large"}, "tags": {"Name": "db"}},
+    {"id": "AWS__S3__Bucket_acme-logs", "metadata": {"resourceType": "AWS::S3::Bucket", "resourceName": "acme-logs"},
+     "configuration": {}},
+] + [
+    # resource cùng type: các term chỉ về type (aws, ec2, instance) phổ biến như trong KB thật
+    {"id": f"AWS__EC2__Instance_i-0app{i}", "metadata": {"resourceType": "AWS::EC2::Instance", "resourceName": f"app-{i}"},
+     "configuration": {"instanceType": "t3.small"}}
+    for i in range(8)
+]
+
+
+def index():
+    return RetrievalIndex.from_documents(IAC, STATE)
+
+
+def test_tokenize_keeps_hyphenated_ids_and_parts():
+    assert tokenize("AWS__EC2__Instance_i-0ab") == ["aws", "ec2", "instance", "i-0ab", "i", "0ab"]
+
+
+def test_exact_lookup_normalizes_iac_addresses():
+    idx = index()
+    assert idx.get("iac", "aws_instance.web") is IAC[0]
+    assert idx.get("iac", "resource.aws_instance.web") is IAC[0]
+    assert idx.get("state", "AWS__S3__Bucket_acme-logs") is STATE[2]
+
+
+def test_bm25_ranks_name_match_first():
+    idx = index()
+    assert "web-server" in iac_query(IAC[0])
+    ranked = idx.search(iac_query(IAC[0]), k=3, kind="state")
+    assert ranked[0][1] == "AWS__EC2__Instance_i-0web"
+    assert all(kind == "state" for kind, _, _ in ranked)
+    assert ranked[0][2] > ranked[-1][2]
+
+
+def test_bm25_scores_rare_terms_higher():
+    idx = index()
+    scores = idx.bm25("web-server instance", kind="state")
+    web, db = (idx.by_key[("state", i)] for i in ("AWS__EC2__Instance_i-0web", "AWS__EC2__Instance_i-0db"))
+    assert scores[web] > scores.get(db, 0)
+    assert idx.bm25("nothing-matches") == {}
+
+
+def test_context_uses_exact_docs_and_candidates_within_budget():
+    idx = index()
+    resources = {
+        "r1": {"resource_address": "aws_instance.web"},
+        "r2": {"resource_address": "resource.aws_s3_bucket.logs", "aws_identifier": "AWS__S3__Bucket_acme-logs"},
+    }
+    text = idx.context(resources, top_k=2, budget_tokens=0)
+    assert "[r1] iac_config aws_instance.web" in text
+    assert "[r1 candidate] aws_state AWS__EC2__Instance_i-0web" in text
+    assert "AWS__EC2__Instance_i-0db" not in text          # chỉ khớp resource type → bị lọc
+    assert "[r2] aws_state AWS__S3__Bucket_acme-logs" in text
+
+    small = idx.context(resources, top_k=2, budget_tokens=40)
+    assert small.count("\n[") < text.count("\n[")
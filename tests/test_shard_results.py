@@ -0,0 +1,47 @@
+from shard_results import dedupe_drifts, detection_result
+
+
+def drift(address, issue, risk="medium"):
+    return {"resource_address": address, "issue": issue, "risk": risk}
+
+
+def test_failed_shards_are_flagged_when_only_local_drifts_remain():
+    local = [drift("aws_instance.web", "instance_type mismatch")]
+    result = detection_result("normal", "full_scan", [{}, {}], local)
+    assert result["drifted_resources"] == local
+    assert result["failed_shards"] == 2
+    assert "2/2 shards failed" in result["summary"]
+
+
+def test_partial_shard_failure_keeps_verdicts_and_flag():
+    outputs = [{"drifted_resources": [drift("aws_vpc.main", "dns", "high")], "summary": "1 drift"}, {}]
+    result = detection_result("normal", "full_scan", outputs, [drift("aws_vpc.main", "cidr", "low")])
+    assert result["failed_shards"] == 1
+    [record] = result["drifted_resources"]
+    assert record["risk"] == "high" and record["issue"] == "cidr; dns"
+
+
+def test_no_failure_flag_when_every_shard_answered():
+    result = detection_result("policy", "full_scan", [{"drifted_resources": [], "summary": "clean"}])
+    assert "failed_shards" not in result
+    assert result["detection_type"] == "policy" and result["summary"] == "clean"
+
+
+def test_dedupe_matches_addresses_with_resource_prefix():
+    records = dedupe_drifts([drift("resource.aws_s3_bucket.logs", "acl"), drift("aws_s3_bucket.logs", "versioning")])
+    assert [r["issue"] for r in records] == ["acl; versioning"]
+
+
+def test_local_only_result_is_deduped():
+    local = [drift("aws_instance.web", "ami mismatch", "high"), drift("aws_instance.web", "tags[\"Env\"] mismatch")]
+    result = detection_result("normal", "full_scan", [], local)
+    assert "failed_shards" not in result
+    [record] = result["drifted_resources"]
+    assert record["risk"] == "high" and record["issue"] == 'ami mismatch; tags["Env"] mismatch'
+    assert result["summary"] == "2 attribute drifts found by local comparison"
+
+
+def test_clean_local_only_result_is_not_a_parse_failure():
+    result = detection_result("normal", "full_scan", [], [])
+    assert result["drifted_resources"] == []
+    assert "parsing failed" not in result["summary"]
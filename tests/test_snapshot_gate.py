@@ -0,0 +1,35 @@
+import snapshot_gate
+from snapshot_gate import MemorySnapshotGate, build_gate
+
+
+def test_window_absorbs_events_until_it_expires():
+    gate = MemorySnapshotGate(window=300)
+    assert gate.open_window("default", now=1000) == 0
+    assert gate.open_window("default", now=1100) is None
+    assert gate.absorb("default") == (1, 1000)
+    assert gate.absorb("default") == (2, 1000)
+    # flush cuối cửa sổ: chỉ mở cửa sổ mới khi còn event chờ
+    assert gate.open_window("default", now=1200, require_pending=True) is None
+    assert gate.open_window("default", now=1301, require_pending=True) == 2
+    assert gate.open_window("default", now=1700, require_pending=True) is None
+
+
+def test_release_returns_events_to_next_window():
+    gate = MemorySnapshotGate(window=300)
+    assert gate.open_window("default", now=1000) == 0
+    gate.release("default", 3)
+    assert gate.open_window("default", now=1001) == 3
+
+
+def test_memory_backend_without_table(monkeypatch):
+    monkeypatch.setattr(snapshot_gate, "SNAPSHOT_GATE_BACKEND", "dynamodb")
+    monkeypatch.setattr(snapshot_gate, "SNAPSHOT_GATE_TABLE", "")
+    assert isinstance(build_gate(60), MemorySnapshotGate)
+
+
+def test_flush_in_container_without_state_still_delivers():
+    # container nhận message flush không phải container đã gom event
+    gate = MemorySnapshotGate(window=300)
+    assert gate.open_window("default", now=1301, require_pending=True) == 1
+    assert gate.open_window("default", now=1302) is None
+    assert gate.open_window("default", now=1700, require_pending=True) is None
@@ -0,0 +1,36 @@
+import json
+
+from terraform_plan_reader import parse_terraform_plan
+
+
+def plan(*changes, drift=()):
+    return json.dumps({"format_version": "1.2", "resource_drift": list(drift), "resource_changes": list(changes)})
+
+
+def change(address, tf_type, actions, before, after):
+    return {"address": address, "mode": "managed", "type": tf_type,
+            "change": {"actions": actions, "before": before, "after": after}}
+
+
+def test_module_address_maps_to_aws_identifier():
+    body = plan(
+        change('module.net.aws_security_group.app["a"]', "aws_security_group", ["update"],
+               {"id": "sg-1", "description": "old"}, {"id": "sg-1", "description": "new"}),
+        change("aws_instance.web", "aws_instance", ["no-op"], {"id": "i-1"}, {"id": "i-1"}),
+    )
+    result = parse_terraform_plan([body[:40], body[40:]])
+    assert result["total_refreshed"] == 2
+    [record] = result["drifted"]
+    assert record["aws_identifier"] == "AWS__EC2__SecurityGroup_sg-1"
+    assert record["change_type"] == "update_in_place"
+
+
+def test_drift_outside_terraform_is_merged_with_planned_change():
+    before, after = {"id": "i-1", "instance_type": "t2.micro"}, {"id": "i-1", "instance_type": "t3.micro"}
+    body = plan(
+        change("aws_instance.web", "aws_instance", ["update"], after, before),
+        drift=[change("aws_instance.web", "aws_instance", ["update"], before, after)],
+    )
+    [record] = parse_terraform_plan([body])["drifted"]
+    assert record["aws_identifier"] == "AWS__EC2__Instance_i-1"
+    assert record["drift_details"].startswith("Changed outside of Terraform")
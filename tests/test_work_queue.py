@@ -0,0 +1,124 @@
+from work_queue import MAX_RECEIVES, FAILURES_KEY, MemoryWorkQueue, RetryLater, drain, process_batch, retry_delay
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_queue(bodies):
+    clock = Clock()
+    queue = MemoryWorkQueue(visibility_timeout=300, clock=clock)
+    queue.send_batch(bodies)
+    return queue, clock
+
+
+def only_message(queue):
+    assert len(queue.messages) == 1
+    return next(iter(queue.messages.values()))
+
+
+def test_done_messages_are_deleted():
+    queue, _ = make_queue([{"repoUrl": "a"}, {"repoUrl": "b"}])
+    seen = []
+    outcome = process_batch(queue, queue.receive(), lambda body: seen.append(body["repoUrl"]))
+    assert sorted(seen) == ["a", "b"]
+    assert len(outcome["done"]) == 2
+    assert queue.messages == {}
+
+
+def test_slot_wait_requeues_fresh_message_without_counting_failure():
+    queue, clock = make_queue([{"repoUrl": "a"}])
+
+    def no_slot(body):
+        raise RetryLater("no free slot", 60)
+
+    for _ in range(MAX_RECEIVES + 2):
+        outcome = process_batch(queue, queue.receive(), no_slot)
+        assert len(outcome["retried"]) == 1 and not outcome["dead"]
+        message = only_message(queue)
+        # message mới: receive count không cộng dồn, không có lỗi thật nào
+        assert message["receive_count"] == 0
+        assert FAILURES_KEY not in message["body"]
+        assert message["visible_at"] == clock.now + 60
+        assert queue.receive() == []
+        clock.now += 60
+    assert queue.dead_letters == []
+
+
+def test_failure_backoff_and_dead_letter():
+    queue, clock = make_queue([{"repoUrl": "a"}])
+
+    def broken(body):
+        raise ValueError("boom")
+
+    for failures in range(1, MAX_RECEIVES):
+        outcome = process_batch(queue, queue.receive(), broken)
+        assert len(outcome["retried"]) == 1
+        message = only_message(queue)
+        assert message["body"][FAILURES_KEY] == failures
+        assert message["visible_at"] == clock.now + retry_delay(failures)
+        clock.now += retry_delay(failures)
+
+    outcome = process_batch(queue, queue.receive(), broken)
+    assert len(outcome["dead"]) == 1
+    assert queue.messages == {}
+    assert queue.dead_letters[0]["reason"] == "ValueError: boom"
+    assert queue.dead_letters[0]["body"][FAILURES_KEY] == MAX_RECEIVES - 1
+
+
+def test_first_error_after_slot_waits_is_not_dead_lettered():
+    queue, clock = make_queue([{"repoUrl": "a"}])
+    for _ in range(MAX_RECEIVES):
+        process_batch(queue, queue.receive(), lambda body: (_ for _ in ()).throw(RetryLater("wait", 10)))
+        clock.now += 10
+    outcome = process_batch(queue, queue.receive(), lambda body: 1 / 0)
+    assert not outcome["dead"] and len(outcome["retried"]) == 1
+    assert only_message(queue)["body"][FAILURES_KEY] == 1
+
+
+def test_unacked_redelivery_counts_as_failure():
+    # Lambda chết sau khi nhận (không ack) → lần nhận lại được tính là 1 lỗi
+    queue, clock = make_queue([{"repoUrl": "a"}])
+    queue.receive()
+    clock.now += 300
+    outcome = process_batch(queue, queue.receive(), lambda body: 1 / 0)
+    assert len(outcome["retried"]) == 1
+    assert only_message(queue)["body"][FAILURES_KEY] == 2
+
+
+def test_resend_failure_falls_back_to_visibility_timeout():
+    queue, clock = make_queue([{"repoUrl": "a"}])
+
+    def send_down(bodies, delay_seconds=0):
+        raise RuntimeError("sqs unavailable")
+
+    messages = queue.receive()
+    queue.send_batch = send_down
+    outcome = process_batch(queue, messages, lambda body: (_ for _ in ()).throw(RetryLater("wait", 45)))
+    assert outcome["unacked"] == [messages[0].id] and not outcome["retried"]
+    assert only_message(queue)["visible_at"] == clock.now + 45
+
+
+def test_drain_stops_when_budget_is_used():
+    queue, _ = make_queue([{"repoUrl": str(i)} for i in range(25)])
+    state = {"free": 12}
+
+    def handle(body):
+        if state["free"] <= 0:
+            raise RetryLater("no free slot", 60)
+        state["free"] -= 1
+
+    outcome = drain(queue, handle, lambda: state["free"])
+    assert len(outcome["done"]) == 12
+    assert len(queue.messages) == 13
+    assert queue.depth() == {"visible": 13, "in_flight": 0}
+
+
+def test_drain_stops_at_deadline():
+    queue, _ = make_queue([{"repoUrl": "a"}])
+    outcome = drain(queue, lambda body: None, lambda: 10, deadline=0)
+    assert outcome["done"] == [] and len(queue.messages) == 1